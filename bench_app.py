@@ -0,0 +1,233 @@
+"""Headless Render-Benchmark für streamlit_app.py
+
+Fährt die App über streamlit.testing (AppTest) komplett lokal im SAFE_MODE:
+Login, Wochen- und Monatsansicht durchblättern, Buchen und Stornieren,
+Admin-Panel rendern. Pro Rerun werden Wall-Time und Anzahl SQL-Statements
+gemessen, damit N+1-Regressionen in den UI-Funktionen auffallen.
+
+Aufruf:
+    python bench_app.py [--weeks 4] [--months 2] [--users 50] [--bookings 60]
+                        [--max-queries 0] [--json bench.json]
+"""
+import argparse, ast, json, os, random, sqlite3, sys, tempfile, time
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+import pytz
+from streamlit.testing.v1 import AppTest
+from streamlit.testing.v1.element_tree import Widget
+
+APP_FILE = Path(__file__).resolve().with_name("streamlit_app.py")
+ADMIN_EMAIL = "bench-admin@dienstplan.local"
+ADMIN_PASSWORD = "bench-admin-pw"
+BENCH_TIMEZONE = "Europe/Berlin"  # auch als TIMEZONE-Secret gesetzt, damit start_epoch übereinstimmt
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+SQL_PREFIXES = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+
+# ===== SQL-Zähler =====
+class SQLCounter:
+    """Zählt alle SQL-Statements, die über sqlite3.connect abgesetzt werden"""
+
+    def __init__(self):
+        self.count = 0
+        self._connect = sqlite3.connect
+
+    def _trace(self, stmt):
+        if stmt.lstrip().upper().startswith(SQL_PREFIXES):
+            self.count += 1
+
+    def install(self):
+        counter = self
+
+        def connect(*args, **kwargs):
+            c = counter._connect(*args, **kwargs)
+            c.set_trace_callback(counter._trace)
+            return c
+
+        sqlite3.connect = connect
+
+    def uninstall(self):
+        sqlite3.connect = self._connect
+
+# ===== Testdaten =====
+def slot_defs(cur):
+    """Aktive Slot-Konfiguration: app_settings 'weekly_slots', sonst WEEKLY_SLOTS aus streamlit_app.py.
+
+    Die App wird dafür nicht importiert (Modulebene liest st.secrets); der
+    Standard wird aus dem Quelltext gelesen.
+    """
+    cur.execute("SELECT value FROM app_settings WHERE key='weekly_slots'")
+    row = cur.fetchone()
+    if row and row[0]:
+        try: return json.loads(row[0])
+        except ValueError: pass
+    tree = ast.parse(APP_FILE.read_text(encoding="utf-8"))
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(getattr(t, "id", None) == "WEEKLY_SLOTS" for t in node.targets):
+            return ast.literal_eval(node.value)
+    raise RuntimeError("WEEKLY_SLOTS nicht gefunden")
+
+def seed_data(db_path, users, bookings):
+    """Legt zusätzliche Nutzer und Buchungen an (direkt per SQL, ohne App-Logik).
+
+    Wochentage kommen aus der aktiven Slot-Konfiguration; start_epoch und
+    Change-Feed werden so geschrieben wie bei Buchungen über die App.
+    """
+    if not (users or bookings): return
+    rnd = random.Random(42)
+    c = sqlite3.connect(db_path)
+    cur = c.cursor()
+    cur.executemany("""INSERT OR IGNORE INTO users(email,phone,name,password_hash)
+                       VALUES(?,?,?,?)""",
+                    [(f"user{i}@dienstplan.local", f"+49151{i:08d}", f"Nutzer {i:03d}", "x")
+                     for i in range(users)])
+    cur.execute("SELECT id FROM users")
+    uids = [r[0] for r in cur.fetchall()]
+    slots = {s["id"]: s for s in slot_defs(cur)}
+    tz = pytz.timezone(BENCH_TIMEZONE)
+    today = date.today()
+    ws = today - timedelta(days=today.weekday())
+    rows = {}
+    for _ in range(bookings):
+        slot = slots[rnd.choice(sorted(slots))]
+        d = ws + timedelta(weeks=rnd.randint(-8, 12), days=WEEKDAYS.index(slot["day"]))
+        start = tz.localize(datetime.combine(d, datetime.strptime(slot["start"], "%H:%M").time()))
+        rows.setdefault((slot["id"], d), (rnd.choice(uids), slot["id"], d.strftime("%Y-%m-%d"),
+                                          int(start.timestamp())))
+    for uid, slot_id, d, start_epoch in sorted(rows.values()):
+        cur.execute("""INSERT INTO bookings(user_id,slot_id,booking_date,start_epoch) VALUES(?,?,?,?)
+                       ON CONFLICT(slot_id, booking_date) DO NOTHING RETURNING id""",
+                    (uid, slot_id, d, start_epoch))
+        row = cur.fetchone()
+        if row:
+            cur.execute("""INSERT INTO change_feed(kind,booking_id,slot_id,booking_date,user_id)
+                           VALUES('booked',?,?,?,?)""", (row[0], slot_id, d, uid))
+    c.commit()
+    c.close()
+
+# ===== Benchmark =====
+class Bench:
+    def __init__(self, timeout):
+        self.counter = SQLCounter()
+        self.results = []
+        self.at = AppTest.from_file(str(APP_FILE), default_timeout=timeout)
+        self.at.secrets["SAFE_MODE"] = "true"
+        self.at.secrets["TIMEZONE"] = BENCH_TIMEZONE
+        self.at.secrets["ENABLE_DAILY_BACKUP"] = "false"
+        self.at.secrets["ENABLE_REMINDER_SMS"] = "false"
+        self.at.secrets["ADMIN_EMAIL"] = ADMIN_EMAIL
+        self.at.secrets["ADMIN_PASSWORD"] = ADMIN_PASSWORD
+
+    def run(self, step, action=None):
+        """Führt eine Aktion plus Rerun aus und misst Zeit und SQL-Statements"""
+        self.counter.count = 0
+        t0 = time.perf_counter()
+        if action: action(self.at)
+        self.at.run()
+        ms = (time.perf_counter() - t0) * 1000
+        if self.at.exception:
+            raise RuntimeError(f"{step}: {self.at.exception[0].message}")
+        self._prune_stale(self.at._tree)
+        self.results.append({"step": step, "ms": round(ms, 1), "queries": self.counter.count})
+        return self.at
+
+    def _prune_stale(self, node):
+        """Entfernt Widgets aus Läufen, die per st.rerun() abgebrochen wurden.
+
+        AppTest sammelt die Deltas aller Durchläufe eines Reruns; ändert sich das
+        Layout (z.B. nach dem Login), bleiben Widgets ohne Session-State stehen.
+        """
+        for k, child in list(getattr(node, "children", {}).items()):
+            if isinstance(child, Widget):
+                try: self.at.session_state[child.id]
+                except KeyError: del node.children[k]
+            else:
+                self._prune_stale(child)
+
+    def button(self, label=None, key_prefix=None):
+        for b in self.at.button:
+            if label and b.label == label: return b
+            if key_prefix and b.key and b.key.startswith(key_prefix): return b
+        return None
+
+    def login(self, at):
+        at.text_input[0].input(ADMIN_EMAIL)
+        at.text_input[1].input(ADMIN_PASSWORD)
+        at.button[0].click()
+
+def run_bench(args):
+    bench = Bench(args.timeout)
+    bench.counter.install()
+    try:
+        bench.run("initial")
+        seed_data(os.path.abspath("dienstplan.db"), args.users, args.bookings)
+        bench.run("login", bench.login)
+
+        for i in range(args.weeks):
+            bench.run(f"week_next_{i+1}", lambda at: bench.button("Nächste Woche ➡️").click())
+
+        # Bis zu 26 Wochen weiterblättern, bis ein freier Slot buchbar ist
+        for _ in range(26):
+            if bench.button(key_prefix="book_"): break
+            bench.run("week_search", lambda at: bench.button("Nächste Woche ➡️").click())
+        if bench.button(key_prefix="book_"):
+            bench.run("book", lambda at: bench.button(key_prefix="book_").click())
+            bench.run("cancel", lambda at: bench.button(key_prefix="cancel_").click())
+
+        bench.run("month_view", lambda at: bench.button("🔄 Monatsansicht").click())
+        for i in range(args.months):
+            bench.run(f"month_next_{i+1}", lambda at: bench.button("Nächster Monat ➡️").click())
+        bench.run("week_view", lambda at: bench.button("🔄 Wochenansicht").click())
+
+        # Alle Tabs werden pro Rerun gerendert; ein leerer Rerun misst das Admin-Panel
+        bench.run("admin_tabs")
+        tabs = [t.label for t in bench.at.tabs]
+        for label in ("👥 Nutzer", "📝 Templates", "📊 Reporting", "💾 Backup/Restore"):
+            if label not in tabs:
+                raise RuntimeError(f"Admin-Tab fehlt: {label}")
+    finally:
+        bench.counter.uninstall()
+    return bench.results
+
+def print_report(results):
+    print(f"{'Schritt':<18} {'ms':>9} {'SQL':>6}")
+    print("-" * 35)
+    for r in results:
+        print(f"{r['step']:<18} {r['ms']:>9.1f} {r['queries']:>6}")
+    print("-" * 35)
+    print(f"{'Summe':<18} {sum(r['ms'] for r in results):>9.1f} {sum(r['queries'] for r in results):>6}")
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Headless Render-Benchmark (AppTest, SAFE_MODE)")
+    p.add_argument("--weeks", type=int, default=4, help="Anzahl Wochen zum Weiterblättern")
+    p.add_argument("--months", type=int, default=2, help="Anzahl Monate zum Weiterblättern")
+    p.add_argument("--users", type=int, default=50, help="Zusätzliche Testnutzer")
+    p.add_argument("--bookings", type=int, default=60, help="Zusätzliche Testbuchungen")
+    p.add_argument("--max-queries", type=int, default=0,
+                   help="Exit-Code 1, wenn ein Rerun mehr SQL-Statements absetzt (0 = aus)")
+    p.add_argument("--timeout", type=float, default=60, help="Timeout pro Rerun in Sekunden")
+    p.add_argument("--json", help="Ergebnisse zusätzlich als JSON speichern")
+    args = p.parse_args(argv)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="dienstplan-bench-") as tmp:
+        os.chdir(tmp)  # dienstplan.db landet im Temp-Verzeichnis
+        try:
+            results = run_bench(args)
+        finally:
+            os.chdir(cwd)
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    worst = max(results, key=lambda r: r["queries"])
+    if args.max_queries and worst["queries"] > args.max_queries:
+        print(f"FEHLER: {worst['step']} setzt {worst['queries']} SQL-Statements ab "
+              f"(Limit {args.max_queries})", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,15 @@
 import streamlit as st
-import sqlite3, hashlib, io, zipfile, smtplib, json, calendar
-from datetime import datetime, timedelta, date
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import sqlite3, hashlib, io, zipfile, smtplib, json, calendar, threading, time, functools, tempfile
+import cProfile, pstats, hmac, secrets, os, re, csv, logging, atexit, shutil
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+from wsgiref.util import setup_testing_defaults
+from collections import deque, namedtuple
+import heapq
+from datetime import datetime, timedelta, date, timezone
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
@@ -10,7 +19,15 @@ import pytz
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
+from requests.adapters import HTTPAdapter
+from twilio.base.exceptions import TwilioRestException
 import pandas as pd
+import numpy as np
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:  # optional; sonst NumPy-Fallback im Solver
+    linear_sum_assignment = None
 import plotly.express as px
 import plotly.graph_objects as go
 
@@ -20,15 +37,88 @@ DB_FILE = "dienstplan.db"
 TIMEZONE_STR = (st.secrets.get("TIMEZONE", "Europe/Berlin")
                 if hasattr(st, "secrets") else "Europe/Berlin")
 TZ = pytz.timezone(TIMEZONE_STR)
+logger = logging.getLogger("dienstplan")
 SAFE_MODE = bool(hasattr(st, "secrets") and str(st.secrets.get("SAFE_MODE", "true")).lower() == "true")
 ENABLE_DAILY_BACKUP = bool(hasattr(st, "secrets") and str(st.secrets.get("ENABLE_DAILY_BACKUP", "false")).lower() == "true")
 ENABLE_REMINDER_SMS = bool(hasattr(st, "secrets") and str(st.secrets.get("ENABLE_REMINDER_SMS", "false")).lower() == "true")
+ENABLE_DB_MAINTENANCE = bool(hasattr(st, "secrets") and str(st.secrets.get("ENABLE_DB_MAINTENANCE", "false")).lower() == "true")
+ENABLE_DB_PROFILING = bool(hasattr(st, "secrets") and str(st.secrets.get("ENABLE_DB_PROFILING", "false")).lower() == "true")
+ENABLE_UI_PROFILER = bool(hasattr(st, "secrets") and str(st.secrets.get("ENABLE_UI_PROFILER", "false")).lower() == "true")
+SLOW_QUERY_MS = float(st.secrets.get("SLOW_QUERY_MS", 50) if hasattr(st, "secrets") else 50)
+PBKDF2_ITERATIONS = int(st.secrets.get("PBKDF2_ITERATIONS", 240000) if hasattr(st, "secrets") else 240000)
+AUTH_WORKERS = int(st.secrets.get("AUTH_WORKERS", 4) if hasattr(st, "secrets") else 4)
+AUTH_MAX_PENDING = int(st.secrets.get("AUTH_MAX_PENDING", 32) if hasattr(st, "secrets") else 32)
+AUTH_TIMEOUT_SECONDS = 15
+ENABLE_API = bool(hasattr(st, "secrets") and str(st.secrets.get("ENABLE_API", "false")).lower() == "true")
+API_HOST = st.secrets.get("API_HOST", "127.0.0.1") if hasattr(st, "secrets") else "127.0.0.1"
+API_PORT = int(st.secrets.get("API_PORT", 8502) if hasattr(st, "secrets") else 8502)
+API_PUBLIC_URL = (st.secrets.get("API_PUBLIC_URL", "") if hasattr(st, "secrets") else "") or f"http://{API_HOST}:{API_PORT}"
+ENABLE_METRICS = bool(hasattr(st, "secrets") and str(st.secrets.get("ENABLE_METRICS", "false")).lower() == "true")
+METRICS_HOST = st.secrets.get("METRICS_HOST", "127.0.0.1") if hasattr(st, "secrets") else "127.0.0.1"
+METRICS_PORT = int(st.secrets.get("METRICS_PORT", 9108) if hasattr(st, "secrets") else 9108)
+ICS_FEED_PAST_DAYS = 90
+ICS_FEED_FUTURE_DAYS = 365
+ADMIN_USERS_PAGE_SIZE = 25
+ADMIN_DIGEST_MINUTES = int(st.secrets.get("ADMIN_DIGEST_MINUTES", 0) if hasattr(st, "secrets") else 0)  # 0 = sofort
+ADMIN_URGENT_HOURS = 24  # Ereignisse so kurz vor Schichtbeginn gehen immer sofort raus
+# Automatische Zuteilung: Präferenzstufen je Slot (Standard ohne Eintrag: "möglich")
+AVAILABILITY_LEVELS = {2: "👍 gern", 1: "🆗 möglich", 0: "🚫 nicht verfügbar"}
+ASSIGN_MAX_PER_WEEK = 1     # max. Schichten pro Person und Woche (inkl. bestehender Buchungen)
+ASSIGN_LOAD_DAYS = 365      # Zeitraum, über den die bisherige Last zählt
+ASSIGN_LOAD_WEIGHT = 1.0    # Kosten pro bereits übernommener Schicht (Fairness)
+REMINDER_OFFSETS = {"24h": timedelta(hours=24), "1h": timedelta(hours=1)}
+REMINDER_GRACE = timedelta(minutes=15)  # verspätet (z.B. nach Neustart) nur innerhalb dieser Frist nachholen
+REMINDER_RETRY_SECONDS = 60       # erster Wiederholungsversuch nach fehlgeschlagenem Versand, danach verdoppelt
+REMINDER_RETRY_MAX_SECONDS = 300
+ORPHAN_SWEEP_CHUNK = 500  # Zeilen pro Lösch-Transaktion
+CHANGE_FEED_RETENTION_DAYS = 180  # ältere Feed-Einträge vergangener Termine werden nachts gelöscht
+MAINTENANCE_VACUUM_PAGES = 1000  # Seiten pro incremental_vacuum-Schritt (eigene Transaktion)
+MAINTENANCE_MAX_SECONDS = 60     # Zeitbudget für das inkrementelle Vacuum
+
+# Tage seit 1970-01-01 wie day_number(); julianday statt unixepoch (erst ab SQLite 3.38)
+DAY_NUM_SQL = "CAST(julianday(booking_date) - 2440587.5 AS INTEGER)"
+# Tabellen mit Fremdschlüsseln; "{name}" = Tabellenname (Neuanlage bzw. Umbau-Migration)
+FK_SCHEMA = {
+    "bookings": """CREATE TABLE IF NOT EXISTS {name}(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE, slot_id INTEGER NOT NULL,
+                booking_date DATE NOT NULL, status TEXT DEFAULT 'confirmed',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, start_epoch INTEGER,
+                day_num INTEGER GENERATED ALWAYS AS (""" + DAY_NUM_SQL + """) VIRTUAL,
+                UNIQUE(slot_id, booking_date))""",
+    "reminder_log": """CREATE TABLE IF NOT EXISTS {name}(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                booking_id INTEGER NOT NULL REFERENCES bookings(id) ON DELETE CASCADE,
+                reminder_type TEXT NOT NULL, sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                status TEXT DEFAULT 'sent', UNIQUE(booking_id, reminder_type))""",
+    "user_availability": """CREATE TABLE IF NOT EXISTS {name}(
+                user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+                slot_id INTEGER NOT NULL, preference INTEGER NOT NULL,
+                PRIMARY KEY(user_id, slot_id)) WITHOUT ROWID""",
+}
+# (tabelle, fk-spalte, eltern-tabelle, schlüssel für DELETE) in Abhängigkeitsreihenfolge
+ORPHAN_RULES = (
+    ("bookings", "user_id", "users", "rowid"),
+    ("reminder_log", "booking_id", "bookings", "rowid"),
+    ("user_availability", "user_id", "users", "user_id, slot_id"),
+)
+BACKUP_TABLES = ("users", "bookings", "audit_log", "app_settings", "info_pages", "reminder_log", "user_availability")
+SMTP_CONNECT_TIMEOUT = float(st.secrets.get("SMTP_CONNECT_TIMEOUT", 5) if hasattr(st, "secrets") else 5)
+SMTP_READ_TIMEOUT = float(st.secrets.get("SMTP_READ_TIMEOUT", 15) if hasattr(st, "secrets") else 15)
+TWILIO_CONNECT_TIMEOUT = float(st.secrets.get("TWILIO_CONNECT_TIMEOUT", 5) if hasattr(st, "secrets") else 5)
+TWILIO_READ_TIMEOUT = float(st.secrets.get("TWILIO_READ_TIMEOUT", 10) if hasattr(st, "secrets") else 10)
+BREAKER_FAILURE_THRESHOLD = int(st.secrets.get("BREAKER_FAILURE_THRESHOLD", 3) if hasattr(st, "secrets") else 3)
+BREAKER_RESET_SECONDS = float(st.secrets.get("BREAKER_RESET_SECONDS", 60) if hasattr(st, "secrets") else 60)
+PLAN_REFRESH_SECONDS = int(st.secrets.get("PLAN_REFRESH_SECONDS", 30) if hasattr(st, "secrets") else 30)
+AUTH_TOKEN_TTL_MINUTES = int(st.secrets.get("AUTH_TOKEN_TTL_MINUTES", 480) if hasattr(st, "secrets") else 480)
 
 WEEKLY_SLOTS = [
     {"id": 1, "day": "tuesday",  "day_name": "Dienstag", "start": "17:00", "end": "20:00"},
     {"id": 2, "day": "friday",   "day_name": "Freitag",  "start": "17:00", "end": "20:00"},
     {"id": 3, "day": "saturday", "day_name": "Samstag",  "start": "14:00", "end": "17:00"},
 ]
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+WEEKDAY_INDEX = {d: i for i, d in enumerate(WEEKDAYS)}
 
 # Bayerische Feiertage 2025/2026
 BAVARIA_HOLIDAYS = {
@@ -49,13 +139,23 @@ def week_start(d=None):
     if hasattr(d, "date"): d = d.date()
     return d - timedelta(days=d.weekday())
 
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def day_number(d):
+    """ISO-Datum oder date → Tage seit 1970-01-01 (entspricht bookings.day_num)"""
+    if isinstance(d, str): d = date.fromisoformat(d)
+    return d.toordinal() - EPOCH_ORDINAL
+
+def shift_start_epoch(slot, booking_date):
+    """Schichtbeginn als Unix-Zeit (lokale Zeitzone, DST-korrekt; entspricht bookings.start_epoch)"""
+    return int(TZ.localize(datetime.combine(date.fromisoformat(booking_date), slot.start_time)).timestamp())
+
 def get_current_week():
     """Gibt die aktuelle Kalenderwoche zurück"""
     return week_start(datetime.now().date())
 
 def slot_date(ws, day):
-    m = {"monday":0,"tuesday":1,"wednesday":2,"thursday":3,"friday":4,"saturday":5,"sunday":6}
-    return (ws + timedelta(days=m.get(day,0))).strftime("%Y-%m-%d")
+    return (ws + timedelta(days=WEEKDAY_INDEX.get(day,0))).strftime("%Y-%m-%d")
 
 def fmt_de(d):
     try: return datetime.strptime(d, "%Y-%m-%d").strftime("%d.%m.%Y")
@@ -86,41 +186,161 @@ def get_block_reason(date_str):
         return "🏖️ Sommerpause - Hallenbad geschlossen"
     return None
 
-def generate_ics(slot, booking_date, user_name, user_email, action="REQUEST"):
-    """Generiert iCal-Einladung für Schichtbuchung"""
-    dt = datetime.strptime(booking_date, "%Y-%m-%d")
-    start_dt = datetime.combine(dt, datetime.strptime(slot["start"], "%H:%M").time())
-    end_dt = datetime.combine(dt, datetime.strptime(slot["end"], "%H:%M").time())
+def _ics_event(slot, booking_date, user_name, user_email, status="CONFIRMED", sequence=0, modified=None):
+    """VEVENT-Block einer Schicht; UID ist pro Slot und Datum stabil (ATTENDEE nur mit user_email)"""
+    dt = date.fromisoformat(booking_date)
     
     # In lokale Zeitzone konvertieren
-    start_dt = TZ.localize(start_dt)
-    end_dt = TZ.localize(end_dt)
+    start_dt = TZ.localize(datetime.combine(dt, slot.start_time))
+    end_dt = TZ.localize(datetime.combine(dt, slot.end_time))
+    stamp = (modified or datetime.now(timezone.utc)).strftime('%Y%m%dT%H%M%SZ')
     
     # UID für eindeutige Identifikation
-    uid = f"dienstplan-{slot['id']}-{booking_date}@dienstplan-cloud.local"
+    uid = f"dienstplan-{slot.id}-{booking_date}@dienstplan-cloud.local"
+    attendee = f"\nATTENDEE;PARTSTAT=ACCEPTED:mailto:{user_email}" if user_email else ""
     
-    ics_content = f"""BEGIN:VCALENDAR
-VERSION:2.0
-PRODID:-//Dienstplan+ Cloud//DE
-METHOD:{action}
-BEGIN:VEVENT
+    return f"""BEGIN:VEVENT
 UID:{uid}
+DTSTAMP:{stamp}
 DTSTART;TZID={TIMEZONE_STR}:{start_dt.strftime('%Y%m%dT%H%M%S')}
 DTEND;TZID={TIMEZONE_STR}:{end_dt.strftime('%Y%m%dT%H%M%S')}
-SUMMARY:Schicht {slot['day_name']}
-DESCRIPTION:Dienstplan+ Schicht\\n{slot['day_name']} {slot['start']}-{slot['end']}\\nGebucht von: {user_name}
+SUMMARY:Schicht {slot.day_name}
+DESCRIPTION:Dienstplan+ Schicht\\n{slot.day_name} {slot.start}-{slot.end}\\nGebucht von: {user_name}
 LOCATION:Dienstort
-ORGANIZER:mailto:noreply@dienstplan-cloud.local
-ATTENDEE;PARTSTAT=ACCEPTED:mailto:{user_email}
-STATUS:{"CONFIRMED" if action == "REQUEST" else "CANCELLED"}
-SEQUENCE:0
-CREATED:{datetime.now(TZ).strftime('%Y%m%dT%H%M%SZ')}
-LAST-MODIFIED:{datetime.now(TZ).strftime('%Y%m%dT%H%M%SZ')}
-END:VEVENT
+ORGANIZER:mailto:noreply@dienstplan-cloud.local{attendee}
+STATUS:{status}
+SEQUENCE:{sequence}
+LAST-MODIFIED:{stamp}
+END:VEVENT"""
+
+def generate_ics(slot, booking_date, user_name, user_email, action="REQUEST", sequence=0):
+    """Generiert iCal-Einladung für Schichtbuchung"""
+    event = _ics_event(slot, booking_date, user_name, user_email,
+                       "CONFIRMED" if action == "REQUEST" else "CANCELLED", sequence)
+    ics_content = f"""BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//Dienstplan+ Cloud//DE
+METHOD:{action}
+{event}
 END:VCALENDAR"""
     
     return ics_content.encode('utf-8')
 
+def generate_ics_feed(events, name):
+    """Kalender mit mehreren Terminen (METHOD:PUBLISH) aus (slot, datum, name, email, sequence, geändert)"""
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//Dienstplan+ Cloud//DE", "METHOD:PUBLISH",
+             f"X-WR-CALNAME:{name}", f"X-WR-TIMEZONE:{TIMEZONE_STR}", "REFRESH-INTERVAL;VALUE=DURATION:PT15M"]
+    for slot, booking_date, user_name, user_email, sequence, modified in events:
+        lines.append(_ics_event(slot, booking_date, user_name, user_email, "CONFIRMED", sequence, modified))
+    lines.append("END:VCALENDAR")
+    return "\r\n".join("\n".join(lines).split("\n")).encode("utf-8") + b"\r\n"
+
+# ===== Slot-Registry =====
+class Slot:
+    """Unveränderlicher Wochen-Slot mit vorab geparsten Zeiten und Wochentag-Offset"""
+    __slots__ = ("id", "day", "day_name", "start", "end", "weekday", "start_time", "end_time")
+
+    def __init__(self, id, day, day_name, start, end):
+        if day not in WEEKDAY_INDEX:
+            raise ValueError(f"Unbekannter Wochentag: {day}")
+        start_time = datetime.strptime(start, "%H:%M").time()
+        end_time = datetime.strptime(end, "%H:%M").time()
+        if end_time <= start_time:
+            raise ValueError(f"Slot {id}: Ende muss nach Beginn liegen")
+        for k, v in (("id", int(id)), ("day", day), ("day_name", day_name), ("start", start),
+                     ("end", end), ("weekday", WEEKDAY_INDEX[day]),
+                     ("start_time", start_time), ("end_time", end_time)):
+            object.__setattr__(self, k, v)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Slot ist unveränderlich")
+
+    def __reduce__(self):
+        # copy/pickle (z.B. Widget-Optionen) über den Konstruktor statt setattr
+        return (Slot, (self.id, self.day, self.day_name, self.start, self.end))
+
+    def __repr__(self):
+        return f"Slot({self.id}, {self.day}, {self.start}-{self.end})"
+
+    @property
+    def time_range(self):
+        return f"{self.start}-{self.end}"
+
+    @property
+    def label(self):
+        return f"{self.day_name} {self.start}-{self.end}"
+
+    def date_in_week(self, ws):
+        return (ws + timedelta(days=self.weekday)).strftime("%Y-%m-%d")
+
+    def to_dict(self):
+        return {"id": self.id, "day": self.day, "day_name": self.day_name,
+                "start": self.start, "end": self.end}
+
+class SlotRegistry:
+    """Unveränderliche Slot-Menge mit O(1)-Zugriff über ID und Wochentag"""
+    __slots__ = ("slots", "by_id", "by_weekday")
+
+    def __init__(self, defs):
+        slots = tuple(sorted((Slot(**d) for d in defs), key=lambda s: (s.weekday, s.start_time, s.id)))
+        by_id = {s.id: s for s in slots}
+        if len(by_id) != len(slots):
+            raise ValueError("Slot-IDs müssen eindeutig sein")
+        self.slots = slots
+        self.by_id = by_id
+        self.by_weekday = {wd: tuple(s for s in slots if s.weekday == wd) for wd in range(7)}
+
+    def __iter__(self):
+        return iter(self.slots)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def get(self, slot_id):
+        return self.by_id.get(slot_id)
+
+    def for_weekday(self, weekday):
+        return self.by_weekday[weekday]
+
+class SlotConfig:
+    """Prozessweiter Halter der aktiven Registry (app_settings 'weekly_slots', Fallback WEEKLY_SLOTS)"""
+
+    def __init__(self):
+        self.raw = None
+        self.registry = SlotRegistry(WEEKLY_SLOTS)
+
+    def load(self, raw):
+        if not raw:
+            if self.raw is not None:  # Einstellung entfernt (z.B. Restore ohne Slots): Standard
+                self.registry, self.raw = SlotRegistry(WEEKLY_SLOTS), None
+            return
+        if raw == self.raw: return
+        try:
+            self.registry = SlotRegistry(json.loads(raw))
+            self.raw = raw
+        except (ValueError, TypeError, KeyError):
+            pass  # Ungültige Konfiguration: bisherige Registry behalten
+
+@st.cache_resource(show_spinner=False)
+def _slot_config():
+    return SlotConfig()
+
+SLOT_CONFIG = _slot_config()
+
+def active_slots():
+    """Aktuell gültige Slot-Registry"""
+    return SLOT_CONFIG.registry
+
+def series_dates(slot, start, until, every_weeks=1):
+    """Serientermine eines Slots: jeder n-te passende Wochentag zwischen start und until"""
+    first = start + timedelta(days=(slot.weekday - start.weekday()) % 7)
+    step = timedelta(weeks=max(int(every_weeks), 1))
+    out, d = [], first
+    while d <= until:
+        out.append((slot.id, d.strftime("%Y-%m-%d")))
+        d += step
+    return out
+
 # ===== CSS für kontrastreiches Design =====
 def inject_css():
     st.markdown("""
@@ -256,18 +476,533 @@ def inject_css():
     </style>
     """, unsafe_allow_html=True)
 
+# ===== Query-Instrumentierung (optional) =====
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, float("inf"))
+
+class QueryStats:
+    """Prozessweite Statistik über DB-Methoden und SQL-Statements"""
+
+    def __init__(self, enabled=False, slow_ms=50.0):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.methods = {}
+            self.statements = {}
+            self.slow = deque(maxlen=100)
+            self.since = datetime.now()
+
+    @staticmethod
+    def _new_entry():
+        return {"calls": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0,
+                "buckets": [0] * len(LATENCY_BUCKETS_MS)}
+
+    @staticmethod
+    def _add(entry, ms):
+        entry["calls"] += 1
+        entry["total_ms"] += ms
+        entry["max_ms"] = max(entry["max_ms"], ms)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= bound:
+                entry["buckets"][i] += 1
+                break
+
+    def count_statement(self, stmt):
+        """Trace-Callback: zählt SQL-Statements des aktuellen Threads (UI-Profiler)"""
+        if stmt.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")):
+            self.local.sql_count = getattr(self.local, "sql_count", 0) + 1
+
+    def current_method(self):
+        stack = getattr(self.local, "stack", None)
+        return stack[-1] if stack else "-"
+
+    def enter(self, name):
+        if not hasattr(self.local, "stack"): self.local.stack = []
+        self.local.stack.append(name)
+
+    def leave(self, name, ms):
+        self.local.stack.pop()
+        with self.lock:
+            self._add(self.methods.setdefault(name, self._new_entry()), ms)
+
+    def record_sql(self, sql, ms, rows, explain=None):
+        key = " ".join(sql.split())
+        method = self.current_method()
+        with self.lock:
+            entry = self.statements.setdefault(key, dict(self._new_entry(), method=method))
+            self._add(entry, ms)
+            entry["rows"] += rows
+            if method != "-":
+                self.methods.setdefault(method, self._new_entry())["rows"] += rows
+        if ms >= self.slow_ms:
+            plan = explain() if explain else ""
+            with self.lock:
+                self.slow.append({"timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                  "method": method, "ms": round(ms, 2), "sql": key, "plan": plan})
+
+    def add_rows(self, sql, rows):
+        key = " ".join(sql.split())
+        method = self.current_method()
+        with self.lock:
+            if key in self.statements: self.statements[key]["rows"] += rows
+            if method != "-": self.methods.setdefault(method, self._new_entry())["rows"] += rows
+
+    @staticmethod
+    def quantile(buckets, q):
+        """Näherungsweises Quantil aus dem Latenz-Histogramm (Obergrenze des Buckets)"""
+        total = sum(buckets)
+        if not total: return 0.0
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS_MS, buckets):
+            seen += n
+            if seen >= q * total: return bound
+        return LATENCY_BUCKETS_MS[-1]
+
+    def _rows(self, entries, label):
+        out = []
+        for name, e in entries.items():
+            row = {label: name, "calls": e["calls"], "total_ms": round(e["total_ms"], 2),
+                   "avg_ms": round(e["total_ms"] / e["calls"], 2) if e["calls"] else 0.0,
+                   "p95_ms": self.quantile(e["buckets"], 0.95), "max_ms": round(e["max_ms"], 2),
+                   "rows": e["rows"]}
+            if "method" in e: row["method"] = e["method"]
+            out.append(row)
+        return sorted(out, key=lambda r: r["total_ms"], reverse=True)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "since": self.since.isoformat(),
+                "created_at": datetime.now().isoformat(),
+                "slow_query_ms": self.slow_ms,
+                "buckets_ms": [str(b) for b in LATENCY_BUCKETS_MS],
+                "methods": self._rows(self.methods, "method"),
+                "statements": self._rows(self.statements, "sql"),
+                "histograms": {n: list(e["buckets"]) for n, e in self.methods.items()},
+                "slow_queries": list(self.slow),
+            }
+
+@st.cache_resource(show_spinner=False)
+def _query_stats():
+    return QueryStats(enabled=ENABLE_DB_PROFILING, slow_ms=SLOW_QUERY_MS)
+
+QUERY_STATS = _query_stats()
+
+class _ProfiledCursor(sqlite3.Cursor):
+    """Cursor, der Laufzeit und Zeilen jedes Statements an QUERY_STATS meldet"""
+
+    def _explain(self, sql, params):
+        if not sql.lstrip().upper().startswith(("SELECT", "WITH", "UPDATE", "DELETE", "INSERT")):
+            return ""
+        try:
+            cur = sqlite3.Cursor(self.connection)
+            cur.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            return "\n".join(r[-1] for r in cur.fetchall())
+        except sqlite3.Error as e:
+            return f"EXPLAIN fehlgeschlagen: {e}"
+
+    def execute(self, sql, params=()):
+        t0 = time.perf_counter()
+        super().execute(sql, params)
+        ms = (time.perf_counter() - t0) * 1000
+        self._sql = sql
+        rows = self.rowcount if self.rowcount > 0 else 0
+        QUERY_STATS.record_sql(sql, ms, rows, lambda: self._explain(sql, params))
+        return self
+
+    def executemany(self, sql, seq):
+        t0 = time.perf_counter()
+        super().executemany(sql, seq)
+        self._sql = sql
+        QUERY_STATS.record_sql(sql, (time.perf_counter() - t0) * 1000, max(self.rowcount, 0))
+        return self
+
+    def fetchone(self):
+        r = super().fetchone()
+        if r is not None: QUERY_STATS.add_rows(self._sql, 1)
+        return r
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(size or self.arraysize)
+        QUERY_STATS.add_rows(self._sql, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        QUERY_STATS.add_rows(self._sql, len(rows))
+        return rows
+
+class _ProfiledConnection(sqlite3.Connection):
+    def cursor(self, factory=_ProfiledCursor):
+        return super().cursor(factory)
+
+def _profiled_method(name, fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        stats = QUERY_STATS
+        if not stats.enabled and not METRICS.enabled:
+            return fn(*args, **kwargs)
+        if stats.enabled: stats.enter(name)
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - t0
+            if stats.enabled: stats.leave(name, elapsed * 1000)
+            METRICS.observe("dienstplan_db_method_seconds", elapsed, method=name)
+    return wrapper
+
+def profile_db_methods(cls):
+    """Klassen-Dekorator: misst alle öffentlichen Methoden, wenn QUERY_STATS oder METRICS aktiv ist"""
+    for name, fn in list(vars(cls).items()):
+        if callable(fn) and not name.startswith("_") and name != "conn":
+            setattr(cls, name, _profiled_method(name, fn))
+    return cls
+
+# ===== Metriken (Prometheus-Textformat) =====
+# name -> (typ, hilfe, buckets in Sekunden)
+METRIC_DEFS = {
+    "dienstplan_booking_events_total": ("counter", "Buchungsereignisse nach Art (booked, cancelled, rebooked)", None),
+    "dienstplan_db_method_seconds": ("histogram", "Laufzeit der DB-Methoden",
+                                     (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)),
+    "dienstplan_notification_seconds": ("histogram", "Versanddauer pro Kanal", (.1, .25, .5, 1, 2.5, 5, 10, 30)),
+    "dienstplan_notifications_total": ("counter", "Versandversuche pro Kanal und Ergebnis", None),
+    "dienstplan_reminder_lag_seconds": ("histogram", "Verspätung der Reminder gegenüber der Fälligkeit",
+                                        (.1, 1, 5, 15, 60, 300, 900)),
+    "dienstplan_reminders_pending": ("gauge", "Geplante Reminder in der Warteschlange", None),
+    "dienstplan_job_seconds": ("histogram", "Laufzeit der Scheduler-Jobs", (.1, .5, 1, 5, 15, 60, 300)),
+    "dienstplan_job_failures_total": ("counter", "Fehlgeschlagene Scheduler-Jobs", None),
+    "dienstplan_job_last_success_timestamp_seconds": ("gauge", "Zeitpunkt des letzten erfolgreichen Laufs", None),
+    "dienstplan_export_seconds": ("histogram", "Erzeugungsdauer der Export-Artefakte (Backup, CSV)",
+                                  (.1, .5, 1, 5, 15, 60, 300)),
+    "dienstplan_export_bytes": ("gauge", "Größe des zuletzt erzeugten Export-Artefakts", None),
+    "dienstplan_active_sessions": ("gauge", "Sitzungen mit Rerun in den letzten 5 Minuten", None),
+    "dienstplan_db_pages": ("gauge", "Seiten der Datenbankdatei nach der letzten Wartung", None),
+    "dienstplan_db_freelist_pages": ("gauge", "Freie Seiten nach der letzten Wartung", None),
+}
+
+class Metrics:
+    """Prozessweite Zähler, Gauges und Histogramme, reine In-Memory-Strukturen.
+
+    Schreiben kostet ein Lock und eine Dict-Operation; bei ENABLE_METRICS=false
+    kehren alle Methoden sofort zurück. Gauges, die erst beim Abruf bekannt sind
+    (Warteschlange, Sitzungen), werden über Callbacks geliefert.
+    """
+
+    SESSION_WINDOW = 300
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.values = {}     # (name, labels) -> float
+        self.hists = {}      # (name, labels) -> [bucket_counts, sum, count]
+        self.callbacks = {}  # name -> fn() -> {labels: value}
+        self.sessions = {}   # session_id -> letzter Rerun
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1.0, **labels):
+        if not self.enabled: return
+        key = self._key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + value
+
+    def set(self, name, value, **labels):
+        if not self.enabled: return
+        with self.lock:
+            self.values[self._key(name, labels)] = float(value)
+
+    def observe(self, name, value, **labels):
+        if not self.enabled: return
+        buckets = METRIC_DEFS[name][2]
+        key = self._key(name, labels)
+        with self.lock:
+            entry = self.hists.get(key)
+            if entry is None:
+                entry = self.hists[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def notification(self, channel, started, result):
+        """Versanddauer und Ergebnis (ok, error, circuit_open) eines Mail-/SMS-Versands"""
+        self.observe("dienstplan_notification_seconds", time.perf_counter() - started, channel=channel)
+        self.inc("dienstplan_notifications_total", channel=channel, result=result)
+
+    def touch_session(self, session_id):
+        if not self.enabled or not session_id: return
+        with self.lock:
+            self.sessions[session_id] = time.time()
+
+    def _active_sessions(self):
+        cutoff = time.time() - self.SESSION_WINDOW
+        with self.lock:
+            self.sessions = {sid: t for sid, t in self.sessions.items() if t >= cutoff}
+            return {(): len(self.sessions)}
+
+    def callback(self, name, fn):
+        self.callbacks[name] = fn
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items: return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+    def render(self):
+        """Alle Metriken im Prometheus-Textformat (Version 0.0.4)"""
+        with self.lock:
+            values = dict(self.values)
+            hists = {k: (list(v[0]), v[1], v[2]) for k, v in self.hists.items()}
+        for name, fn in list(self.callbacks.items()) + [("dienstplan_active_sessions", self._active_sessions)]:
+            try:
+                for labels, value in fn().items():
+                    values[(name, tuple(labels))] = float(value)
+            except Exception:
+                pass  # Callback-Fehler sollen den Scrape nicht abbrechen
+        
+        lines = []
+        for name, (kind, help_text, buckets) in METRIC_DEFS.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            if kind == "histogram":
+                for (n, labels), (counts, total, count) in sorted(hists.items()):
+                    if n != name: continue
+                    cumulative = 0
+                    for bound, c in zip(buckets, counts):
+                        cumulative += c
+                        lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {total:.6f}")
+                    lines.append(f"{name}_count{self._labels(labels)} {count}")
+            else:
+                for (n, labels), value in sorted(values.items()):
+                    if n == name: lines.append(f"{name}{self._labels(labels)} {value:.17g}")
+        return "\n".join(lines) + "\n"
+
+    def wsgi_app(self, environ, start_response):
+        if environ.get("PATH_INFO", "/") not in ("/", "/metrics"):
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return [b"not found\n"]
+        body = self.render().encode("utf-8")
+        start_response("200 OK", [("Content-Type", "text/plain; version=0.0.4; charset=utf-8"),
+                                  ("Content-Length", str(len(body)))])
+        return [body]
+
+@st.cache_resource(show_spinner=False)
+def _metrics():
+    return Metrics(enabled=ENABLE_METRICS)
+
+METRICS = _metrics()
+
+def timed_job(name, fn):
+    """Scheduler-Job mit Laufzeit-, Fehler- und Letzter-Erfolg-Metriken.
+
+    Als Fehlschlag zählt neben einer Exception auch ein Ergebnis ``False`` bzw.
+    ``(False, ...)`` (Konvention der DB-/Versand-Methoden); leere Ergebnisse wie
+    0 gelöschte Zeilen sind ein Erfolg.
+    """
+    @functools.wraps(fn)
+    def job(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            METRICS.inc("dienstplan_job_failures_total", job=name)
+            raise
+        finally:
+            METRICS.observe("dienstplan_job_seconds", time.perf_counter() - t0, job=name)
+        if result is False or (isinstance(result, tuple) and result and result[0] is False):
+            METRICS.inc("dienstplan_job_failures_total", job=name)
+            return result
+        METRICS.set("dienstplan_job_last_success_timestamp_seconds", time.time(), job=name)
+        return result
+    return job
+
+# ===== Auth-Service (KDF im Worker-Pool) =====
+def hash_password(pw, iterations=None):
+    """PBKDF2-SHA256 mit zufälligem Salt, Format pbkdf2_sha256$iter$salt$hash"""
+    iterations = iterations or PBKDF2_ITERATIONS
+    salt = os.urandom(16)
+    dk = hashlib.pbkdf2_hmac("sha256", pw.encode(), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${salt.hex()}${dk.hex()}"
+
+def verify_password(pw, stored):
+    """Prüft Passwort gegen gespeicherten Hash; liefert (ok, rehash_nötig)"""
+    if not stored: return False, False
+    if stored.startswith("pbkdf2_sha256$"):
+        try:
+            _, iterations, salt, dk = stored.split("$")
+            calc = hashlib.pbkdf2_hmac("sha256", pw.encode(), bytes.fromhex(salt), int(iterations))
+        except ValueError:
+            return False, False
+        ok = hmac.compare_digest(calc.hex(), dk)
+        return ok, ok and int(iterations) < PBKDF2_ITERATIONS
+    # Alt-Format: ungesalzenes SHA-256 -> nach erfolgreichem Login migrieren
+    ok = hmac.compare_digest(hashlib.sha256(pw.encode()).hexdigest(), stored)
+    return ok, ok
+
+class AuthService:
+    """Begrenzter Worker-Pool für KDF-Operationen und kurzlebiger Session-Token-Cache"""
+
+    BUSY = "Server ausgelastet - bitte in einigen Sekunden erneut versuchen"
+
+    def __init__(self, workers=4, max_pending=32, token_ttl_minutes=480):
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="auth-kdf")
+        self.pending = threading.BoundedSemaphore(max_pending)
+        # Unbekannte/inaktive E-Mails prüfen gegen diesen Hash, damit die Antwortzeit nichts verrät
+        self.dummy_hash = hash_password(secrets.token_hex(16))
+        self.token_ttl = timedelta(minutes=token_ttl_minutes)
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def _run(self, fn, *args, timeout=AUTH_TIMEOUT_SECONDS):
+        # Mehr als max_pending gleichzeitige Anfragen werden abgewiesen statt zu stauen
+        if not self.pending.acquire(timeout=timeout):
+            raise TimeoutError(self.BUSY)
+        try:
+            return self.pool.submit(fn, *args).result(timeout=timeout)
+        finally:
+            self.pending.release()
+
+    def hash(self, pw):
+        return self._run(hash_password, pw)
+
+    def hash_many(self, passwords):
+        """Hasht mehrere Passwörter parallel im Pool (z.B. für Massenimport).
+
+        Jeder Hash belegt wie eine Einzelanfrage einen Platz im Semaphor, und höchstens
+        die Hälfte der Worker ist gleichzeitig belegt, damit Anmeldungen durchkommen.
+        """
+        window = max(1, self.workers // 2)
+        inflight, results = deque(), []
+        for pw in passwords:
+            if len(inflight) >= window:
+                results.append(inflight.popleft().result())
+            if not self.pending.acquire(timeout=AUTH_TIMEOUT_SECONDS):
+                raise TimeoutError(self.BUSY)
+            future = self.pool.submit(hash_password, pw)
+            future.add_done_callback(lambda _: self.pending.release())
+            inflight.append(future)
+        results.extend(f.result() for f in inflight)
+        return results
+
+    def verify(self, pw, stored):
+        return self._run(verify_password, pw, stored)
+
+    def issue_token(self, uid):
+        token = secrets.token_urlsafe(32)
+        with self.lock:
+            self._purge()
+            self.tokens[token] = [uid, datetime.now() + self.token_ttl]
+        return token
+
+    def resolve_token(self, token):
+        """Liefert die User-ID zu einem gültigen Token (gleitende Ablaufzeit) oder None"""
+        if not token: return None
+        with self.lock:
+            entry = self.tokens.get(token)
+            if not entry: return None
+            if entry[1] < datetime.now():
+                del self.tokens[token]
+                return None
+            entry[1] = datetime.now() + self.token_ttl
+            return entry[0]
+
+    def revoke(self, token):
+        with self.lock:
+            self.tokens.pop(token, None)
+
+    def revoke_user(self, uid, keep=None):
+        """Entwertet alle Tokens eines Nutzers (z.B. nach Passwortänderung)"""
+        with self.lock:
+            for t in [t for t, e in self.tokens.items() if e[0] == uid and t != keep]:
+                del self.tokens[t]
+
+    def _purge(self):
+        now = datetime.now()
+        for t in [t for t, e in self.tokens.items() if e[1] < now]:
+            del self.tokens[t]
+
+@st.cache_resource(show_spinner=False)
+def _auth_service():
+    return AuthService(workers=AUTH_WORKERS, max_pending=AUTH_MAX_PENDING,
+                       token_ttl_minutes=AUTH_TOKEN_TTL_MINUTES)
+
+AUTH = _auth_service()
+
+# ===== Datensätze =====
+class Record:
+    """Mapping-Zugriff für namedtuple-Datensätze aus dem DB-Layer.
+
+    Die Datensätze sind Tupel mit __slots__ = () (kein Instanz-Dict). Neben
+    Attributzugriff (b.user_name) bleibt der bisherige Dict-Zugriff erhalten:
+    b["user_name"], b.get(...), "id" in b, dict(b), dict(b, day=...).
+    pd.DataFrame(liste) übernimmt die Felder als Spalten.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        return default if i is None else tuple.__getitem__(self, i)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def keys(self):
+        return self._fields
+
+    def items(self):
+        return zip(self._fields, self)
+
+def record_type(name, fields):
+    """Erzeugt einen Datensatztyp (namedtuple + Record) mit den angegebenen Feldern"""
+    base = namedtuple(name, fields)
+    return type(name, (Record, base), {"__slots__": (), "_index": {f: i for i, f in enumerate(base._fields)}})
+
+BookingRow = record_type("BookingRow", "id user_id user_name user_email user_phone created_at")
+UserBookingRow = record_type("UserBookingRow", "id slot_id date created_at")
+UserRow = record_type("UserRow", "id email phone name role active created_at")
+AuditRow = record_type("AuditRow", "timestamp user action details")
+UserStatsRow = record_type("UserStatsRow", "name email total_bookings last_booking")
+
 # ===== Datenbank-Layer (erweitert) =====
+@profile_db_methods
 class DB:
     def __init__(self, path=DB_FILE):
         self.path = path
         self._init()
 
     def conn(self):
-        return sqlite3.connect(self.path, check_same_thread=False)
+        if QUERY_STATS.enabled:
+            c = sqlite3.connect(self.path, check_same_thread=False, factory=_ProfiledConnection)
+        else:
+            c = sqlite3.connect(self.path, check_same_thread=False)
+        c.execute("PRAGMA foreign_keys=ON")
+        if getattr(QUERY_STATS.local, "trace_sql", False):
+            c.set_trace_callback(QUERY_STATS.count_statement)
+        return c
 
     def _init(self):
         with self.conn() as c:
             cur = c.cursor()
+            # Wirkt nur auf eine leere Datei; Bestände stellt run_maintenance einmalig per VACUUM um
+            cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
             cur.execute("""CREATE TABLE IF NOT EXISTS app_settings(
                 key TEXT PRIMARY KEY, value TEXT, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
             cur.execute("""CREATE TABLE IF NOT EXISTS users(
@@ -276,12 +1011,7 @@ class DB:
                 password_hash TEXT NOT NULL, role TEXT DEFAULT 'user',
                 sms_opt_in BOOLEAN DEFAULT 1, email_opt_in BOOLEAN DEFAULT 1,
                 active BOOLEAN DEFAULT 1, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
-            cur.execute("""CREATE TABLE IF NOT EXISTS bookings(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL, slot_id INTEGER NOT NULL,
-                booking_date DATE NOT NULL, status TEXT DEFAULT 'confirmed',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(slot_id, booking_date))""")
+            cur.execute(FK_SCHEMA["bookings"].format(name="bookings"))
             cur.execute("""CREATE TABLE IF NOT EXISTS audit_log(
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER, action TEXT NOT NULL, details TEXT,
@@ -290,13 +1020,41 @@ class DB:
                 id INTEGER PRIMARY KEY AUTOINCREMENT, page_key TEXT UNIQUE NOT NULL,
                 title TEXT NOT NULL, content TEXT, last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_by INTEGER)""")
-            cur.execute("""CREATE TABLE IF NOT EXISTS reminder_log(
-                id INTEGER PRIMARY KEY AUTOINCREMENT, booking_id INTEGER NOT NULL,
-                reminder_type TEXT NOT NULL, sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                status TEXT DEFAULT 'sent', UNIQUE(booking_id, reminder_type))""")
+            cur.execute(FK_SCHEMA["reminder_log"].format(name="reminder_log"))
+            cur.execute("""CREATE TABLE IF NOT EXISTS change_feed(
+                seq INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL,
+                booking_id INTEGER, slot_id INTEGER, booking_date DATE, user_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+            cur.execute(FK_SCHEMA["user_availability"].format(name="user_availability"))
+            cur.execute("""CREATE TABLE IF NOT EXISTS admin_digest_queue(
+                id INTEGER PRIMARY KEY AUTOINCREMENT, subject TEXT NOT NULL, message TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, sent_at TIMESTAMP)""")
+            c.commit()
+            # Altbestände ohne Fremdschlüssel umbauen (vor Indizes/Triggern, die beim Umbau verloren gehen)
+            self._migrate_foreign_keys()
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_bookings_user ON bookings(user_id)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_change_feed_slot_date ON change_feed(slot_id, booking_date)")
+            cur.execute("DROP INDEX IF EXISTS idx_change_feed_user")  # ersetzt durch (user_id, seq)
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_change_feed_user_seq ON change_feed(user_id, seq)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_change_feed_booking ON change_feed(booking_id, seq)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_change_feed_reset ON change_feed(seq) WHERE kind='reset'")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_users_name ON users(name COLLATE NOCASE, id)")
+            # Datenstand pro Tabelle (für Export-Caches), per Trigger hochgezählt
+            cur.execute("""CREATE TABLE IF NOT EXISTS table_versions(
+                name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)""")
+            for table in BACKUP_TABLES:
+                cur.execute("INSERT OR IGNORE INTO table_versions(name) VALUES(?)", (table,))
+                for op in ("INSERT", "UPDATE", "DELETE"):
+                    cur.execute(f"""CREATE TRIGGER IF NOT EXISTS tv_{table}_{op.lower()} AFTER {op} ON {table}
+                                    BEGIN UPDATE table_versions SET version=version+1 WHERE name='{table}'; END""")
             c.commit()
+        self._migrate_booking_times()
+        self._init_user_search()
+        self._init_text_search()
         self._seed_admin()
         self._ensure_default_templates()
+        SLOT_CONFIG.load(self.get_setting("weekly_slots", ""))
+        self.fill_start_epochs()
 
     def _seed_admin(self):
         if not hasattr(st, "secrets"): return
@@ -305,12 +1063,18 @@ class DB:
         with self.conn() as c:
             cur = c.cursor()
             cur.execute("SELECT COUNT(*) FROM users WHERE email=?", (email,))
-            if cur.fetchone()[0] == 0:
-                cur.execute("""INSERT INTO users(email,phone,name,password_hash,role)
-                               VALUES(?,?,?,?,?)""",
-                            (email, "+4915199999999", "Initial Admin",
-                             hashlib.sha256(pw.encode()).hexdigest(), "admin"))
-                c.commit()
+            if cur.fetchone()[0]: return
+        try:
+            pw_hash = AUTH.hash(pw)
+        except TimeoutError:
+            # Auth-Pool ausgelastet: die nächste Sitzung legt den Admin an
+            logger.warning("Initial-Admin nicht angelegt: %s", AUTH.BUSY)
+            return
+        with self.conn() as c:
+            c.execute("""INSERT INTO users(email,phone,name,password_hash,role) VALUES(?,?,?,?,?)
+                         ON CONFLICT(email) DO NOTHING""",
+                      (email, "+4915199999999", "Initial Admin", pw_hash, "admin"))
+            c.commit()
 
     def _ensure_default_templates(self):
         defaults = {
@@ -319,6 +1083,7 @@ class DB:
             "admin_cancellation_notification": "{USER} hat die Schicht am {DATUM} storniert.",
             "admin_rebooking_notification": "Schicht am {DATUM} wurde von {OLD_USER} auf {NEW_USER} umgebucht.",
             "rebooking_confirmation": "Hallo {USER},\\n\\nSie wurden für die Schicht am {DATUM} von {ZEIT} eingeteilt.\\n\\nBeste Grüße\\nIhr Dienstplan-Team",
+            "series_booking_confirmation": "Hallo {USER},\\n\\nfolgende {ANZAHL} Schichten wurden für Sie gebucht:\\n{TERMINE}\\n\\nBeste Grüße\\nIhr Dienstplan-Team",
             "reminder_24h": "Erinnerung: Morgen haben Sie Schicht von {ZEIT}. Schicht: {SCHICHT}",
             "reminder_1h": "Erinnerung: In einer Stunde beginnt Ihre Schicht ({ZEIT}). Schicht: {SCHICHT}",
             "handbuch_page_1": "# Schicht-Checkliste\\n\\n## Vor Schichtbeginn:\\n1. **Kasse holen** - Schlüssel im Büro\\n2. **Technik prüfen** - Licht, Heizung, Filter\\n3. **Sicherheitsrundgang**\\n\\n## Während der Schicht:\\n- Badeaufsicht\\n- Kassendienst\\n- Reinigung",
@@ -349,25 +1114,519 @@ class DB:
                         (key, value))
             c.commit()
 
+    def save_weekly_slots(self, defs):
+        """Validiert und speichert die Slot-Konfiguration (app_settings 'weekly_slots')"""
+        try:
+            registry = SlotRegistry(defs)
+        except (ValueError, TypeError, KeyError) as e:
+            return False, f"Ungültige Slot-Konfiguration: {e}"
+        current = active_slots()
+        # Entfernte Slots oder geänderte Wochentage würden bestehende Buchungen verschieben
+        changed = [s.id for s in current if s.id not in registry.by_id or registry.get(s.id).weekday != s.weekday]
+        if changed:
+            with self.conn() as c:
+                cur = c.cursor()
+                cur.execute(f"""SELECT DISTINCT slot_id FROM bookings
+                               WHERE slot_id IN ({",".join("?" * len(changed))})
+                               AND booking_date >= ? AND status='confirmed'""",
+                            (*changed, date.today().strftime("%Y-%m-%d")))
+                blocked = [r[0] for r in cur.fetchall()]
+            if blocked:
+                return False, f"Slot(s) {', '.join(map(str, blocked))} haben noch zukünftige Buchungen"
+        raw = json.dumps([s.to_dict() for s in registry], ensure_ascii=False)
+        # Geänderte Startzeiten: start_epoch zukünftiger Buchungen in derselben Transaktion nachziehen
+        retimed = [s.id for s in registry if current.get(s.id) and current.get(s.id).start_time != s.start_time]
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute("""INSERT INTO app_settings(key,value) VALUES('weekly_slots',?)
+                           ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=CURRENT_TIMESTAMP""",
+                        (raw,))
+            self._retime_bookings(cur, registry, retimed)
+            c.commit()
+        SLOT_CONFIG.load(raw)
+        REMINDERS.rebuild()  # Fälligkeiten hängen an den Startzeiten
+        return True, "Schichtzeiten gespeichert"
+
+    @staticmethod
+    def _retime_bookings(cur, registry, slot_ids):
+        """Setzt start_epoch zukünftiger Buchungen der Slots slot_ids neu (Startzeit geändert)"""
+        if not slot_ids: return
+        cur.execute(f"""SELECT DISTINCT slot_id, booking_date FROM bookings
+                       WHERE slot_id IN ({",".join("?" * len(slot_ids))}) AND booking_date >= ?""",
+                    (*slot_ids, date.today().strftime("%Y-%m-%d")))
+        cur.executemany("UPDATE bookings SET start_epoch=? WHERE slot_id=? AND booking_date=?",
+                        [(shift_start_epoch(registry.get(sid), d), sid, d) for sid, d in cur.fetchall()])
+
     def create_user(self, email, phone, name, pw):
+        """Legt einen Nutzer an; liefert (True, nutzer) wie auth() oder (False, fehlertext)"""
+        try:
+            pw_hash = AUTH.hash(pw)
+        except TimeoutError:
+            return False, AUTH.BUSY
         try:
             with self.conn() as c:
                 cur = c.cursor()
                 cur.execute("INSERT INTO users(email,phone,name,password_hash) VALUES(?,?,?,?)",
-                            (email,phone,name,hashlib.sha256(pw.encode()).hexdigest()))
+                            (email,phone,name,pw_hash))
                 c.commit()
-                return True, cur.lastrowid
+                return True, dict(id=cur.lastrowid, email=email, phone=phone, name=name, role="user",
+                                  sms_opt_in=True, email_opt_in=True)
         except sqlite3.IntegrityError:
             return False, "E-Mail bereits registriert"
 
+    def _init_user_search(self):
+        """FTS5-Trigramm-Index über Name und E-Mail (Teilstring-Suche), per Trigger synchron"""
+        try:
+            with self.conn() as c:
+                cur = c.cursor()
+                cur.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+                    name, email, content='users', content_rowid='id', tokenize='trigram')""")
+                cur.execute("""CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN
+                    INSERT INTO users_fts(rowid,name,email) VALUES(new.id,new.name,new.email); END""")
+                cur.execute("""CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN
+                    INSERT INTO users_fts(users_fts,rowid,name,email) VALUES('delete',old.id,old.name,old.email); END""")
+                cur.execute("""CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF name,email ON users BEGIN
+                    INSERT INTO users_fts(users_fts,rowid,name,email) VALUES('delete',old.id,old.name,old.email);
+                    INSERT INTO users_fts(rowid,name,email) VALUES(new.id,new.name,new.email); END""")
+                cur.execute("SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM users_fts_docsize)")
+                n_users, n_fts = cur.fetchone()
+                if n_users != n_fts:
+                    cur.execute("INSERT INTO users_fts(users_fts) VALUES('rebuild')")
+                c.commit()
+            self.user_fts = True
+        except sqlite3.OperationalError:
+            self.user_fts = False  # SQLite ohne FTS5/Trigramm: Suche per LIKE
+
+    def _migrate_foreign_keys(self):
+        """Baut Tabellen ohne Fremdschlüssel nach FK_SCHEMA um (SQLite kennt kein ADD CONSTRAINT).
+
+        Vorher werden verwaiste Zeilen entfernt; der Umbau läuft in einer Transaktion
+        mit abgeschalteten Fremdschlüsseln und wird per foreign_key_check geprüft.
+        """
+        with self.conn() as c:
+            cur = c.cursor()
+            todo = [t for t in FK_SCHEMA if not cur.execute(f"PRAGMA foreign_key_list({t})").fetchall()]
+        if not todo: return
+        self.sweep_orphans()
+        
+        c = self.conn()
+        try:
+            c.execute("PRAGMA foreign_keys=OFF")
+            cur = c.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            for table in todo:
+                new = f"{table}_fk_new"
+                cur.execute(f"DROP TABLE IF EXISTS {new}")
+                cur.execute(FK_SCHEMA[table].format(name=new))
+                cols = [col for col in self._table_columns(cur, new) if col in set(self._table_columns(cur, table))]
+                cur.execute(f"INSERT INTO {new}({','.join(cols)}) SELECT {','.join(cols)} FROM {table}")
+                # AUTOINCREMENT-Stand übernehmen, sonst würden IDs gelöschter Zeilen neu vergeben
+                seq = cur.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,)).fetchone()
+                cur.execute(f"DROP TABLE {table}")
+                cur.execute(f"ALTER TABLE {new} RENAME TO {table}")
+                if seq:
+                    cur.execute("UPDATE sqlite_sequence SET seq=MAX(seq, ?) WHERE name=?", (seq[0], table))
+                    if not cur.rowcount:
+                        cur.execute("INSERT INTO sqlite_sequence(name, seq) VALUES(?, ?)", (table, seq[0]))
+            violations = cur.execute("PRAGMA foreign_key_check").fetchall()
+            if violations:
+                raise sqlite3.IntegrityError(f"Fremdschlüssel verletzt: {violations[:5]}")
+            c.commit()
+        except Exception:
+            c.rollback()
+            raise
+        finally:
+            c.close()
+
+    def sweep_orphans(self, chunk=ORPHAN_SWEEP_CHUNK):
+        """Entfernt verwaiste Zeilen (Buchungen ohne Nutzer, Reminder ohne Buchung, …) blockweise.
+
+        Jeder Block ist eine eigene kurze Transaktion, damit parallele Buchungen
+        nicht lange warten. Der Bericht wird in app_settings 'orphan_sweep_report'
+        abgelegt und zurückgegeben.
+        """
+        t0 = time.perf_counter()
+        removed, chunks = {}, 0
+        for table, col, parent, key in ORPHAN_RULES:
+            orphan = f"NOT EXISTS (SELECT 1 FROM {parent} p WHERE p.id=c.{col})"
+            last, removed[table] = None, 0
+            with self.conn() as c:
+                cur = c.cursor()
+                while True:
+                    if key == "rowid":
+                        # Keyset über rowid: jeder Block setzt hinter dem letzten gefundenen an
+                        cur.execute(f"""SELECT c.rowid FROM {table} c WHERE c.rowid > ? AND {orphan}
+                                        ORDER BY c.rowid LIMIT ?""", (last or 0, chunk))
+                        ids = [r[0] for r in cur.fetchall()]
+                        if not ids: break
+                        cur.execute(f"DELETE FROM {table} WHERE rowid IN (SELECT value FROM json_each(?))",
+                                    (json.dumps(ids),))
+                        last = ids[-1]
+                    else:
+                        cur.execute(f"""DELETE FROM {table} WHERE ({key}) IN
+                                        (SELECT {key} FROM {table} c WHERE {orphan} LIMIT ?)""", (chunk,))
+                    n = cur.rowcount
+                    if table == "bookings" and n:
+                        self._record_change(cur, "reset")  # Plan-Caches der Sitzungen neu laden
+                    c.commit()
+                    removed[table] += n
+                    chunks += 1
+                    if n < chunk and key != "rowid": break
+        report = dict(at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), removed=removed,
+                      total=sum(removed.values()), chunks=chunks, seconds=round(time.perf_counter() - t0, 3))
+        self.set_setting("orphan_sweep_report", json.dumps(report))
+        if report["total"]:
+            self.log(None, "orphans_removed", json.dumps(removed))
+            if removed.get("bookings"): REMINDERS.rebuild()
+        return report
+
+    def orphan_sweep_report(self):
+        raw = self.get_setting("orphan_sweep_report", "")
+        return json.loads(raw) if raw else None
+
+    def run_maintenance(self, vacuum_pages=MAINTENANCE_VACUUM_PAGES, max_seconds=MAINTENANCE_MAX_SECONDS):
+        """Nächtliche Wartung: integrity_check, Vacuum, ANALYZE/optimize.
+
+        Das Vacuum läuft inkrementell in kleinen Schritten (je eine kurze
+        Schreibtransaktion) bis die Freelist leer oder das Zeitbudget aufgebraucht
+        ist. Dateien mit auto_vacuum=NONE werden beim ersten Lauf einmalig per
+        VACUUM auf INCREMENTAL umgestellt. Statistiken: beim ersten Mal ANALYZE,
+        danach PRAGMA optimize mit analysis_limit. Bericht in app_settings
+        'db_maintenance_report'.
+        """
+        t0 = time.perf_counter()
+        c = self.conn()
+        c.isolation_level = None  # Autocommit: VACUUM darf nicht in einer Transaktion laufen
+        try:
+            cur = c.cursor()
+            pages_before, free_before = self._page_stats(cur)
+            problems = [r[0] for r in cur.execute("PRAGMA integrity_check(20)").fetchall()]
+            integrity_ok = problems == ["ok"]
+            
+            if not integrity_ok:
+                vacuum = "übersprungen (Integritätsfehler)"  # beschädigte Datei nicht umschreiben
+            elif cur.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                cur.execute("VACUUM")
+                vacuum = "voll (Umstellung auf INCREMENTAL)"
+            else:
+                steps = 0
+                while self._page_stats(cur)[1] and time.perf_counter() - t0 < max_seconds:
+                    cur.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)})").fetchall()
+                    steps += 1
+                vacuum = f"inkrementell ({steps} Schritte)"
+            
+            analyzed = bool(cur.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone())
+            if analyzed:
+                cur.execute("PRAGMA analysis_limit=1000")
+                cur.execute("PRAGMA optimize")
+            else:
+                cur.execute("ANALYZE")
+            
+            pages_after, free_after = self._page_stats(cur)
+            page_size = cur.execute("PRAGMA page_size").fetchone()[0]
+        finally:
+            c.close()
+        
+        report = dict(at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), seconds=round(time.perf_counter() - t0, 3),
+                      integrity="ok" if integrity_ok else problems, vacuum=vacuum,
+                      statistics="PRAGMA optimize" if analyzed else "ANALYZE",
+                      pages_before=pages_before, pages_after=pages_after,
+                      freelist_before=free_before, freelist_after=free_after,
+                      freed_bytes=(pages_before - pages_after) * page_size,
+                      objects=self.db_object_sizes())
+        self.set_setting("db_maintenance_report", json.dumps(report))
+        self.log(None, "db_maintenance", json.dumps({k: report[k] for k in ("integrity", "vacuum", "freed_bytes")}))
+        METRICS.set("dienstplan_db_pages", pages_after)
+        METRICS.set("dienstplan_db_freelist_pages", free_after)
+        return report
+
+    @staticmethod
+    def _page_stats(cur):
+        return (cur.execute("PRAGMA page_count").fetchone()[0],
+                cur.execute("PRAGMA freelist_count").fetchone()[0])
+
+    def maintenance_report(self):
+        raw = self.get_setting("db_maintenance_report", "")
+        return json.loads(raw) if raw else None
+
+    def db_health(self):
+        """Kennzahlen der Datei (nur PRAGMAs, billig genug für jeden Rerun)"""
+        with self.conn() as c:
+            cur = c.cursor()
+            pages, free = self._page_stats(cur)
+            page_size = cur.execute("PRAGMA page_size").fetchone()[0]
+            auto_vacuum = cur.execute("PRAGMA auto_vacuum").fetchone()[0]
+            journal = cur.execute("PRAGMA journal_mode").fetchone()[0]
+        return dict(page_size=page_size, page_count=pages, freelist_count=free,
+                    size_bytes=pages * page_size, free_bytes=free * page_size,
+                    auto_vacuum={0: "NONE", 1: "FULL", 2: "INCREMENTAL"}.get(auto_vacuum, auto_vacuum),
+                    journal_mode=journal)
+
+    def db_object_sizes(self):
+        """Größe pro Tabelle/Index über die dbstat-Tabelle (scannt die ganze Datei).
+
+        Ohne SQLITE_ENABLE_DBSTAT_VTAB nur Name, Typ und Zeilenzahl der Tabellen.
+        """
+        with self.conn() as c:
+            cur = c.cursor()
+            try:
+                cur.execute("""SELECT m.name, m.type, m.tbl_name, SUM(s.pgsize), COUNT(*)
+                               FROM dbstat s JOIN sqlite_master m ON m.name=s.name
+                               GROUP BY m.name ORDER BY SUM(s.pgsize) DESC""")
+                return [dict(name=r[0], type=r[1], table=r[2], bytes=r[3], pages=r[4]) for r in cur.fetchall()]
+            except sqlite3.OperationalError:
+                cur.execute("""SELECT name, type, tbl_name FROM sqlite_master
+                               WHERE type IN ('table','index') AND name NOT LIKE 'sqlite_%' ORDER BY type DESC, name""")
+                objects = [dict(name=r[0], type=r[1], table=r[2], bytes=None, pages=None) for r in cur.fetchall()]
+                for o in objects:
+                    if o["type"] == "table":
+                        try: o["rows"] = cur.execute(f'SELECT COUNT(*) FROM "{o["name"]}"').fetchone()[0]
+                        except sqlite3.OperationalError: o["rows"] = None  # z.B. FTS-Schattentabellen
+                return objects
+
+    def _migrate_booking_times(self):
+        """Integer-Spalten für Datumslogik: day_num (generiert aus booking_date) und start_epoch.
+
+        day_num ist eine virtuelle, indizierte Spalte (Tage seit 1970-01-01).
+        start_epoch hängt von der Slot-Konfiguration ab und wird daher beim Buchen
+        gesetzt bzw. von fill_start_epochs nachgetragen.
+        """
+        with self.conn() as c:
+            cur = c.cursor()
+            cols = {r[1] for r in cur.execute("PRAGMA table_xinfo(bookings)")}
+            if "day_num" not in cols:
+                cur.execute(f"""ALTER TABLE bookings ADD COLUMN day_num INTEGER
+                               GENERATED ALWAYS AS ({DAY_NUM_SQL}) VIRTUAL""")
+            if "start_epoch" not in cols:
+                cur.execute("ALTER TABLE bookings ADD COLUMN start_epoch INTEGER")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_bookings_day ON bookings(day_num, slot_id)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_bookings_start ON bookings(start_epoch)")
+            c.commit()
+
+    def fill_start_epochs(self):
+        """Trägt start_epoch für Buchungen ohne Wert nach (Altbestand, Restore, Fremdimporte)"""
+        registry = active_slots()
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("SELECT DISTINCT slot_id, booking_date FROM bookings WHERE start_epoch IS NULL")
+            updates = [(shift_start_epoch(registry.get(sid), d), sid, d)
+                       for sid, d in cur.fetchall() if registry.get(sid)]
+            if updates:
+                cur.executemany("UPDATE bookings SET start_epoch=? WHERE slot_id=? AND booking_date=?", updates)
+                c.commit()
+        return len(updates)
+
+    @staticmethod
+    def _table_columns(cur, table):
+        """Gespeicherte Spalten einer Tabelle (ohne generierte), für Backup und Restore"""
+        return [r[1] for r in cur.execute(f"PRAGMA table_info({table})")]
+
+    def _init_text_search(self):
+        """FTS5-Indizes für Audit-Log (action, details) und Handbuch-Seiten, per Trigger synchron"""
+        try:
+            with self.conn() as c:
+                cur = c.cursor()
+                cur.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS audit_fts USING fts5(
+                    action, details, content='audit_log', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2')""")
+                cur.execute("""CREATE TRIGGER IF NOT EXISTS audit_fts_ai AFTER INSERT ON audit_log BEGIN
+                    INSERT INTO audit_fts(rowid,action,details) VALUES(new.id,new.action,new.details); END""")
+                cur.execute("""CREATE TRIGGER IF NOT EXISTS audit_fts_ad AFTER DELETE ON audit_log BEGIN
+                    INSERT INTO audit_fts(audit_fts,rowid,action,details) VALUES('delete',old.id,old.action,old.details); END""")
+                cur.execute("""CREATE TRIGGER IF NOT EXISTS audit_fts_au AFTER UPDATE OF action,details ON audit_log BEGIN
+                    INSERT INTO audit_fts(audit_fts,rowid,action,details) VALUES('delete',old.id,old.action,old.details);
+                    INSERT INTO audit_fts(rowid,action,details) VALUES(new.id,new.action,new.details); END""")
+                # Nur Altbestand nachindizieren: das Log wächst ausschließlich am Ende
+                cur.execute("SELECT (SELECT MAX(id) FROM audit_log) IS NOT (SELECT MAX(id) FROM audit_fts_docsize)")
+                if cur.fetchone()[0]:
+                    cur.execute("INSERT INTO audit_fts(audit_fts) VALUES('rebuild')")
+                
+                # Handbuch: kleine Tabelle mit eigenem Inhalt (nur handbuch_page_* aus app_settings)
+                cur.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS handbook_fts USING fts5(
+                    key UNINDEXED, content, tokenize='unicode61 remove_diacritics 2')""")
+                cur.execute("""CREATE TRIGGER IF NOT EXISTS handbook_fts_ai AFTER INSERT ON app_settings
+                    WHEN new.key LIKE 'handbuch_page_%' BEGIN
+                    INSERT INTO handbook_fts(key,content) VALUES(new.key,new.value); END""")
+                cur.execute("""CREATE TRIGGER IF NOT EXISTS handbook_fts_ad AFTER DELETE ON app_settings
+                    WHEN old.key LIKE 'handbuch_page_%' BEGIN
+                    DELETE FROM handbook_fts WHERE key=old.key; END""")
+                cur.execute("""CREATE TRIGGER IF NOT EXISTS handbook_fts_au AFTER UPDATE OF value ON app_settings
+                    WHEN new.key LIKE 'handbuch_page_%' BEGIN
+                    DELETE FROM handbook_fts WHERE key=old.key;
+                    INSERT INTO handbook_fts(key,content) VALUES(new.key,new.value); END""")
+                cur.execute("DELETE FROM handbook_fts")
+                cur.execute("""INSERT INTO handbook_fts(key,content) SELECT key,value FROM app_settings
+                               WHERE key LIKE 'handbuch_page_%'""")
+                c.commit()
+            self.text_fts = True
+        except sqlite3.OperationalError:
+            self.text_fts = False  # SQLite ohne FTS5: Suche per LIKE
+
+    @staticmethod
+    def _fts_query(query):
+        """Freitext → FTS5-Ausdruck: jedes Wort als Präfix-Phrase, alle müssen vorkommen"""
+        terms = [t.replace('"', '""') for t in query.split()]
+        return " ".join(f'"{t}"*' for t in terms)
+
+    def search_audit(self, query, page=0, limit=25, since=None, until=None):
+        """Rangierte Volltextsuche im Audit-Log (bm25, Aktion doppelt gewichtet).
+
+        since/until begrenzen auf Zeitstempel (ISO, inklusive). Rückgabe:
+        (treffer, weitere_seite_vorhanden); Treffer mit hervorgehobenem Ausschnitt.
+        """
+        query = (query or "").strip()
+        if not query: return [], False
+        where, args = [], []
+        if self.text_fts:
+            sql = """SELECT a.id,a.timestamp,COALESCE(u.name,'System'),a.action,
+                            snippet(audit_fts,1,'**','**','…',16)
+                     FROM audit_fts JOIN audit_log a ON a.id=audit_fts.rowid
+                     LEFT JOIN users u ON u.id=a.user_id
+                     WHERE audit_fts MATCH ?"""
+            args.append(self._fts_query(query))
+            order = " ORDER BY bm25(audit_fts, 2.0, 1.0), a.id DESC"
+        else:
+            sql = """SELECT a.id,a.timestamp,COALESCE(u.name,'System'),a.action,a.details
+                     FROM audit_log a LEFT JOIN users u ON u.id=a.user_id WHERE 1"""
+            pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            where.append("(a.action LIKE ? ESCAPE '\\' OR a.details LIKE ? ESCAPE '\\')")
+            args += [pattern, pattern]
+            order = " ORDER BY a.id DESC"
+        if since:
+            where.append("a.timestamp >= ?"); args.append(since)
+        if until:
+            where.append("a.timestamp < date(?, '+1 day')"); args.append(until)
+        if where: sql += " AND " + " AND ".join(where)
+        with self.conn() as c:
+            cur = c.cursor()
+            try:
+                cur.execute(sql + order + " LIMIT ? OFFSET ?", args + [limit + 1, page * limit])
+            except sqlite3.OperationalError:
+                return [], False  # ungültiger Suchausdruck
+            rows = cur.fetchall()
+        return [dict(id=r[0], timestamp=r[1], user=r[2], action=r[3], details=r[4])
+                for r in rows[:limit]], len(rows) > limit
+
+    def search_handbook(self, query, limit=10):
+        """Volltextsuche in den Handbuch-Seiten; Rückgabe [(key, ausschnitt)] nach Relevanz.
+
+        Treffer im Ausschnitt sind mit [[…]] markiert (** kollidiert mit dem Markdown der Seiten).
+        """
+        query = (query or "").strip()
+        if not query: return []
+        with self.conn() as c:
+            cur = c.cursor()
+            if self.text_fts:
+                try:
+                    cur.execute("""SELECT key, snippet(handbook_fts,1,'[[',']]','…',24) FROM handbook_fts
+                                   WHERE handbook_fts MATCH ? ORDER BY rank LIMIT ?""",
+                                (self._fts_query(query), limit))
+                except sqlite3.OperationalError:
+                    return []
+            else:
+                cur.execute("""SELECT key, substr(value,1,200) FROM app_settings
+                               WHERE key LIKE 'handbuch_page_%' AND value LIKE ? LIMIT ?""",
+                            ("%" + query + "%", limit))
+            return cur.fetchall()
+
+    def search_users(self, query="", after=None, limit=25, active_only=False, exclude_id=None):
+        """Nutzersuche mit Keyset-Pagination (sortiert nach Name, id).
+
+        Ab 3 Zeichen Teilstring-Suche über den FTS-Index, darunter Präfixsuche
+        auf Name/E-Mail. after = (name, id) des letzten Treffers der Vorseite.
+        Rückgabe: (nutzer, cursor_der_nächsten_seite oder None)
+        """
+        query = (query or "").strip()
+        where, args = [], []
+        if query and len(query) >= 3 and getattr(self, "user_fts", False):
+            where.append("id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)")
+            args.append('"' + query.replace('"', '""') + '"')
+        elif query:
+            where.append("(name LIKE ? ESCAPE '\\' OR email LIKE ? ESCAPE '\\')")
+            pattern = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            args += [pattern, pattern]
+        if active_only: where.append("active=1")
+        if exclude_id is not None:
+            where.append("id<>?"); args.append(exclude_id)
+        if after:
+            where.append("name >= ? COLLATE NOCASE AND (name > ? COLLATE NOCASE OR id > ?)")
+            args += [after[0], after[0], after[1]]
+        sql = """SELECT id,email,phone,name,role,active,created_at FROM users"""
+        if where: sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY name COLLATE NOCASE, id LIMIT ?"
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute(sql, args + [limit + 1])
+            rows = cur.fetchall()
+        users = [dict(id=r[0],email=r[1],phone=r[2],name=r[3],role=r[4],
+                      active=bool(r[5]),created_at=r[6]) for r in rows[:limit]]
+        cursor = (users[-1]["name"], users[-1]["id"]) if len(rows) > limit else None
+        return users, cursor
+
+    def user_counts(self):
+        """Aktive, gesamte und aktive Admin-Nutzer in einer Abfrage"""
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("""SELECT COALESCE(SUM(active=1),0), COUNT(*), COALESCE(SUM(active=1 AND role='admin'),0)
+                           FROM users""")
+            active, total, admins = cur.fetchone()
+        return dict(active=active, total=total, admins=admins)
+
+    def existing_emails(self, emails):
+        """Teilmenge der übergebenen E-Mails, die bereits registriert sind (eine Abfrage)"""
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("SELECT email FROM users WHERE email IN (SELECT value FROM json_each(?))",
+                        (json.dumps(list(emails)),))
+            return {r[0] for r in cur.fetchall()}
+
+    def import_users(self, rows):
+        """Legt einen Block Nutzer in einer Transaktion an (rows mit fertigem password_hash).
+
+        Liefert die E-Mails der tatsächlich angelegten Nutzer; inzwischen registrierte
+        E-Mails werden übersprungen statt den Block abzubrechen.
+        """
+        created = []
+        with self.conn() as c:
+            cur = c.cursor()
+            for r in rows:
+                cur.execute("""INSERT INTO users(email,phone,name,password_hash,role,sms_opt_in,email_opt_in,active)
+                               VALUES(:email,:phone,:name,:password_hash,:role,:sms_opt_in,:email_opt_in,:active)
+                               ON CONFLICT(email) DO NOTHING RETURNING email""", r)
+                created += [x[0] for x in cur.fetchall()]
+            c.commit()
+        return created
+
+    def iter_users(self, batch=500):
+        """Streamt die Nutzertabelle blockweise (ohne Passwort-Hashes)"""
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("""SELECT id,email,phone,name,role,sms_opt_in,email_opt_in,active,created_at
+                           FROM users ORDER BY id""")
+            while True:
+                rows = cur.fetchmany(batch)
+                if not rows: break
+                yield rows
+
     def auth(self, email, pw):
+        """Prüft Zugangsdaten (KDF im Auth-Pool) und migriert Alt-Hashes"""
         with self.conn() as c:
             cur = c.cursor()
-            cur.execute("""SELECT id,email,phone,name,role,sms_opt_in,email_opt_in,active
-                           FROM users WHERE email=? AND password_hash=?""",
-                        (email, hashlib.sha256(pw.encode()).hexdigest()))
+            cur.execute("""SELECT id,email,phone,name,role,sms_opt_in,email_opt_in,active,password_hash
+                           FROM users WHERE email=?""", (email,))
             r = cur.fetchone()
-        if not r or r[7] != 1: return None
+        if not r or r[7] != 1:
+            AUTH.verify(pw, AUTH.dummy_hash)  # gleiche Laufzeit wie bei bekannter E-Mail
+            return None
+        ok, rehash = AUTH.verify(pw, r[8])
+        if not ok: return None
+        if rehash:
+            with self.conn() as c:
+                c.execute("UPDATE users SET password_hash=? WHERE id=? AND password_hash=?",
+                          (AUTH.hash(pw), r[0], r[8]))
+                c.commit()
         return dict(id=r[0],email=r[1],phone=r[2],name=r[3],role=r[4],
                     sms_opt_in=bool(r[5]),email_opt_in=bool(r[6]))
 
@@ -376,14 +1635,17 @@ class DB:
             cur = c.cursor()
             cur.execute("UPDATE users SET name=?, phone=?, sms_opt_in=?, email_opt_in=? WHERE id=?", 
                         (name,phone,1 if sms_opt_in else 0, 1 if email_opt_in else 0, uid))
+            updated = cur.rowcount > 0
+            if updated:
+                self._record_change(cur, "user", uid=uid)  # Name/Telefon stehen in den Plan-Zellen
             c.commit()
-            return cur.rowcount > 0
+            return updated
 
     def change_password(self, uid, new_password):
+        pw_hash = AUTH.hash(new_password)
         with self.conn() as c:
             cur = c.cursor()
-            cur.execute("UPDATE users SET password_hash=? WHERE id=?",
-                        (hashlib.sha256(new_password.encode()).hexdigest(), uid))
+            cur.execute("UPDATE users SET password_hash=? WHERE id=?", (pw_hash, uid))
             c.commit()
             return cur.rowcount > 0
 
@@ -392,8 +1654,7 @@ class DB:
             cur = c.cursor()
             cur.execute("""SELECT id,email,phone,name,role,active,created_at
                            FROM users ORDER BY created_at DESC""")
-            return [dict(id=r[0],email=r[1],phone=r[2],name=r[3],role=r[4],
-                        active=bool(r[5]),created_at=r[6]) for r in cur.fetchall()]
+            return [UserRow(*r[:5], bool(r[5]), r[6]) for r in cur.fetchall()]
 
     def get_user_by_id(self, uid):
         with self.conn() as c:
@@ -425,61 +1686,422 @@ class DB:
             cur.execute("SELECT email FROM users WHERE role='admin' AND active=1")
             return [r[0] for r in cur.fetchall()]
 
-    def bookings_for(self, slot_id, d):
+    def queue_admin_event(self, subject, message):
         with self.conn() as c:
-            cur = c.cursor()
-            cur.execute("""SELECT b.id,b.user_id,u.name,u.email,u.phone,b.created_at
-                           FROM bookings b JOIN users u ON u.id=b.user_id
-                           WHERE b.slot_id=? AND b.booking_date=? AND b.status='confirmed'""",
-                        (slot_id,d))
-            return [dict(id=r[0],user_id=r[1],user_name=r[2],user_email=r[3],user_phone=r[4],created_at=r[5]) for r in cur.fetchall()]
+            c.execute("INSERT INTO admin_digest_queue(subject,message) VALUES(?,?)", (subject, message))
+            c.commit()
 
-    def create_booking(self, uid, slot_id, d):
-        if is_blocked_date(d):
-            return False, get_block_reason(d)
-            
+    def take_admin_events(self):
+        """Reserviert alle offenen Digest-Ereignisse (älteste zuerst)"""
         with self.conn() as c:
             cur = c.cursor()
-            cur.execute("SELECT COUNT(*) FROM bookings WHERE slot_id=? AND booking_date=? AND status='confirmed'", (slot_id,d))
-            if cur.fetchone()[0] > 0: return False,"Slot bereits belegt"
-            cur.execute("INSERT INTO bookings(user_id,slot_id,booking_date) VALUES(?,?,?)",(uid,slot_id,d))
+            cur.execute("""UPDATE admin_digest_queue SET sent_at=CURRENT_TIMESTAMP WHERE sent_at IS NULL
+                           RETURNING id,subject,message,created_at""")
+            rows = sorted(cur.fetchall())
             c.commit()
-            return True, cur.lastrowid
+        return [dict(id=r[0], subject=r[1], message=r[2], created_at=r[3]) for r in rows]
 
-    def cancel_booking(self, bid, uid=None):
+    def release_admin_events(self, ids):
+        """Gibt reservierte Ereignisse nach fehlgeschlagenem Versand wieder frei"""
         with self.conn() as c:
-            cur = c.cursor()
-            if uid: cur.execute("DELETE FROM bookings WHERE id=? AND user_id=?", (bid,uid))
-            else: cur.execute("DELETE FROM bookings WHERE id=?", (bid,))
+            c.execute("UPDATE admin_digest_queue SET sent_at=NULL WHERE id IN (SELECT value FROM json_each(?))",
+                      (json.dumps(list(ids)),))
             c.commit()
-            return cur.rowcount > 0
 
-    def rebook_to_user(self, booking_id, new_user_id):
-        """Bucht eine Schicht auf einen anderen User um"""
+    def pending_admin_events(self):
         with self.conn() as c:
             cur = c.cursor()
-            cur.execute("UPDATE bookings SET user_id=? WHERE id=?", (new_user_id, booking_id))
+            cur.execute("SELECT COUNT(*), MIN(created_at) FROM admin_digest_queue WHERE sent_at IS NULL")
+            return cur.fetchone()
+
+    def bookings_for(self, slot_id, d):
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("""SELECT b.id,b.user_id,u.name,u.email,u.phone,b.created_at
+                           FROM bookings b JOIN users u ON u.id=b.user_id
+                           WHERE b.slot_id=? AND b.booking_date=? AND b.status='confirmed'""",
+                        (slot_id,d))
+            return list(map(BookingRow._make, cur.fetchall()))
+
+    def get_booking(self, bid):
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("""SELECT id,user_id,slot_id,booking_date,created_at FROM bookings
+                           WHERE id=? AND status='confirmed'""", (bid,))
+            r = cur.fetchone()
+        if not r: return None
+        return dict(id=r[0],user_id=r[1],slot_id=r[2],date=r[3],created_at=r[4])
+
+    def bookings_in_range(self, start, end):
+        """Alle Buchungen eines Zeitraums in einer Abfrage: {(slot_id, datum): [buchung]}"""
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("""SELECT b.id,b.user_id,u.name,u.email,u.phone,b.created_at,b.slot_id,b.booking_date
+                           FROM bookings b JOIN users u ON u.id=b.user_id
+                           WHERE b.day_num BETWEEN ? AND ? AND b.status='confirmed'""",
+                        (day_number(start), day_number(end)))
+            cells = {}
+            for r in cur.fetchall():
+                cells.setdefault((r[6], r[7]), []).append(BookingRow._make(r[:6]))
+            return cells
+
+    def _record_change(self, cur, kind, booking_id=None, slot_id=None, d=None, uid=None):
+        """Schreibt einen Eintrag in den Change-Feed (innerhalb der laufenden Transaktion)"""
+        cur.execute("""INSERT INTO change_feed(kind,booking_id,slot_id,booking_date,user_id)
+                       VALUES(?,?,?,?,?)""", (kind, booking_id, slot_id, d, uid))
+        if kind not in ("reset", "user"): METRICS.inc("dienstplan_booking_events_total", kind=kind)
+
+    def current_seq(self):
+        """Aktueller Stand des Change-Feeds (monoton steigend)"""
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("SELECT MAX(seq) FROM change_feed")
+            return cur.fetchone()[0] or 0
+
+    def changes_since(self, seq, limit=200):
+        """Änderungen nach seq; None, wenn es zu viele sind oder die Zellen komplett neu zu laden sind.
+
+        Komplett neu geladen wird nach Restore ('reset'), Profiländerungen ('user')
+        und wenn seq vor dem Stand der letzten Feed-Bereinigung liegt.
+        """
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("""SELECT seq,kind,booking_id,slot_id,booking_date,user_id FROM change_feed WHERE seq>?
+                           UNION ALL
+                           SELECT NULL,'reset',NULL,NULL,NULL,NULL FROM app_settings
+                           WHERE key='change_feed_pruned_seq' AND CAST(value AS INTEGER) > ?
+                           ORDER BY 1 LIMIT ?""", (seq, seq, limit + 1))
+            rows = cur.fetchall()
+        if len(rows) > limit or any(r[1] in ("reset", "user") for r in rows): return None
+        return [dict(seq=r[0],kind=r[1],booking_id=r[2],slot_id=r[3],date=r[4],user_id=r[5]) for r in rows]
+
+    def prune_change_feed(self, days=CHANGE_FEED_RETENTION_DAYS):
+        """Löscht Feed-Einträge, die älter als days sind und vergangene Termine betreffen.
+
+        Einträge zukünftiger Termine bleiben (iCal-SEQUENCE), der neueste Eintrag
+        ebenfalls (current_seq bleibt monoton). Der höchste gelöschte seq wird als
+        'change_feed_pruned_seq' gemerkt; ältere Sitzungs-Caches laden komplett neu.
+        """
+        cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute("""DELETE FROM change_feed
+                           WHERE created_at < ? AND (booking_date IS NULL OR booking_date < ?)
+                             AND seq < (SELECT MAX(seq) FROM change_feed)
+                           RETURNING seq""",
+                        (cutoff.strftime("%Y-%m-%d %H:%M:%S"), cutoff.astimezone(TZ).strftime("%Y-%m-%d")))
+            deleted = [r[0] for r in cur.fetchall()]
+            if deleted:
+                cur.execute("""INSERT INTO app_settings(key,value) VALUES('change_feed_pruned_seq',?)
+                               ON CONFLICT(key) DO UPDATE SET value=MAX(CAST(value AS INTEGER), excluded.value),
+                                                              updated_at=CURRENT_TIMESTAMP""", (max(deleted),))
             c.commit()
-            return cur.rowcount > 0
+        return len(deleted)
+
+    def ics_sequence(self, slot_id, d):
+        """iCal-SEQUENCE eines Termins: Anzahl Änderungen an Slot+Datum seit der ersten Buchung"""
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("SELECT COUNT(*) FROM change_feed WHERE slot_id=? AND booking_date=?", (slot_id, d))
+            return max(cur.fetchone()[0] - 1, 0)
+
+    def ics_sequences(self, pairs):
+        """ics_sequence für mehrere (slot_id, datum) in einer Abfrage: {(slot_id, datum): sequence}"""
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("""SELECT slot_id, booking_date, COUNT(*) FROM change_feed
+                           WHERE (slot_id, booking_date) IN
+                                 (SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?))
+                           GROUP BY slot_id, booking_date""", (json.dumps(list(pairs)),))
+            return {(r[0], r[1]): max(r[2] - 1, 0) for r in cur.fetchall()}
+
+    def feed_version(self, uid=None):
+        """(seq, Zeitpunkt) der letzten Änderung, die den Kalender-Feed betrifft.
+
+        Für einen Nutzer zählen eigene Buchungen, Buchungen, die von ihm weg
+        umgebucht wurden, und Restores; ohne uid der gesamte Change-Feed. Jeder
+        Teil ist ein MAX über einen Index (user_id,seq / booking_id,seq / reset).
+        """
+        with self.conn() as c:
+            cur = c.cursor()
+            if uid is None:
+                cur.execute("SELECT seq,created_at FROM change_feed ORDER BY seq DESC LIMIT 1")
+            else:
+                cur.execute("""SELECT seq,created_at FROM change_feed WHERE seq = (SELECT MAX(s) FROM (
+                                   SELECT MAX(seq) AS s FROM change_feed WHERE user_id=?
+                                   UNION ALL SELECT MAX(seq) FROM change_feed WHERE kind='reset'
+                                   UNION ALL SELECT MAX(f.seq) FROM change_feed f WHERE f.booking_id IN
+                                       (SELECT booking_id FROM change_feed WHERE user_id=?)))""", (uid, uid))
+            r = cur.fetchone()
+        return (r[0], r[1]) if r else (0, None)
+
+    def ics_feed_rows(self, start, end, uid=None):
+        """Bestätigte Buchungen für den Kalender-Feed inkl. SEQUENCE, in einer Abfrage"""
+        sql = """SELECT b.slot_id,b.booking_date,u.name,u.email,
+                        (SELECT COUNT(*) FROM change_feed f
+                         WHERE f.slot_id=b.slot_id AND f.booking_date=b.booking_date),
+                        (SELECT MAX(f.created_at) FROM change_feed f
+                         WHERE f.slot_id=b.slot_id AND f.booking_date=b.booking_date),
+                        b.created_at
+                 FROM bookings b JOIN users u ON u.id=b.user_id
+                 WHERE b.status='confirmed' AND b.day_num BETWEEN ? AND ?"""
+        args = [day_number(start), day_number(end)]
+        if uid is not None:
+            sql += " AND b.user_id=?"
+            args.append(uid)
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute(sql + " ORDER BY b.booking_date, b.slot_id", args)
+            return [dict(slot_id=r[0],date=r[1],user_name=r[2],user_email=r[3],
+                         sequence=max(r[4] - 1, 0),modified=r[5] or r[6]) for r in cur.fetchall()]
+
+    def create_booking(self, uid, slot_id, d):
+        if is_blocked_date(d):
+            return False, get_block_reason(d)
+            
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("SELECT COUNT(*) FROM bookings WHERE slot_id=? AND booking_date=? AND status='confirmed'", (slot_id,d))
+            if cur.fetchone()[0] > 0: return False,"Slot bereits belegt"
+            slot = active_slots().get(slot_id)
+            try:
+                cur.execute("INSERT INTO bookings(user_id,slot_id,booking_date,start_epoch) VALUES(?,?,?,?)",
+                            (uid, slot_id, d, shift_start_epoch(slot, d) if slot else None))
+            except sqlite3.IntegrityError:
+                c.rollback()  # parallel gebucht (UNIQUE(slot_id, booking_date))
+                return False, "Slot bereits belegt"
+            bid = cur.lastrowid
+            self._record_change(cur, "booked", bid, slot_id, d, uid)
+            c.commit()
+        REMINDERS.schedule(bid, slot_id, d)
+        return True, bid
+
+    def create_bookings(self, uid, items):
+        """Bucht viele (slot_id, datum)-Paare in einer Transaktion.
+
+        Validierung (Slot, Wochentag, Vergangenheit, Sperrtage, Duplikate) erfolgt
+        vorab; bestehende Buchungen werden mit einer Abfrage ermittelt. Konflikte
+        werden pro Eintrag gemeldet, alle übrigen Paare per executemany gebucht.
+        Rückgabe: {"booked": [{id, slot_id, date}], "conflicts": [{slot_id, date, reason}]}
+        """
+        registry = active_slots()
+        today = date.today().strftime("%Y-%m-%d")
+        conflicts, wanted, seen = [], [], set()
+        for slot_id, d in items:
+            slot = registry.get(slot_id)
+            try:
+                d = date.fromisoformat(d).strftime("%Y-%m-%d")
+            except (TypeError, ValueError):
+                conflicts.append(dict(slot_id=slot_id, date=d, reason="Ungültiges Datum")); continue
+            if not slot: reason = "Unbekannter Slot"
+            elif date.fromisoformat(d).weekday() != slot.weekday: reason = "Falscher Wochentag"
+            elif d < today: reason = "Datum liegt in der Vergangenheit"
+            elif is_blocked_date(d): reason = get_block_reason(d)
+            elif (slot_id, d) in seen: reason = "Doppelt angefragt"
+            else: reason = None
+            if reason:
+                conflicts.append(dict(slot_id=slot_id, date=d, reason=reason)); continue
+            seen.add((slot_id, d))
+            wanted.append((slot_id, d))
+        if not wanted: return {"booked": [], "conflicts": conflicts}
+        
+        booked, rejected = self._book_pairs([(uid, sid, d) for sid, d in wanted])
+        conflicts += [dict(slot_id=p[0], date=p[1], reason=rejected[p]) for p in wanted if p in rejected]
+        return {"booked": [dict(id=b["id"], slot_id=b["slot_id"], date=b["date"]) for b in booked],
+                "conflicts": conflicts}
+
+    def _book_pairs(self, rows, max_per_week=None, per_row=False):
+        """Bucht (user_id, slot_id, datum)-Tripel in einer Transaktion.
+
+        Bereits belegte Paare werden übersprungen, alle übrigen per executemany
+        eingefügt; Change-Feed und Reminder inklusive. Mit ``max_per_week`` gelten
+        zusätzlich die Zuteilungsregeln (siehe _assignment_rejects), geprüft im
+        selben Schreib-Lock. Verletzt ein paralleler Schreiber trotzdem
+        UNIQUE(slot_id, booking_date), wird zurückgerollt und zeilenweise neu
+        gebucht; nur die betroffenen Paare werden dann als belegt gemeldet.
+        Rückgabe: (booked, {(slot_id, datum): grund})
+        """
+        pair_sql = """SELECT b.id,b.slot_id,b.booking_date,b.user_id FROM bookings b
+                      JOIN json_each(?) j ON b.slot_id=json_extract(j.value,'$[0]')
+                                         AND b.booking_date=json_extract(j.value,'$[1]')
+                      WHERE b.status='confirmed'"""
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute(pair_sql, (json.dumps([(sid, d) for _, sid, d in rows]),))
+            rejected = {(r[1], r[2]): "Slot bereits belegt" for r in cur.fetchall()}
+            if max_per_week is not None:
+                rejected.update(self._assignment_rejects(cur, [r for r in rows if (r[1], r[2]) not in rejected],
+                                                         max_per_week))
+            free = [r for r in rows if (r[1], r[2]) not in rejected]
+            booked, raced = [], False
+            if free:
+                registry = active_slots()
+                insert_sql = "INSERT INTO bookings(user_id,slot_id,booking_date,start_epoch) VALUES(?,?,?,?)"
+                params = [(uid, sid, d, shift_start_epoch(registry.get(sid), d) if registry.get(sid) else None)
+                          for uid, sid, d in free]
+                if per_row:
+                    for p in params:
+                        try:
+                            cur.execute(insert_sql, p)
+                        except sqlite3.IntegrityError:
+                            rejected[(p[1], p[2])] = "Slot bereits belegt"
+                    free = [r for r in free if (r[1], r[2]) not in rejected]
+                else:
+                    try:
+                        cur.executemany(insert_sql, params)
+                    except sqlite3.IntegrityError:
+                        c.rollback()
+                        raced = True
+            if free and not raced:
+                cur.execute(pair_sql, (json.dumps([(sid, d) for _, sid, d in free]),))
+                booked = sorted((dict(id=r[0], slot_id=r[1], date=r[2], user_id=r[3]) for r in cur.fetchall()),
+                                key=lambda b: (b["date"], b["slot_id"]))
+                cur.executemany("""INSERT INTO change_feed(kind,booking_id,slot_id,booking_date,user_id)
+                                   VALUES('booked',?,?,?,?)""",
+                                [(b["id"], b["slot_id"], b["date"], b["user_id"]) for b in booked])
+            c.commit()
+        if raced:
+            return self._book_pairs(rows, max_per_week, per_row=True)
+        METRICS.inc("dienstplan_booking_events_total", len(booked), kind="booked")
+        for b in booked:
+            REMINDERS.schedule(b["id"], b["slot_id"], b["date"])
+        return booked, rejected
+
+    def _assignment_rejects(self, cur, rows, max_per_week):
+        """Prüft Zuteilungen gegen den aktuellen Stand (innerhalb der Schreib-Transaktion).
+
+        Abgelehnt werden inaktive Nutzer, als "nicht verfügbar" markierte Slots,
+        ein zweiter Dienst am selben Tag und Überschreitungen von ``max_per_week``
+        (bestehende Buchungen plus bereits angenommene Zeilen).
+        """
+        if not rows: return {}
+        uids = json.dumps(sorted({uid for uid, _, _ in rows}))
+        weeks = [week_start(date.fromisoformat(d)) for _, _, d in rows]
+        cur.execute("SELECT id FROM users WHERE active=1 AND id IN (SELECT value FROM json_each(?))", (uids,))
+        active = {r[0] for r in cur.fetchall()}
+        cur.execute("""SELECT user_id,slot_id FROM user_availability
+                       WHERE preference=0 AND user_id IN (SELECT value FROM json_each(?))""", (uids,))
+        unavailable = set(cur.fetchall())
+        cur.execute("""SELECT user_id,booking_date FROM bookings
+                       WHERE status='confirmed' AND user_id IN (SELECT value FROM json_each(?))
+                         AND day_num BETWEEN ? AND ?""",
+                    (uids, day_number(min(weeks)), day_number(max(weeks) + timedelta(days=6))))
+        days, per_week = set(), {}
+        for uid, d in cur.fetchall():
+            days.add((uid, d))
+            key = (uid, week_start(date.fromisoformat(d)))
+            per_week[key] = per_week.get(key, 0) + 1
+        rejected = {}
+        for (uid, sid, d), ws in zip(rows, weeks):
+            if uid not in active: reason = "Nutzer inaktiv"
+            elif (uid, sid) in unavailable: reason = "Nutzer nicht verfügbar"
+            elif (uid, d) in days: reason = "Nutzer hat an diesem Tag bereits einen Dienst"
+            elif per_week.get((uid, ws), 0) >= max_per_week: reason = "Wochenlimit erreicht"
+            else: reason = None
+            if reason:
+                rejected[(sid, d)] = reason; continue
+            days.add((uid, d))
+            per_week[(uid, ws)] = per_week.get((uid, ws), 0) + 1
+        return rejected
+
+    def apply_assignment(self, items, max_per_week=ASSIGN_MAX_PER_WEEK):
+        """Übernimmt einen Zuteilungsvorschlag [(user_id, slot_id, datum)] in einer Transaktion.
+
+        Der Vorschlag kann veraltet sein; belegte Slots und verletzte
+        Zuteilungsregeln werden pro Eintrag als Konflikt gemeldet.
+        """
+        today = date.today().strftime("%Y-%m-%d")
+        stale, rows, seen = [], [], set()
+        for uid, sid, d in items:
+            if d < today: reason = "Datum liegt in der Vergangenheit"
+            elif (sid, d) in seen: reason = "Doppelt angefragt"
+            else: reason = None
+            if reason:
+                stale.append(dict(slot_id=sid, date=d, user_id=uid, reason=reason)); continue
+            seen.add((sid, d))
+            rows.append((uid, sid, d))
+        booked, rejected = self._book_pairs(rows, max_per_week) if rows else ([], {})
+        return {"booked": booked,
+                "conflicts": stale + [dict(slot_id=sid, date=d, user_id=uid, reason=rejected[(sid, d)])
+                                      for uid, sid, d in rows if (sid, d) in rejected]}
+
+    def get_availability(self, uid):
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("SELECT slot_id,preference FROM user_availability WHERE user_id=?", (uid,))
+            return dict(cur.fetchall())
+
+    def set_availability(self, uid, prefs):
+        """Speichert die Präferenzen {slot_id: stufe}; Stufe 1 (Standard) wird nicht gespeichert"""
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("DELETE FROM user_availability WHERE user_id=?", (uid,))
+            cur.executemany("INSERT INTO user_availability(user_id,slot_id,preference) VALUES(?,?,?)",
+                            [(uid, sid, int(p)) for sid, p in prefs.items() if int(p) != 1])
+            c.commit()
+        return True
+
+    def assignment_inputs(self, since, end):
+        """Rohdaten für den Solver als NumPy-Arrays: aktive Nutzer, Präferenzen und Buchungen ab ``since``"""
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("SELECT id,name FROM users WHERE active=1 ORDER BY id")
+            users = cur.fetchall()
+            cur.execute("""SELECT a.user_id,a.slot_id,a.preference FROM user_availability a
+                           JOIN users u ON u.id=a.user_id WHERE u.active=1""")
+            prefs = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 3)
+            cur.execute("""SELECT user_id,slot_id,booking_date FROM bookings
+                           WHERE status='confirmed' AND day_num BETWEEN ? AND ?""", (day_number(since), day_number(end)))
+            bookings = cur.fetchall()
+        return users, prefs, bookings
+
+    def cancel_booking(self, bid, uid=None):
+        with self.conn() as c:
+            cur = c.cursor()
+            if uid: cur.execute("SELECT slot_id,booking_date,user_id FROM bookings WHERE id=? AND user_id=?", (bid,uid))
+            else: cur.execute("SELECT slot_id,booking_date,user_id FROM bookings WHERE id=?", (bid,))
+            r = cur.fetchone()
+            if not r: return False
+            cur.execute("DELETE FROM bookings WHERE id=?", (bid,))  # reminder_log per ON DELETE CASCADE
+            self._record_change(cur, "cancelled", bid, r[0], r[1], r[2])
+            c.commit()
+        REMINDERS.cancel(bid)
+        return True
+
+    def rebook_to_user(self, booking_id, new_user_id):
+        """Bucht eine Schicht auf einen anderen User um"""
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("SELECT slot_id,booking_date FROM bookings WHERE id=?", (booking_id,))
+            r = cur.fetchone()
+            if not r: return False
+            cur.execute("UPDATE bookings SET user_id=? WHERE id=?", (new_user_id, booking_id))
+            # Der neue Nutzer soll seine Reminder erhalten, auch wenn der alte schon einen bekam
+            cur.execute("DELETE FROM reminder_log WHERE booking_id=?", (booking_id,))
+            self._record_change(cur, "rebooked", booking_id, r[0], r[1], new_user_id)
+            c.commit()
+        REMINDERS.schedule(booking_id, r[0], r[1])
+        return True
 
     def get_next_shift(self, uid):
         """Holt den nächsten Dienst eines Users"""
         with self.conn() as c:
             cur = c.cursor()
-            today = datetime.now().strftime("%Y-%m-%d")
             cur.execute("""SELECT booking_date, slot_id FROM bookings 
-                           WHERE user_id=? AND booking_date>=? AND status='confirmed'
-                           ORDER BY booking_date ASC LIMIT 1""", (uid, today))
+                           WHERE user_id=? AND day_num>=? AND status='confirmed'
+                           ORDER BY day_num ASC LIMIT 1""", (uid, day_number(date.today())))
             result = cur.fetchone()
         if not result: return None
         
-        slot = next((s for s in WEEKLY_SLOTS if s["id"] == result[1]), None)
+        slot = active_slots().get(result[1])
         if not slot: return None
         
         return {
             "date": fmt_de(result[0]),
-            "time": f"{slot['start']}-{slot['end']}",
-            "day": slot["day_name"]
+            "time": slot.time_range,
+            "day": slot.day_name
         }
 
     def user_bookings(self, uid):
@@ -487,79 +2109,112 @@ class DB:
             cur = c.cursor()
             cur.execute("""SELECT id,slot_id,booking_date,created_at FROM bookings
                            WHERE user_id=? AND status='confirmed' ORDER BY booking_date ASC""",(uid,))
-            return [dict(id=r[0],slot_id=r[1],date=r[2],created_at=r[3]) for r in cur.fetchall()]
+            return list(map(UserBookingRow._make, cur.fetchall()))
 
-    def get_upcoming_shifts_for_reminders(self):
-        """Holt anstehende Schichten für Reminder (24h und 1h)"""
-        now = datetime.now(TZ)
-        
+    def pending_reminder_bookings(self):
+        """Zukünftige Buchungen mit bereits versendeten Reminder-Typen (Aufbau der Reminder-Queue)
+
+        Fehlgeschlagene Reminder zählen nicht als versendet und werden innerhalb
+        der Nachhol-Frist erneut eingeplant.
+        """
         with self.conn() as c:
             cur = c.cursor()
-            cur.execute("""
-                SELECT b.id, b.user_id, b.slot_id, b.booking_date, u.phone, u.name, u.sms_opt_in
-                FROM bookings b
-                JOIN users u ON b.user_id = u.id
-                WHERE b.status = 'confirmed' AND u.active = 1
-                ORDER BY b.booking_date, b.slot_id
-            """)
-            
-            bookings = cur.fetchall()
-            reminder_candidates = []
-            
-            for booking in bookings:
-                booking_id, user_id, slot_id, booking_date, phone, name, sms_opt_in = booking
-                if not sms_opt_in:
-                    continue
-                    
-                slot = next((s for s in WEEKLY_SLOTS if s["id"] == slot_id), None)
-                if not slot:
-                    continue
-                    
-                booking_dt = datetime.strptime(booking_date, "%Y-%m-%d")
-                start_time = datetime.strptime(slot["start"], "%H:%M").time()
-                shift_start = TZ.localize(datetime.combine(booking_dt, start_time))
-                
-                time_diff = shift_start - now
-                
-                if timedelta(hours=23, minutes=45) <= time_diff <= timedelta(hours=24, minutes=15):
-                    reminder_type = "24h"
-                elif timedelta(minutes=45) <= time_diff <= timedelta(hours=1, minutes=15):
-                    reminder_type = "1h"
-                else:
-                    continue
-                
-                cur.execute("SELECT COUNT(*) FROM reminder_log WHERE booking_id=? AND reminder_type=?", 
-                           (booking_id, reminder_type))
-                if cur.fetchone()[0] > 0:
-                    continue
-                    
-                reminder_candidates.append({
-                    "booking_id": booking_id,
-                    "user_id": user_id,
-                    "phone": phone,
-                    "name": name,
-                    "slot": slot,
-                    "date": booking_date,
-                    "reminder_type": reminder_type
-                })
-            
-            return reminder_candidates
+            cur.execute("""SELECT b.id, b.slot_id, b.booking_date, b.start_epoch, GROUP_CONCAT(r.reminder_type)
+                           FROM bookings b LEFT JOIN reminder_log r ON r.booking_id=b.id AND r.status!='failed'
+                           WHERE b.status='confirmed' AND b.start_epoch>?
+                           GROUP BY b.id""", (int(time.time()),))
+            return [dict(id=r[0], slot_id=r[1], date=r[2], start=r[3], sent=set((r[4] or "").split(",")) - {""})
+                    for r in cur.fetchall()]
 
-    def log_reminder_sent(self, booking_id, reminder_type):
+    def reminder_target(self, booking_id):
+        """Aktueller Empfänger einer Buchung (nach Umbuchung der neue Nutzer)"""
         with self.conn() as c:
             cur = c.cursor()
-            cur.execute("INSERT INTO reminder_log(booking_id,reminder_type) VALUES(?,?)",
-                        (booking_id, reminder_type))
+            cur.execute("""SELECT b.user_id, b.slot_id, b.booking_date, u.phone, u.name, u.sms_opt_in, u.active,
+                                  b.start_epoch
+                           FROM bookings b JOIN users u ON u.id=b.user_id
+                           WHERE b.id=? AND b.status='confirmed'""", (booking_id,))
+            r = cur.fetchone()
+        if not r: return None
+        return dict(user_id=r[0], slot_id=r[1], date=r[2], phone=r[3], name=r[4],
+                    sms_opt_in=bool(r[5]), active=bool(r[6]), start=r[7])
+
+    def claim_reminder(self, booking_id, reminder_type):
+        """Reserviert einen Reminder (UNIQUE booking_id+typ); False, wenn schon versendet/reserviert.
+
+        Fehlgeschlagene Versuche ('failed') dürfen erneut reserviert werden.
+        """
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("""INSERT INTO reminder_log(booking_id,reminder_type,status) VALUES(?,?,'pending')
+                           ON CONFLICT(booking_id, reminder_type) DO UPDATE SET status='pending'
+                           WHERE reminder_log.status='failed'""", (booking_id, reminder_type))
+            c.commit()
+            return cur.rowcount == 1
+
+    def finish_reminder(self, booking_id, reminder_type, ok):
+        with self.conn() as c:
+            c.execute("UPDATE reminder_log SET status=?, sent_at=CURRENT_TIMESTAMP WHERE booking_id=? AND reminder_type=?",
+                      ("sent" if ok else "failed", booking_id, reminder_type))
             c.commit()
 
+    def table_versions(self):
+        """Änderungszähler aller Backup-Tabellen in einer Abfrage"""
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("SELECT name,version FROM table_versions")
+            return dict(cur.fetchall())
+
+    def iter_table(self, table, batch=1000):
+        """Streamt eine Backup-Tabelle blockweise: erst die Spaltennamen, dann Zeilenblöcke"""
+        if table not in BACKUP_TABLES: raise ValueError(table)
+        with self.conn() as c:
+            cur = c.cursor()
+            cols = self._table_columns(cur, table)
+            cur.execute(f"SELECT {','.join(cols)} FROM {table}")
+            yield cols
+            while True:
+                rows = cur.fetchmany(batch)
+                if not rows: break
+                yield rows
+
+    def iter_audit_log(self, batch=1000):
+        """Kompletter Audit-Log (neueste zuerst), blockweise"""
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute("""SELECT a.timestamp,COALESCE(u.name,'System'),a.action,a.details
+                           FROM audit_log a LEFT JOIN users u ON a.user_id=u.id
+                           ORDER BY a.timestamp DESC, a.id DESC""")
+            while True:
+                rows = cur.fetchmany(batch)
+                if not rows: break
+                yield rows
+
     def get_audit_log(self, limit=100):
         with self.conn() as c:
             cur = c.cursor()
-            cur.execute("""SELECT a.timestamp,u.name,a.action,a.details 
+            cur.execute("""SELECT a.timestamp,COALESCE(u.name,'System'),a.action,a.details 
                            FROM audit_log a 
                            LEFT JOIN users u ON a.user_id=u.id 
                            ORDER BY a.timestamp DESC LIMIT ?""", (limit,))
-            return [dict(timestamp=r[0],user=r[1] or "System",action=r[2],details=r[3]) for r in cur.fetchall()]
+            return list(map(AuditRow._make, cur.fetchall()))
+
+    def query_frame(self, sql, args=()):
+        """Abfrage direkt als DataFrame (Spalten aus cursor.description, ohne Dict-Zwischenschritt)"""
+        with self.conn() as c:
+            cur = c.cursor()
+            cur.execute(sql, args)
+            return pd.DataFrame.from_records(cur.fetchall(), columns=[d[0] for d in cur.description])
+
+    def analytics_frames(self, events_since):
+        """Spaltenbasierte Rohdaten für das Analytics-Modul: Buchungen, aktive Nutzer, Change-Feed"""
+        bookings = self.query_frame("""SELECT id,user_id,slot_id,booking_date,created_at FROM bookings
+                                       WHERE status='confirmed'""")
+        users = self.query_frame("SELECT id,name,email FROM users WHERE active=1")
+        events = self.query_frame("""SELECT kind,booking_id,slot_id,booking_date,created_at FROM change_feed
+                                     WHERE created_at>=? AND kind IN ('booked','cancelled','rebooked')""",
+                                  (events_since,))
+        return bookings, users, events
 
     def get_user_statistics(self):
         """Benutzerstatistiken für Reporting"""
@@ -574,24 +2229,25 @@ class DB:
                 GROUP BY u.id, u.name, u.email
                 ORDER BY total_bookings DESC
             """)
-            return [dict(name=r[0], email=r[1], total_bookings=r[2], last_booking=r[3]) 
-                    for r in cur.fetchall()]
+            return list(map(UserStatsRow._make, cur.fetchall()))
 
     def get_booking_trends(self, weeks=12):
         """Holt Buchungstrends für Visualisierung"""
         with self.conn() as c:
             cur = c.cursor()
-            start_date = (datetime.now() - timedelta(weeks=weeks)).strftime("%Y-%m-%d")
+            start_day = day_number(date.today() - timedelta(weeks=weeks))
+            # Wochennummer seit 1970 (Montag als Wochenbeginn, 1970-01-01 war ein Donnerstag);
+            # Wochen über den Jahreswechsel werden wie bei '%Y-%W' nach Jahr getrennt
             cur.execute("""
                 SELECT 
-                    strftime('%Y-%W', booking_date) as week,
+                    strftime('%Y-%W', MIN(booking_date)) as week,
                     COUNT(*) as bookings,
                     COUNT(DISTINCT user_id) as unique_users
                 FROM bookings 
-                WHERE booking_date >= ? AND status = 'confirmed'
-                GROUP BY week
+                WHERE day_num >= ? AND status = 'confirmed'
+                GROUP BY (day_num + 3) / 7, substr(booking_date, 1, 4)
                 ORDER BY week
-            """, (start_date,))
+            """, (start_day,))
             return [dict(week=r[0], bookings=r[1], unique_users=r[2]) for r in cur.fetchall()]
 
     def get_slot_distribution(self):
@@ -605,41 +2261,37 @@ class DB:
                 GROUP BY slot_id
                 ORDER BY count DESC
             """)
+            registry = active_slots()
             results = []
             for r in cur.fetchall():
-                slot = next((s for s in WEEKLY_SLOTS if s["id"] == r[0]), None)
+                slot = registry.get(r[0])
                 if slot:
                     results.append({
-                        "slot": f"{slot['day_name']} {slot['start']}-{slot['end']}",
+                        "slot": slot.label,
                         "count": r[1]
                     })
             return results
 
     def get_free_slots_next_weeks(self, weeks=4):
-        """Freie Slots der nächsten X Wochen"""
+        """Freie Slots der nächsten X Wochen (eine Abfrage für den ganzen Zeitraum)"""
         today = date.today()
-        end_date = today + timedelta(weeks=weeks)
+        today_s = today.strftime("%Y-%m-%d")
+        week_starts = [week_start(today + timedelta(weeks=i)) for i in range(weeks + 1)]
+        cells = self.bookings_in_range(today, week_starts[-1] + timedelta(days=6))
         
         free_slots = []
-        current = today
-        
-        while current <= end_date:
-            ws = week_start(current)
-            for slot in WEEKLY_SLOTS:
-                slot_d = slot_date(ws, slot["day"])
-                if slot_d < today.strftime("%Y-%m-%d") or is_blocked_date(slot_d):
+        for ws in week_starts:
+            for slot in active_slots():
+                slot_d = slot.date_in_week(ws)
+                if slot_d < today_s or is_blocked_date(slot_d) or (slot.id, slot_d) in cells:
                     continue
-                    
-                bookings = self.bookings_for(slot["id"], slot_d)
-                if not bookings:
-                    free_slots.append({
-                        "date": slot_d,
-                        "date_de": fmt_de(slot_d),
-                        "day": slot["day_name"],
-                        "time": f"{slot['start']}-{slot['end']}",
-                        "slot_id": slot["id"]
-                    })
-            current += timedelta(days=7)
+                free_slots.append({
+                    "date": slot_d,
+                    "date_de": fmt_de(slot_d),
+                    "day": slot.day_name,
+                    "time": slot.time_range,
+                    "slot_id": slot.id
+                })
         
         return free_slots
 
@@ -654,13 +2306,11 @@ class DB:
         
         with self.conn() as c:
             cur = c.cursor()
-            tables = ["users", "bookings", "audit_log", "app_settings", "info_pages", "reminder_log"]
-            
-            for table in tables:
+            for table in BACKUP_TABLES:
                 try:
-                    cur.execute(f"SELECT * FROM {table}")
+                    cols = self._table_columns(cur, table)
+                    cur.execute(f"SELECT {','.join(cols)} FROM {table}")
                     rows = cur.fetchall()
-                    cols = [d[0] for d in cur.description]
                     backup_data["tables"][table] = {
                         "columns": cols,
                         "rows": rows
@@ -677,21 +2327,43 @@ class DB:
         
         try:
             with self.conn() as c:
+                # Tabellen werden einzeln ersetzt; Kaskaden würden bereits eingespielte Daten löschen
+                c.execute("PRAGMA foreign_keys=OFF")
                 cur = c.cursor()
                 
                 for table_name, table_data in backup_data["tables"].items():
-                    if table_name in ["users", "bookings", "audit_log", "app_settings", "info_pages", "reminder_log"]:
+                    if table_name in BACKUP_TABLES:
                         # Tabelle leeren
                         cur.execute(f"DELETE FROM {table_name}")
                         
-                        # Daten wiederherstellen
+                        # Daten wiederherstellen (per Spaltenname; ältere Backups haben weniger Spalten)
                         if table_data["rows"]:
-                            placeholders = ",".join(["?" for _ in table_data["columns"]])
-                            for row in table_data["rows"]:
-                                cur.execute(f"INSERT INTO {table_name} VALUES ({placeholders})", row)
+                            known = set(self._table_columns(cur, table_name))
+                            idx = [i for i, col in enumerate(table_data["columns"]) if col in known]
+                            cols = ",".join(table_data["columns"][i] for i in idx)
+                            placeholders = ",".join("?" * len(idx))
+                            cur.executemany(f"INSERT INTO {table_name}({cols}) VALUES ({placeholders})",
+                                            ([row[i] for i in idx] for row in table_data["rows"]))
                 
+                # Offene Sitzungen müssen ihre Plan-Caches komplett neu laden
+                self._record_change(cur, "reset")
                 c.commit()
-                return True, "Backup erfolgreich wiederhergestellt"
+            # Slot-Konfiguration aus dem Backup übernehmen, bevor start_epoch/Reminder berechnet werden
+            previous = active_slots()
+            SLOT_CONFIG.load(self.get_setting("weekly_slots", ""))
+            registry = active_slots()
+            retimed = [s.id for s in registry
+                       if not previous.get(s.id) or previous.get(s.id).start_time != s.start_time]
+            if retimed:
+                with self.conn() as c:
+                    cur = c.cursor()
+                    cur.execute("BEGIN IMMEDIATE")
+                    self._retime_bookings(cur, registry, retimed)
+                    c.commit()
+            self.fill_start_epochs()
+            self.sweep_orphans()  # Backups ohne Fremdschlüssel können Waisen enthalten
+            REMINDERS.rebuild()
+            return True, "Backup erfolgreich wiederhergestellt"
         except Exception as e:
             return False, f"Restore-Fehler: {str(e)}"
 
@@ -704,54 +2376,231 @@ class DB:
         except Exception:
             pass
 
-# ===== Twilio Balance (robuste Version) =====
-def get_twilio_balance():
-    """Holt Twilio Account Balance mit robuster Fehlerbehandlung"""
-    if SAFE_MODE or not hasattr(st, "secrets"):
-        return None, "Safe-Mode aktiv oder Secrets nicht verfügbar"
-    
-    try:
+# ===== Circuit Breaker (SMTP/Twilio) =====
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    """Prozessweiter Schutzschalter pro externem Anbieter.
+
+    closed: Aufrufe laufen durch; nach failure_threshold Fehlern in Folge -> open.
+    open: Aufrufe werden sofort abgewiesen, bis reset_seconds verstrichen sind.
+    half_open: genau ein Probe-Aufruf; Erfolg schließt, Fehler öffnet erneut.
+    is_failure entscheidet, ob eine Exception den Anbieter betrifft (z.B. nicht
+    bei ungültiger Empfängernummer).
+    """
+
+    def __init__(self, name, failure_threshold=3, reset_seconds=60, is_failure=None):
+        self.name = name
+        self.is_failure = is_failure or (lambda e: True)
+        self.failure_threshold = max(int(failure_threshold), 1)
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.last_error = None
+        self.stats = {"calls": 0, "failures": 0, "rejected": 0}
+
+    def _allow(self):
+        with self.lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self.probing:
+                self.probing = True
+                return True
+            self.stats["rejected"] += 1
+            return False
+
+    def _record(self, error=None):
+        with self.lock:
+            self.stats["calls"] += 1
+            self.probing = False
+            if error is None:
+                self.state, self.failures = "closed", 0
+                return
+            self.stats["failures"] += 1
+            self.failures += 1
+            self.last_error = f"{datetime.now().strftime('%H:%M:%S')} {type(error).__name__}: {error}"[:200]
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state, self.opened_at = "open", time.monotonic()
+
+    def call(self, fn, *args, **kwargs):
+        if not self._allow():
+            raise CircuitOpenError(f"{self.name} vorübergehend deaktiviert (Circuit offen)")
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self._record(e if self.is_failure(e) else None)
+            raise
+        self._record()
+        return result
+
+    def retry_in(self):
+        """Sekunden bis zum nächsten Probe-Aufruf (nur im Zustand open)"""
+        with self.lock:
+            if self.state != "open": return 0
+            return max(0, int(self.reset_seconds - (time.monotonic() - self.opened_at)))
+
+    def reset(self):
+        with self.lock:
+            self.state, self.failures, self.opened_at, self.probing = "closed", 0, None, False
+
+def _smtp_failure(e):
+    return not isinstance(e, (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused))
+
+def _twilio_failure(e):
+    return not (isinstance(e, TwilioRestException) and e.status and e.status < 500 and e.status != 429)
+
+@st.cache_resource(show_spinner=False)
+def _breakers():
+    return {"SMTP": CircuitBreaker("SMTP", BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS, _smtp_failure),
+            "Twilio": CircuitBreaker("Twilio", BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS, _twilio_failure)}
+
+BREAKERS = _breakers()
+
+class _TimeoutAdapter(HTTPAdapter):
+    """requests-Adapter mit getrenntem Connect-/Read-Timeout (TwilioHttpClient akzeptiert nur einen Float)"""
+
+    def send(self, request, **kwargs):
+        kwargs["timeout"] = (TWILIO_CONNECT_TIMEOUT, TWILIO_READ_TIMEOUT)
+        return super().send(request, **kwargs)
+
+def twilio_client(sid, token):
+    """Twilio-Client mit getrennten Connect-/Read-Timeouts"""
+    http = TwilioHttpClient(timeout=TWILIO_READ_TIMEOUT)
+    http.session.mount("https://", _TimeoutAdapter())
+    return Client(sid, token, http_client=http)
+
+# ===== Twilio Balance (prozessweiter Monitor) =====
+def _twilio_error_text(e):
+    error_msg = str(e)
+    if isinstance(e, CircuitOpenError):
+        return error_msg
+    elif "authentication" in error_msg.lower():
+        return "Authentifizierungsfehler - Twilio-Credentials prüfen"
+    elif "network" in error_msg.lower() or "timeout" in error_msg.lower():
+        return "Netzwerkfehler - Später erneut versuchen"
+    elif "rate" in error_msg.lower():
+        return "Rate-Limit erreicht - Anfragen reduzieren"
+    else:
+        return f"API-Fehler: {error_msg}"
+
+class TwilioBalanceMonitor:
+    """Ein Balance-Abruf für alle Sitzungen (stale-while-revalidate).
+
+    get() liefert sofort den letzten Stand; ist er älter als ttl, wird im
+    Hintergrund neu geladen. Zusätzlich aktualisiert ein Scheduler-Job den Wert
+    periodisch. Die Zeitreihe (Balance + gesendete SMS je Messpunkt) bleibt im
+    Speicher und liefert die Verbrauchsrate ohne weitere API-Aufrufe.
+    """
+
+    def __init__(self, ttl_seconds=300, history=288):
+        self.ttl = ttl_seconds
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.current = None          # {"balance", "currency", "last_updated", "fetched_at"}
+        self.error = None
+        self.series = deque(maxlen=history)  # (datetime, balance, sms_seit_letztem_punkt)
+        self.sms_since_sample = 0
+
+    @staticmethod
+    def credentials():
+        if SAFE_MODE or not hasattr(st, "secrets"):
+            return None, "Safe-Mode aktiv oder Secrets nicht verfügbar"
         sid = st.secrets.get("TWILIO_ACCOUNT_SID", "")
         token = st.secrets.get("TWILIO_AUTH_TOKEN", "")
-        
         if not (sid and token):
             return None, "Twilio-Credentials nicht konfiguriert"
-        
-        # Cache prüfen
-        cache_key = "twilio_balance_cache"
-        cache_time_key = "twilio_balance_time"
-        
-        if (cache_key in st.session_state and cache_time_key in st.session_state):
-            cache_age = datetime.now() - st.session_state[cache_time_key]
-            if cache_age < timedelta(minutes=5):  # Cache für 5 Minuten
-                return st.session_state[cache_key], None
-        
-        # Neue Abfrage
-        client = Client(sid, token)
-        balance = client.api.v2010.balance.fetch()
-        
-        result = {
-            "balance": balance.balance,
-            "currency": balance.currency,
-            "last_updated": datetime.now().strftime("%H:%M:%S")
-        }
-        
-        # Cache aktualisieren
-        st.session_state[cache_key] = result
-        st.session_state[cache_time_key] = datetime.now()
-        
-        return result, None
-        
-    except Exception as e:
-        error_msg = str(e)
-        if "authentication" in error_msg.lower():
-            return None, "Authentifizierungsfehler - Twilio-Credentials prüfen"
-        elif "network" in error_msg.lower() or "timeout" in error_msg.lower():
-            return None, "Netzwerkfehler - Später erneut versuchen"
-        elif "rate" in error_msg.lower():
-            return None, "Rate-Limit erreicht - Anfragen reduzieren"
+        return (sid, token), None
+
+    def record_sms(self, count=1):
+        with self.lock:
+            self.sms_since_sample += count
+
+    def refresh(self, min_age=0):
+        """Synchroner Abruf; übersprungen, wenn bereits einer läuft oder der Wert jünger als min_age ist.
+
+        Rückgabe False bei fehlgeschlagenem Abruf (für die Job-Metriken), sonst True/None.
+        """
+        with self.lock:
+            fresh = self.current and (time.time() - self.current["fetched_at"]) < min_age
+            if fresh or self.refreshing:
+                return
+            self.refreshing = True
+        try:
+            creds, error = self.credentials()
+            if not creds:
+                with self.lock: self.error = error
+                return False
+            client = twilio_client(*creds)
+            balance = BREAKERS["Twilio"].call(client.api.v2010.balance.fetch)
+            now = datetime.now(TZ)
+            with self.lock:
+                self.current = {"balance": balance.balance, "currency": balance.currency,
+                                "last_updated": now.strftime("%H:%M:%S"), "fetched_at": time.time()}
+                self.error = None
+                try:
+                    self.series.append((now, float(balance.balance), self.sms_since_sample))
+                    self.sms_since_sample = 0
+                except (TypeError, ValueError):
+                    pass
+            return True
+        except Exception as e:
+            with self.lock: self.error = _twilio_error_text(e)
+            return False
+        finally:
+            with self.lock: self.refreshing = False
+
+    def _refresh_async(self):
+        with self.lock:
+            if self.refreshing: return
+        threading.Thread(target=self.refresh, kwargs={"min_age": self.ttl / 2},
+                         name="twilio-balance", daemon=True).start()
+
+    def get(self, wait=False):
+        """(daten, fehler) sofort aus dem Cache; wait=True lädt synchron neu"""
+        if wait:
+            self.refresh()
         else:
-            return None, f"API-Fehler: {error_msg}"
+            with self.lock:
+                stale = not self.current or (time.time() - self.current["fetched_at"]) >= self.ttl
+            if stale and self.credentials()[0]:
+                self._refresh_async()
+        with self.lock:
+            if self.current:
+                return dict(self.current, stale=(time.time() - self.current["fetched_at"]) >= self.ttl), self.error
+            return None, self.error or ("Balance wird geladen..." if self.credentials()[0] else self.credentials()[1])
+
+    def burn_rate(self):
+        """Verbrauch pro Tag (nur Abbuchungen, Aufladungen ignoriert) und Kosten pro SMS"""
+        with self.lock:
+            points = list(self.series)
+        if len(points) < 2: return None
+        spent = sum(max(a[1] - b[1], 0) for a, b in zip(points, points[1:]))
+        sms = sum(p[2] for p in points[1:])
+        hours = (points[-1][0] - points[0][0]).total_seconds() / 3600
+        if hours <= 0: return None
+        per_day = spent / hours * 24
+        return {"per_day": per_day, "per_sms": (spent / sms) if sms else None, "sms": sms, "hours": hours,
+                "days_left": (points[-1][1] / per_day) if per_day > 0 else None}
+
+    def history(self):
+        with self.lock:
+            return [{"zeit": t, "balance": b, "sms": n} for t, b, n in self.series]
+
+@st.cache_resource(show_spinner=False)
+def _balance_monitor():
+    return TwilioBalanceMonitor()
+
+BALANCE_MONITOR = _balance_monitor()
+
+def get_twilio_balance(wait=False):
+    """Twilio-Balance aus dem prozessweiten Monitor: (daten, fehler)"""
+    return BALANCE_MONITOR.get(wait=wait)
 
 # ===== Dienste (nur aktivierbar, wenn nicht SAFE_MODE) =====
 class TwilioSMS:
@@ -762,19 +2611,24 @@ class TwilioSMS:
             sid = st.secrets.get("TWILIO_ACCOUNT_SID","")
             token = st.secrets.get("TWILIO_AUTH_TOKEN","")
             from_number = st.secrets.get("TWILIO_PHONE_NUMBER","")
-            self.client = Client(sid, token) if (sid and token) else None
+            self.client = twilio_client(sid, token) if (sid and token) else None
             self.from_number = from_number
             self.enabled = bool(self.client and self.from_number and str(st.secrets.get("ENABLE_SMS","false")).lower()=="true")
         except Exception:
+            logger.exception("Twilio-Client konnte nicht initialisiert werden, SMS deaktiviert")
             self.client = None
             self.enabled = False
             
     def send(self,to,text):
         if not self.enabled: return False,"SMS disabled"
+        t0 = time.perf_counter()
         try:
-            msg = self.client.messages.create(body=text, from_=self.from_number, to=to)
+            msg = BREAKERS["Twilio"].call(self.client.messages.create, body=text, from_=self.from_number, to=to)
+            BALANCE_MONITOR.record_sms()
+            METRICS.notification("sms", t0, "ok")
             return True, msg.sid
         except Exception as e:
+            METRICS.notification("sms", t0, "circuit_open" if isinstance(e, CircuitOpenError) else "error")
             return False, str(e)
 
 class Mailer:
@@ -788,6 +2642,7 @@ class Mailer:
     
     def send(self,to,subject,body,attachments=None):
         if not self.enabled: return False,"mail disabled"
+        t0 = time.perf_counter()
         try:
             msg = MIMEMultipart()
             msg["From"]=f"{self.from_name} <{self.user}>"
@@ -803,13 +2658,20 @@ class Mailer:
                 part.add_header("Content-Disposition", f'attachment; filename="{att["filename"]}"')
                 msg.attach(part)
             
-            with smtplib.SMTP("smtp.gmail.com",587) as s:
-                s.starttls()
-                s.login(self.user,self.pw)
-                s.send_message(msg)
+            BREAKERS["SMTP"].call(self._deliver, msg)
+            METRICS.notification("email", t0, "ok")
             return True,"OK"
         except Exception as e:
+            METRICS.notification("email", t0, "circuit_open" if isinstance(e, CircuitOpenError) else "error")
             return False,str(e)
+    
+    def _deliver(self, msg):
+        # Connect-Timeout für den Verbindungsaufbau, danach Read-Timeout pro Socket-Operation
+        with smtplib.SMTP("smtp.gmail.com", 587, timeout=SMTP_CONNECT_TIMEOUT) as s:
+            s.sock.settimeout(SMTP_READ_TIMEOUT)
+            s.starttls()
+            s.login(self.user,self.pw)
+            s.send_message(msg)
 
 # ===== Template-System =====
 def format_template(template_key, db, **kwargs):
@@ -820,133 +2682,1291 @@ def format_template(template_key, db, **kwargs):
     return template.replace("\\n", "\n")
 
 # ===== Benachrichtigungsfunktionen =====
-def _send_booking_confirmation(user, slot, booking_date):
+def _send_booking_confirmation(user, slot, booking_date, svc=None):
     """Sendet Buchungs-Bestätigung mit iCal"""
-    message = format_template("booking_confirmation", st.session_state.db,
+    svc = svc or st.session_state
+    message = format_template("booking_confirmation", svc.db,
                              USER=user["name"], DATUM=fmt_de(booking_date),
-                             SCHICHT=slot["day_name"], ZEIT=f"{slot['start']}-{slot['end']}")
+                             SCHICHT=slot.day_name, ZEIT=slot.time_range)
     
     # E-Mail mit iCal
-    if st.session_state.mail.enabled and user.get("email_opt_in", True):
-        ics_content = generate_ics(slot, booking_date, user["name"], user["email"])
-        st.session_state.mail.send(user["email"], "Schicht bestätigt", message,
-                                 [{"filename": f"schicht_{slot['day']}_{booking_date}.ics", "content": ics_content}])
+    if svc.mail.enabled and user.get("email_opt_in", True):
+        ics_content = generate_ics(slot, booking_date, user["name"], user["email"],
+                                   sequence=svc.db.ics_sequence(slot.id, booking_date))
+        svc.mail.send(user["email"], "Schicht bestätigt", message,
+                      [{"filename": f"schicht_{slot.day}_{booking_date}.ics", "content": ics_content}])
     
     # SMS
-    if st.session_state.sms.enabled and user.get("sms_opt_in", True):
-        st.session_state.sms.send(user["phone"], message)
+    if svc.sms.enabled and user.get("sms_opt_in", True):
+        svc.sms.send(user["phone"], message)
 
-def _send_cancellation_confirmation(user, slot, booking_date):
+def _send_cancellation_confirmation(user, slot, booking_date, svc=None):
     """Sendet Storno-Bestätigung mit iCal-Cancel"""
-    message = format_template("cancellation_confirmation", st.session_state.db,
+    svc = svc or st.session_state
+    message = format_template("cancellation_confirmation", svc.db,
                              USER=user["name"], DATUM=fmt_de(booking_date),
-                             SCHICHT=slot["day_name"], ZEIT=f"{slot['start']}-{slot['end']}")
+                             SCHICHT=slot.day_name, ZEIT=slot.time_range)
     
     # E-Mail mit Cancel-iCal
-    if st.session_state.mail.enabled and user.get("email_opt_in", True):
-        ics_cancel = generate_ics(slot, booking_date, user["name"], user["email"], action="CANCEL")
-        st.session_state.mail.send(user["email"], "Schicht storniert", message,
-                                 [{"filename": f"storno_{slot['day']}_{booking_date}.ics", "content": ics_cancel}])
+    if svc.mail.enabled and user.get("email_opt_in", True):
+        ics_cancel = generate_ics(slot, booking_date, user["name"], user["email"], action="CANCEL",
+                                  sequence=svc.db.ics_sequence(slot.id, booking_date))
+        svc.mail.send(user["email"], "Schicht storniert", message,
+                      [{"filename": f"storno_{slot.day}_{booking_date}.ics", "content": ics_cancel}])
     
     # SMS
-    if st.session_state.sms.enabled and user.get("sms_opt_in", True):
-        st.session_state.sms.send(user["phone"], message)
+    if svc.sms.enabled and user.get("sms_opt_in", True):
+        svc.sms.send(user["phone"], message)
+
+def _notify_admins(svc, subject, message, slot, booking_date):
+    """Admin-Benachrichtigung: sofort, wenn dringend oder Digest aus, sonst in den Digest"""
+    if not svc.mail.enabled: return
+    start = TZ.localize(datetime.combine(date.fromisoformat(booking_date), slot.start_time))
+    urgent = start - datetime.now(TZ) < timedelta(hours=ADMIN_URGENT_HOURS)
+    if ADMIN_DIGEST_MINUTES > 0 and not urgent:
+        ADMIN_DIGEST.add(svc, subject, message)
+        return
+    
+    # E-Mail an Admins
+    for admin_email in svc.db.get_admin_users():
+        svc.mail.send(admin_email, subject, message)
+
+def _notify_admins_cancellation(user, slot, booking_date, svc=None):
+    """Benachrichtigt Admins über Stornierung"""
+    svc = svc or st.session_state
+    message = format_template("admin_cancellation_notification", svc.db,
+                             USER=user["name"], DATUM=fmt_de(booking_date), 
+                             SCHICHT=slot.day_name, ZEIT=slot.time_range)
+    _notify_admins(svc, "Schicht storniert", message, slot, booking_date)
+
+def _notify_admins_rebooking(old_user, new_user, slot, booking_date, svc=None):
+    """Benachrichtigt Admins über Umbuchung"""
+    svc = svc or st.session_state
+    message = format_template("admin_rebooking_notification", svc.db,
+                             OLD_USER=old_user["user_name"], NEW_USER=new_user["name"],
+                             DATUM=fmt_de(booking_date), SCHICHT=slot.day_name, 
+                             ZEIT=slot.time_range)
+    _notify_admins(svc, "Schicht umgebucht", message, slot, booking_date)
+
+class AdminDigest:
+    """Sammelt nicht dringende Admin-Ereignisse und versendet pro Intervall eine Zusammenfassung je Admin.
+
+    Die Ereignisse liegen in admin_digest_queue (überstehen Neustarts); ein Timer
+    pro Intervall wird beim ersten Ereignis gestellt und verschickt dann alles
+    Offene in einer Mail pro Admin.
+    """
+
+    def __init__(self, minutes):
+        self.interval = minutes * 60
+        self.lock = threading.Lock()
+        self.timer = None
+        self.svc = None
+
+    def add(self, svc, subject, message):
+        svc.db.queue_admin_event(subject, message)
+        self.ensure_timer(svc)
+
+    def ensure_timer(self, svc, delay=None):
+        with self.lock:
+            self.svc = self.svc or Services(svc.db, svc.mail, svc.sms)
+            if self.timer: return
+            self.timer = threading.Timer(self.interval if delay is None else delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def resume(self, svc):
+        """Nach Neustart: offene Ereignisse spätestens nach einem Intervall versenden"""
+        if self.interval <= 0: return
+        count, oldest = svc.db.pending_admin_events()
+        if not count: return
+        created = datetime.strptime(oldest, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+        age = (datetime.now(timezone.utc) - created).total_seconds()
+        self.ensure_timer(svc, delay=max(self.interval - age, 0))
+
+    def flush(self):
+        """Läuft im Timer-Thread: bei Fehlern werden die Ereignisse freigegeben und der Timer neu gestellt"""
+        with self.lock:
+            self.timer = None
+            svc = self.svc
+        events, retry = [], True
+        try:
+            events = svc.db.take_admin_events()
+            if not events:
+                retry = False; return
+            
+            body = f"Zusammenfassung: {len(events)} Änderung(en) seit der letzten Benachrichtigung\n\n"
+            body += "\n\n".join(f"— {e['subject']} ({e['created_at'][11:16]} UTC) —\n{e['message']}" for e in events)
+            subject = f"[Dienstplan+] {len(events)} Änderung(en): " + ", ".join(sorted({e['subject'] for e in events}))
+            results = [svc.mail.send(admin_email, subject, body)[0] for admin_email in svc.db.get_admin_users()]
+            # Kein Admin erreichbar (z.B. SMTP-Circuit offen): später erneut versuchen
+            retry = bool(results) and not any(results)
+        except Exception:
+            logger.exception("Admin-Zusammenfassung fehlgeschlagen")
+        finally:
+            if retry:
+                try:
+                    if events: svc.db.release_admin_events(e["id"] for e in events)
+                except Exception:
+                    logger.exception("Admin-Ereignisse konnten nicht freigegeben werden")
+                self.ensure_timer(svc)
+
+@st.cache_resource(show_spinner=False)
+def _admin_digest():
+    return AdminDigest(ADMIN_DIGEST_MINUTES)
+
+ADMIN_DIGEST = _admin_digest()
+
+def _send_rebooking_confirmation(new_user, slot, booking_date, svc=None):
+    """Sendet Bestätigung an neuen Nutzer bei Umbuchung"""
+    svc = svc or st.session_state
+    message = format_template("rebooking_confirmation", svc.db,
+                             USER=new_user["name"], DATUM=fmt_de(booking_date),
+                             SCHICHT=slot.day_name, ZEIT=slot.time_range)
+    
+    if svc.mail.enabled and new_user.get("email_opt_in", True):
+        ics_content = generate_ics(slot, booking_date, new_user["name"], new_user["email"],
+                                   sequence=svc.db.ics_sequence(slot.id, booking_date))
+        svc.mail.send(new_user["email"], "Neue Schicht zugeteilt", message,
+                      [{"filename": f"neue_schicht_{slot.day}_{booking_date}.ics", "content": ics_content}])
+    
+    if svc.sms.enabled and new_user.get("sms_opt_in", True):
+        svc.sms.send(new_user["phone"], message)
+
+def _send_series_confirmation(user, booked, svc=None):
+    """Eine Sammelbestätigung (E-Mail mit Mehrfach-iCal, eine SMS) für eine Serienbuchung"""
+    svc = svc or st.session_state
+    registry = active_slots()
+    entries = [(registry.get(b["slot_id"]), b["date"]) for b in booked]
+    entries = [(slot, d) for slot, d in entries if slot]
+    if not entries: return
+    termine = "\n".join(f"- {slot.day_name}, {fmt_de(d)}, {slot.time_range}" for slot, d in entries)
+    message = format_template("series_booking_confirmation", svc.db,
+                             USER=user["name"], ANZAHL=len(entries), TERMINE=termine)
+    
+    # E-Mail mit allen Terminen in einer iCal-Datei
+    if svc.mail.enabled and user.get("email_opt_in", True):
+        sequences = svc.db.ics_sequences([(slot.id, d) for slot, d in entries])
+        ics_content = generate_ics_feed([(slot, d, user["name"], user["email"], sequences.get((slot.id, d), 0), None)
+                                         for slot, d in entries], "Dienstplan+ – Serienbuchung")
+        svc.mail.send(user["email"], f"{len(entries)} Schichten bestätigt", message,
+                      [{"filename": f"serie_{entries[0][1]}_{entries[-1][1]}.ics", "content": ics_content}])
+    
+    # SMS (kurz, ohne Terminliste)
+    if svc.sms.enabled and user.get("sms_opt_in", True):
+        svc.sms.send(user["phone"], f"{len(entries)} Schichten gebucht ({fmt_de(entries[0][1])} – {fmt_de(entries[-1][1])}).")
+
+def book_series(user, items, svc=None, actor_id=None):
+    """Serienbuchung inkl. Sammelbestätigung und einem Audit-Eintrag"""
+    svc = svc or st.session_state
+    result = svc.db.create_bookings(user["id"], items)
+    if result["booked"]:
+        _send_series_confirmation(user, result["booked"], svc=svc)
+        svc.db.log(actor_id or user["id"], "series_booked",
+                   f"user_id={user['id']}, booked={len(result['booked'])}, conflicts={len(result['conflicts'])}")
+    return result
+
+# ===== Nutzer-Import/Export (CSV) =====
+USER_CSV_COLUMNS = ("email", "name", "phone", "role", "password", "sms_opt_in", "email_opt_in", "active")
+USER_CSV_ALIASES = {"e-mail": "email", "mail": "email", "telefon": "phone", "handy": "phone",
+                    "rolle": "role", "passwort": "password", "sms": "sms_opt_in", "aktiv": "active"}
+EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+def _csv_bool(value, default=True):
+    value = (value or "").strip().lower()
+    if not value: return default
+    if value in ("1", "true", "ja", "yes", "x", "j", "y"): return True
+    if value in ("0", "false", "nein", "no", "n"): return False
+    raise ValueError(f"Ungültiger Wahrheitswert '{value}'")
+
+def _parse_user_row(raw):
+    """Validiert eine CSV-Zeile; liefert Nutzer-Dict ohne Hash oder wirft ValueError"""
+    row = {USER_CSV_ALIASES.get(k, k): (v or "").strip() for k, v in raw.items() if k}
+    email = row.get("email", "").lower()
+    if not EMAIL_RE.match(email): raise ValueError("E-Mail ungültig")
+    if not row.get("name"): raise ValueError("Name fehlt")
+    role = (row.get("role") or "user").lower()
+    if role not in ("user", "admin"): raise ValueError(f"Unbekannte Rolle '{role}'")
+    password = row.get("password", "")
+    if password and len(password) < 6: raise ValueError("Passwort min. 6 Zeichen")
+    return dict(email=email, name=row["name"], phone=row.get("phone", ""), role=role, password=password,
+                sms_opt_in=_csv_bool(row.get("sms_opt_in")), email_opt_in=_csv_bool(row.get("email_opt_in")),
+                active=_csv_bool(row.get("active")))
+
+def open_csv_upload(fileobj):
+    """Textstrom für eine hochgeladene CSV: UTF-8 (mit/ohne BOM), sonst cp1252 (Excel-Export)"""
+    raw = fileobj.getvalue()
+    try:
+        raw.decode("utf-8")
+        encoding = "utf-8-sig"
+    except UnicodeDecodeError:
+        encoding = "cp1252"
+    return io.TextIOWrapper(io.BytesIO(raw), encoding=encoding, errors="replace", newline="")
+
+def import_users_csv(db: DB, stream, chunk_size=250):
+    """Streamender Nutzer-Import.
+
+    Liest die CSV zeilenweise (Trennzeichen , ; oder Tab), validiert jede Zeile,
+    prüft E-Mail-Duplikate pro Block mit einer Abfrage, hasht Passwörter parallel
+    im Auth-Pool und legt jeden Block in einer Transaktion an. Fehlt ein Passwort,
+    wird ein temporäres erzeugt und im Bericht ausgegeben.
+    """
+    head = stream.readline()
+    if not head.strip():
+        return {"created": 0, "errors": [{"line": 1, "email": "", "error": "Datei ist leer"}], "passwords": []}
+    try:
+        dialect = csv.Sniffer().sniff(head, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    fields = [f.strip().lower() for f in next(csv.reader([head], dialect))]
+    fields = [USER_CSV_ALIASES.get(f, f) for f in fields]
+    if "email" not in fields or "name" not in fields:
+        return {"created": 0, "errors": [{"line": 1, "email": "", "error": "Spalten 'email' und 'name' erforderlich"}],
+                "passwords": []}
+    
+    report = {"created": 0, "errors": [], "passwords": []}
+    seen = set()
+    
+    def flush(chunk):
+        if not chunk: return
+        taken = db.existing_emails(r["email"] for _, r in chunk)
+        fresh = []
+        for line, r in chunk:
+            if r["email"] in taken: report["errors"].append({"line": line, "email": r["email"], "error": "E-Mail bereits registriert"})
+            else: fresh.append((line, r))
+        if not fresh: return
+        generated = {}
+        for _, r in fresh:
+            if not r["password"]:
+                r["password"] = generated[r["email"]] = secrets.token_urlsafe(9)
+        try:
+            hashes = AUTH.hash_many([r.pop("password") for _, r in fresh])
+        except TimeoutError:
+            # Auth-Pool ausgelastet: Block überspringen, bereits importierte Blöcke bleiben im Bericht
+            report["errors"] += [{"line": line, "email": r["email"], "error": AUTH.BUSY} for line, r in fresh]
+            return
+        for (_, r), h in zip(fresh, hashes):
+            r["password_hash"] = h
+        try:
+            created, error = set(db.import_users([r for _, r in fresh])), "E-Mail bereits registriert"
+        except sqlite3.IntegrityError as e:
+            created, error = set(), f"Block nicht importiert: {e}"
+        report["created"] += len(created)
+        for line, r in fresh:
+            if r["email"] not in created:
+                report["errors"].append({"line": line, "email": r["email"], "error": error})
+            elif r["email"] in generated:
+                report["passwords"].append({"email": r["email"], "password": generated[r["email"]]})
+    
+    chunk = []
+    reader = csv.DictReader(stream, fieldnames=fields, dialect=dialect)
+    for raw in reader:
+        line = reader.line_num + 1  # +1 für die vorab gelesene Kopfzeile; bei mehrzeiligen Feldern die letzte Zeile
+        if not any((v or "").strip() for v in raw.values() if isinstance(v, str)): continue
+        try:
+            r = _parse_user_row(raw)
+            if r["email"] in seen: raise ValueError("E-Mail doppelt in der Datei")
+        except ValueError as e:
+            report["errors"].append({"line": line, "email": (raw.get("email") or "").strip(), "error": str(e)})
+            continue
+        seen.add(r["email"])
+        chunk.append((line, r))
+        if len(chunk) >= chunk_size:
+            flush(chunk); chunk = []
+    flush(chunk)
+    report["errors"].sort(key=lambda e: e["line"])
+    return report
+
+def export_users_csv(db: DB):
+    """Streamender Nutzer-Export (Generator über CSV-Textblöcke, Spalten wie beim Import)"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["id", "email", "name", "phone", "role", "sms_opt_in", "email_opt_in", "active", "created_at"])
+    for rows in db.iter_users():
+        writer.writerows((r[0], r[1], r[3], r[2], r[4], int(bool(r[5])), int(bool(r[6])), int(bool(r[7])), r[8])
+                         for r in rows)
+        yield buf.getvalue()
+        buf.seek(0); buf.truncate()
+    if buf.tell(): yield buf.getvalue()
+
+# ===== Automatische Zuteilung (Solver) =====
+_FORBIDDEN = 1e9
+
+def _lsa_numpy(cost):
+    """Hungarian-Verfahren (kürzeste augmentierende Pfade, O(n²·m)) für n <= m.
+
+    Fallback für scipy.optimize.linear_sum_assignment; die innere Schleife über
+    die Spalten ist vektorisiert. Rückgabe wie scipy: (zeilen, spalten).
+    """
+    n, m = cost.shape
+    u, v = np.zeros(n + 1), np.zeros(m + 1)
+    p, way = np.zeros(m + 1, dtype=np.int64), np.zeros(m + 1, dtype=np.int64)
+    for i in range(1, n + 1):
+        p[0], j0 = i, 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while p[j0] != 0:
+            used[j0] = True
+            i0 = p[j0]
+            cur = cost[i0 - 1] - u[i0] - v[1:]
+            free = ~used[1:]
+            better = free & (cur < minv[1:])
+            minv[1:][better] = cur[better]
+            way[1:][better] = j0
+            masked = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(masked)) + 1
+            delta = masked[j1 - 1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[~used] -= delta
+            j0 = j1
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    cols = np.nonzero(p[1:])[0]
+    rows = p[1:][cols] - 1
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+def solve_assignment(cost):
+    """Minimale Zuordnung Zeilen→Spalten; nimmt scipy, falls installiert"""
+    n, m = cost.shape
+    if n == 0 or m == 0: return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    if linear_sum_assignment is not None: return linear_sum_assignment(cost)
+    if n <= m: return _lsa_numpy(cost)
+    cols, rows = _lsa_numpy(cost.T)
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+def propose_assignment(db, start, end, max_per_week=ASSIGN_MAX_PER_WEEK, load_weight=ASSIGN_LOAD_WEIGHT):
+    """Fairer Zuteilungsvorschlag für alle freien Slots zwischen start und end (ISO-Daten).
+
+    Pro Woche wird eine Kostenmatrix (offene Slots × Nutzer-Kopien) vektorisiert
+    aufgebaut und optimal zugeordnet: Präferenz "gern" kostet 0, "möglich" 1,
+    "nicht verfügbar", Sperr- und belegte Tage sind ausgeschlossen. Dazu kommt
+    die bisherige Last (Buchungen der letzten ASSIGN_LOAD_DAYS plus bereits
+    vergebene Schichten des Vorschlags), sodass Schichten reihum verteilt werden.
+    Rückgabe: {"assignments": [...], "unassigned": [...]}
+    """
+    today = date.today().strftime("%Y-%m-%d")
+    start = max(start, today)
+    since = (date.fromisoformat(start) - timedelta(days=ASSIGN_LOAD_DAYS)).strftime("%Y-%m-%d")
+    users, prefs, bookings = db.assignment_inputs(since, end)
+    slots = list(active_slots())
+    if not users or not slots: return {"assignments": [], "unassigned": []}
+    
+    uids = np.array([u[0] for u in users], dtype=np.int64)
+    names = [u[1] for u in users]
+    slot_ids = np.array([s.id for s in slots], dtype=np.int64)
+    U = len(uids)
+    
+    # Präferenzmatrix (Nutzer × Slot), Standard 1 = möglich
+    pref = np.ones((U, len(slots)), dtype=np.int8)
+    if len(prefs):
+        lut = np.full(max(slot_ids.max(), prefs[:, 1].max()) + 1, -1)
+        lut[slot_ids] = np.arange(len(slots))
+        ui, si = np.searchsorted(uids, prefs[:, 0]), lut[prefs[:, 1]]
+        known = si >= 0  # Präferenzen für entfernte Slots ignorieren
+        pref[ui[known], si[known]] = prefs[known, 2]
+    base = np.where(pref == 0, _FORBIDDEN, np.where(pref >= 2, 0.0, 1.0))
+    
+    # Bisherige Last und Buchungen pro Woche/Tag
+    load = np.zeros(U)
+    per_week, per_day, taken = {}, {}, set()
+    for uid, sid, d in bookings:
+        taken.add((sid, d))
+        k = np.searchsorted(uids, uid)
+        if k >= U or uids[k] != uid: continue
+        if d <= end: load[k] += 1
+        ws = week_start(date.fromisoformat(d))
+        per_week.setdefault(ws, np.zeros(U, dtype=np.int64))[k] += 1
+        per_day.setdefault(d, []).append(k)
+    
+    slot_pos = {s.id: i for i, s in enumerate(slots)}
+    copies = np.arange(max_per_week)
+    assignments, unassigned = [], []
+    ws = week_start(date.fromisoformat(start))
+    while ws.strftime("%Y-%m-%d") <= end:
+        shifts = [(s, s.date_in_week(ws)) for s in slots]
+        shifts = [(s, d) for s, d in shifts
+                  if start <= d <= end and not is_blocked_date(d) and (s.id, d) not in taken]
+        ws_next = ws + timedelta(days=7)
+        # Mehrere Slots am selben Tag: pro Durchgang höchstens einer je Datum, damit der
+        # Tagesausschluss (per_day) auch zwischen ihnen greift
+        by_date = {}
+        for s, d in shifts:
+            by_date.setdefault(d, []).append((s, d))
+        passes = [[g[i] for g in by_date.values() if i < len(g)]
+                  for i in range(max(map(len, by_date.values()), default=0))]
+        week_count = per_week.setdefault(ws, np.zeros(U, dtype=np.int64))
+        for shifts in passes:
+            # Kosten (offene Slots × Nutzer-Kopien): Kopie k = (k+1)-te Schicht dieser Woche
+            remaining = max_per_week - week_count
+            cost = base[:, [slot_pos[s.id] for s, _ in shifts]].T                     # R × U
+            cost = cost[:, None, :] + load_weight * (load[None, :] + copies[:, None])[None, :, :]
+            cost = np.where((copies[:, None] < remaining[None, :])[None, :, :], cost, _FORBIDDEN)
+            for r, (_, d) in enumerate(shifts):
+                if d in per_day: cost[r, :, per_day[d]] = _FORBIDDEN
+            cost = cost.reshape(len(shifts), -1)
+            
+            rows, cols = solve_assignment(cost)
+            ok = cost[rows, cols] < _FORBIDDEN
+            done = set()
+            for r, col in zip(rows[ok], cols[ok]):
+                k = int(col % U)
+                slot, d = shifts[r]
+                assignments.append(dict(slot_id=slot.id, date=d, user_id=int(uids[k]), user_name=names[k],
+                                        preference=int(pref[k, slot_pos[slot.id]]), load=int(load[k])))
+                load[k] += 1
+                week_count[k] += 1
+                per_day.setdefault(d, []).append(k)
+                done.add(r)
+            unassigned += [dict(slot_id=s.id, date=d) for r, (s, d) in enumerate(shifts) if r not in done]
+        ws = ws_next
+    return {"assignments": assignments, "unassigned": unassigned, "max_per_week": max_per_week}
+
+def apply_assignment(assignments, svc=None, actor_id=None, max_per_week=ASSIGN_MAX_PER_WEEK):
+    """Bucht einen Vorschlag in einer Transaktion und schickt jedem Nutzer eine Sammelbestätigung"""
+    svc = svc or st.session_state
+    result = svc.db.apply_assignment([(a["user_id"], a["slot_id"], a["date"]) for a in assignments], max_per_week)
+    by_user = {}
+    for b in result["booked"]:
+        by_user.setdefault(b["user_id"], []).append(b)
+    for uid, booked in by_user.items():
+        user = svc.db.get_user_by_id(uid)
+        if user: _send_series_confirmation(user, booked, svc=svc)
+    if result["booked"]:
+        svc.db.log(actor_id, "auto_assigned",
+                   f"booked={len(result['booked'])}, users={len(by_user)}, conflicts={len(result['conflicts'])}")
+    return result
+
+# ===== Backup + Scheduler =====
+def _write_backup_zip(db: DB, fileobj):
+    """Schreibt das Backup-ZIP tabellenweise in fileobj (gleiches JSON-Format wie export_full_backup)"""
+    with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED) as z:
+        with z.open(f"dienstplan_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json", "w") as raw:
+            out = io.TextIOWrapper(raw, encoding="utf-8")
+            out.write('{"version": %s, "created_at": %s, "timezone": %s, "tables": {' % (
+                json.dumps(VERSION), json.dumps(datetime.now().isoformat()), json.dumps(TIMEZONE_STR)))
+            for ti, table in enumerate(BACKUP_TABLES):
+                chunks = db.iter_table(table)
+                out.write("%s%s: {\"columns\": %s, \"rows\": [" % ("," if ti else "", json.dumps(table),
+                                                                   json.dumps(next(chunks))))
+                first = True
+                for rows in chunks:
+                    out.write(("" if first else ",") + ",".join(json.dumps(r, default=str) for r in rows))
+                    first = False
+                out.write("]}")
+            out.write("}}")
+            out.flush()
+            out.detach()
+        z.writestr("README.txt", f"Dienstplan+ v{VERSION} Backup {datetime.now().isoformat()} {TIMEZONE_STR}")
+
+def _send_daily_backup(db: DB, mailer: Mailer):
+    if not mailer.enabled: return False
+    with open(EXPORTS.get(db, "backup"), "rb") as f:
+        zip_bytes = f.read()
+    to = (st.secrets.get("BACKUP_EMAIL","backup@example.com") if hasattr(st,"secrets") else "backup@example.com")
+    ok,_ = mailer.send(to, f"[Dienstplan+] Tägliches Backup - {datetime.now().strftime('%d.%m.%Y')}",
+                       "Automatisches Backup im Anhang.",
+                       [{"filename": f"dienstplan_backup_{datetime.now().strftime('%Y%m%d')}.zip", "content": zip_bytes}])
+    return ok
+
+@st.cache_resource(show_spinner=False)
+def _maintenance_scheduler(_db: DB):
+    """Prozessweiter Scheduler für die DB-Wartung.
+
+    Die Sitzungs-Scheduler werden pro Sitzung angelegt; Wartungsjobs dürfen aber
+    nur einmal pro Prozess laufen (sonst N parallele Bereinigungen).
+    """
+    sched = BackgroundScheduler(timezone=TZ)
+    sched.add_job(timed_job("orphan_sweep", _db.sweep_orphans), CronTrigger(hour=3, minute=30),
+                  id="orphan_sweep", replace_existing=True, max_instances=1)
+    sched.add_job(timed_job("change_feed_prune", _db.prune_change_feed), CronTrigger(hour=3, minute=45),
+                  id="change_feed_prune", replace_existing=True, max_instances=1)
+    sched.add_job(timed_job("db_maintenance", _db.run_maintenance), CronTrigger(hour=4, minute=0),
+                  id="db_maintenance", replace_existing=True, max_instances=1)
+    sched.start()
+    return sched
+
+@st.cache_resource(show_spinner=False)
+def _balance_scheduler():
+    """Prozessweiter Scheduler für den Twilio-Guthabenabruf (ein Job statt einem pro Sitzung)"""
+    sched = BackgroundScheduler(timezone=TZ)
+    sched.add_job(timed_job("twilio_balance", lambda: BALANCE_MONITOR.refresh(min_age=BALANCE_MONITOR.ttl / 2)),
+                  "interval", seconds=BALANCE_MONITOR.ttl, id="twilio_balance",
+                  replace_existing=True, max_instances=1, next_run_time=datetime.now(TZ))
+    sched.start()
+    return sched
+
+def start_scheduler(db: DB, mailer: Mailer, sms: TwilioSMS):
+    if SAFE_MODE or not (ENABLE_DAILY_BACKUP or ENABLE_REMINDER_SMS or ENABLE_DB_MAINTENANCE): return None
+    if ENABLE_REMINDER_SMS:
+        REMINDERS.start(db, sms)
+    if ENABLE_DB_MAINTENANCE:
+        _maintenance_scheduler(db)
+    if BALANCE_MONITOR.credentials()[0]:
+        _balance_scheduler()
+    try:
+        sched = BackgroundScheduler(timezone=TZ)
+        if ENABLE_DAILY_BACKUP:
+            sched.add_job(timed_job("daily_backup", lambda: _send_daily_backup(db, mailer)), CronTrigger(hour=20, minute=0),
+                          id="daily_backup", replace_existing=True, max_instances=1)
+        
+        sched.start()
+        return sched
+    except Exception:
+        return None
+
+class ReminderQueue:
+    """Prozessweite Reminder-Warteschlange mit exakten Fälligkeiten.
+
+    Ein Heap aus (fällig_um, booking_id, typ, generation); ein Timer-Thread schläft
+    bis zum nächsten Eintrag (ohne Einträge unbegrenzt). Buchen/Umbuchen plant neu,
+    Stornieren erhöht nur die Generation, veraltete Einträge werden beim Abholen
+    verworfen. Vor dem Versand wird der Eintrag in reminder_log reserviert, damit
+    jeder Reminder genau einmal rausgeht. Fehlgeschlagene Sendungen werden mit
+    Backoff neu eingeplant, solange die Nachhol-Frist (REMINDER_GRACE) läuft.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap = []
+        self.generation = {}
+        self.attempts = {}  # (booking_id, typ) -> bisherige Fehlversuche
+        self.db = None
+        self.sms = None
+        self.thread = None
+
+    def start(self, db: DB, sms: TwilioSMS):
+        with self.cond:
+            if self.thread: return
+            self.db, self.sms = db, sms
+            self.thread = threading.Thread(target=self._run, name="reminder-queue", daemon=True)
+        self.rebuild()
+        self.thread.start()
+
+    def rebuild(self):
+        """Heap komplett aus der DB aufbauen (Start, Restore)"""
+        if not self.db: return
+        entries, generation = [], {}
+        for b in self.db.pending_reminder_bookings():
+            generation[b["id"]] = 0
+            entries += [(due, b["id"], kind, 0) for due, kind in self._due_times(b["start"])
+                        if kind not in b["sent"]]
+        heapq.heapify(entries)
+        with self.cond:
+            self.heap, self.generation, self.attempts = entries, generation, {}
+            self.cond.notify()
+
+    @staticmethod
+    def _due_times(start):
+        """Fälligkeiten (Unix-Zeit, typ) für einen Schichtbeginn als Unix-Zeit"""
+        now = time.time()
+        return [(start - offset.total_seconds(), kind) for kind, offset in REMINDER_OFFSETS.items()
+                if start > now and start - (offset - REMINDER_GRACE).total_seconds() > now]
+
+    def schedule(self, booking_id, slot_id, booking_date):
+        if not self.thread: return
+        with self.cond:
+            gen = self.generation.get(booking_id, -1) + 1
+            self.generation[booking_id] = gen
+            slot = active_slots().get(slot_id)
+            for due, kind in (self._due_times(shift_start_epoch(slot, booking_date)) if slot else []):
+                heapq.heappush(self.heap, (due, booking_id, kind, gen))
+            self.cond.notify()
+
+    def cancel(self, booking_id):
+        if not self.thread: return
+        with self.cond:
+            self.generation.pop(booking_id, None)
+
+    def stats(self):
+        with self.cond:
+            live = [e for e in self.heap if self.generation.get(e[1]) == e[3]]
+        return {"pending": len(live), "next": datetime.fromtimestamp(min(live)[0], TZ) if live else None}
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    delay = self.heap[0][0] - time.time()
+                    if delay <= 0:
+                        due, booking_id, kind, gen = heapq.heappop(self.heap)
+                        if self.generation.get(booking_id) == gen: break
+                        continue
+                    self.cond.wait(timeout=delay)
+            METRICS.observe("dienstplan_reminder_lag_seconds", max(time.time() - due, 0.0), kind=kind)
+            try:
+                self._fire(booking_id, kind, gen)
+            except Exception:
+                # DB/SMS-Fehler dürfen den Timer-Thread nicht beenden
+                logger.exception("Reminder %s für Buchung %s fehlgeschlagen", kind, booking_id)
+
+    def _retry(self, booking_id, kind, gen, start):
+        """Plant einen fehlgeschlagenen Versand mit Backoff neu ein, solange die Nachhol-Frist läuft"""
+        with self.cond:
+            attempt = self.attempts.get((booking_id, kind), 0)
+            due = time.time() + min(REMINDER_RETRY_SECONDS * 2 ** attempt, REMINDER_RETRY_MAX_SECONDS)
+            deadline = start - (REMINDER_OFFSETS[kind] - REMINDER_GRACE).total_seconds()
+            if due > deadline or self.generation.get(booking_id) != gen:
+                self.attempts.pop((booking_id, kind), None)
+                return
+            self.attempts[(booking_id, kind)] = attempt + 1
+            heapq.heappush(self.heap, (due, booking_id, kind, gen))
+            self.cond.notify()
+
+    def _fire(self, booking_id, kind, gen):
+        target = self.db.reminder_target(booking_id)
+        if not target or not target["active"] or not target["sms_opt_in"] or not self.sms.enabled: return
+        slot = active_slots().get(target["slot_id"])
+        if not slot or not self.db.claim_reminder(booking_id, kind): return
+        message = format_template(
+            f"reminder_{kind}", self.db,
+            USER=target["name"],
+            DATUM=fmt_de(target["date"]),
+            SCHICHT=slot.day_name,
+            ZEIT=slot.time_range
+        )
+        success, _ = self.sms.send(target["phone"], message)
+        self.db.finish_reminder(booking_id, kind, success)
+        if success:
+            with self.cond: self.attempts.pop((booking_id, kind), None)
+            self.db.log(target["user_id"], f"reminder_sent_{kind}", f"SMS reminder sent for {target['date']}")
+        else:
+            self._retry(booking_id, kind, gen, target["start"] or shift_start_epoch(slot, target["date"]))
+
+@st.cache_resource(show_spinner=False)
+def _reminder_queue():
+    return ReminderQueue()
+
+REMINDERS = _reminder_queue()
+METRICS.callback("dienstplan_reminders_pending", lambda: {(): REMINDERS.stats()["pending"]})
+
+# ===== Export-Artefakte (lazy, pro Datenstand) =====
+def _write_csv(fileobj, header, row_chunks):
+    out = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    writer = csv.writer(out)
+    writer.writerow(header)
+    for rows in row_chunks:
+        writer.writerows(rows)
+    out.flush()
+    out.detach()
+
+def _write_free_slots_csv(db: DB, fileobj):
+    free = db.get_free_slots_next_weeks(4)
+    _write_csv(fileobj, ["date", "date_de", "day", "time", "slot_id"],
+               [[(f["date"], f["date_de"], f["day"], f["time"], f["slot_id"]) for f in free]])
+
+def _write_audit_csv(db: DB, fileobj):
+    _write_csv(fileobj, ["timestamp", "user", "action", "details"], db.iter_audit_log())
+
+def _write_users_csv(db: DB, fileobj):
+    out = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    for chunk in export_users_csv(db):
+        out.write(chunk)
+    out.flush()
+    out.detach()
+
+class ExportArtifacts:
+    """Download-Artefakte, erst bei Anforderung erzeugt und als Temp-Datei gecacht.
+
+    Der Cache-Schlüssel ist der Datenstand der beteiligten Tabellen (table_versions,
+    plus Datum/Slot-Konfiguration bei den freien Slots). Pro Art wird nur die
+    jeweils aktuelle Datei behalten; ältere Stände werden gelöscht. Das
+    Temp-Verzeichnis wird beim Prozessende entfernt.
+    """
+    KINDS = {
+        "backup":     (BACKUP_TABLES, _write_backup_zip, ".zip", "application/zip"),
+        "free_slots": (("bookings",), _write_free_slots_csv, ".csv", "text/csv"),
+        "audit":      (("audit_log", "users"), _write_audit_csv, ".csv", "text/csv"),
+        "users":      (("users",), _write_users_csv, ".csv", "text/csv"),
+    }
+
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix="dienstplan-exports-")
+        atexit.register(shutil.rmtree, self.dir, ignore_errors=True)
+        self.lock = threading.Lock()
+        self.kind_locks = {kind: threading.Lock() for kind in self.KINDS}
+        self.files = {}  # kind -> (version, path)
+
+    def version(self, db: DB, kind):
+        tables, *_ = self.KINDS[kind]
+        versions = db.table_versions()
+        key = [db.path, *(versions.get(t, 0) for t in tables)]
+        if kind == "free_slots":
+            key += [date.today().isoformat(), SLOT_CONFIG.raw or ""]
+        return hashlib.sha1(json.dumps(key).encode()).hexdigest()[:16]
+
+    def get(self, db: DB, kind):
+        """Pfad zur aktuellen Datei; baut sie nur, wenn sich der Datenstand geändert hat"""
+        _, writer, suffix, _ = self.KINDS[kind]
+        version = self.version(db, kind)
+        with self.kind_locks[kind]:
+            with self.lock:
+                cached = self.files.get(kind)
+            if cached and cached[0] == version and os.path.exists(cached[1]):
+                return cached[1]
+            
+            path = os.path.join(self.dir, f"{kind}-{version}{suffix}")
+            tmp = path + ".part"
+            t0 = time.perf_counter()
+            with open(tmp, "wb") as f:
+                writer(db, f)
+            os.replace(tmp, path)
+            METRICS.observe("dienstplan_export_seconds", time.perf_counter() - t0, kind=kind)
+            METRICS.set("dienstplan_export_bytes", os.path.getsize(path), kind=kind)
+            with self.lock:
+                old = self.files.get(kind)
+                self.files[kind] = (version, path)
+            if old and old[1] != path:
+                try: os.remove(old[1])
+                except OSError: pass
+            return path
+
+    def mime(self, kind):
+        return self.KINDS[kind][3]
+
+@st.cache_resource(show_spinner=False)
+def _exports():
+    return ExportArtifacts()
+
+EXPORTS = _exports()
+
+# ===== Analytics (spaltenbasiert, pro Datenstand gecacht) =====
+def gini(values):
+    """Gini-Koeffizient einer Lastverteilung (0 = alle gleich, →1 = eine Person trägt alles)"""
+    x = np.sort(np.asarray(values, dtype=float))
+    n, total = len(x), x.sum()
+    if n == 0 or total == 0: return 0.0
+    return float(2 * np.dot(np.arange(1, n + 1), x) / (n * total) - (n + 1) / n)
+
+def _shift_grid(slots, first_week, weeks):
+    """Alle Soll-Schichten (Woche × Slot) als DataFrame inkl. Sperrtag-Markierung"""
+    week_starts = pd.date_range(first_week, periods=weeks, freq="7D")
+    offsets = pd.to_timedelta([s.weekday for s in slots], unit="D")
+    dates = (week_starts.values[:, None] + offsets.values[None, :]).ravel()
+    grid = pd.DataFrame({
+        "week": np.repeat(week_starts.strftime("%Y-%W"), len(slots)),
+        "slot_id": np.tile([s.id for s in slots], weeks),
+        "booking_date": pd.DatetimeIndex(dates).strftime("%Y-%m-%d"),
+    })
+    blocked = {d: is_blocked_date(d) for d in grid["booking_date"].unique()}
+    grid["blocked"] = grid["booking_date"].map(blocked)
+    return grid
+
+def compute_analytics(db, weeks=12):
+    """Abdeckung, Lastverteilung, Storno-/Umbuchungsquoten und Vorlaufzeit in einem Durchgang.
+
+    Die Buchungen werden einmal als DataFrame geladen; alle Kennzahlen sind
+    vektorisierte pandas/NumPy-Operationen darauf. ``weeks`` ist das Fenster
+    (bis einschließlich der laufenden Woche) für Abdeckung, Last und Quoten.
+    """
+    slots = list(active_slots())
+    registry = active_slots()
+    this_week = week_start(date.today())
+    first_week = this_week - timedelta(weeks=weeks - 1)
+    window_start, window_end = first_week.strftime("%Y-%m-%d"), (this_week + timedelta(days=6)).strftime("%Y-%m-%d")
+    bookings, users, events = db.analytics_frames(first_week.strftime("%Y-%m-%d"))
+    labels = {s.id: s.label for s in slots}
+    in_window = bookings[bookings["booking_date"].between(window_start, window_end)]
+    
+    # Abdeckung: Anteil belegter, nicht gesperrter Soll-Schichten je Slot und Woche
+    grid = _shift_grid(slots, first_week, weeks) if slots else pd.DataFrame(
+        columns=["week", "slot_id", "booking_date", "blocked"])
+    grid = grid[~grid["blocked"].astype(bool)]
+    keys = pd.MultiIndex.from_frame(in_window[["slot_id", "booking_date"]])
+    grid["covered"] = pd.MultiIndex.from_frame(grid[["slot_id", "booking_date"]]).isin(keys)
+    coverage = (grid.assign(slot=grid["slot_id"].map(labels))
+                    .pivot_table(index="week", columns="slot", values="covered", aggfunc="mean"))
+    coverage_total = float(grid["covered"].mean()) if len(grid) else None
+    
+    # Last pro aktivem Nutzer im Fenster (inkl. Nutzer ohne Schicht)
+    load = (in_window.groupby("user_id").size()
+                     .reindex(users["id"], fill_value=0).to_numpy())
+    load_stats = dict(users=len(load), mean=float(load.mean()) if len(load) else 0.0,
+                      gini=gini(load), without_shift=int((load == 0).sum()),
+                      **{f"p{q}": float(np.percentile(load, q)) if len(load) else 0.0 for q in (25, 50, 75, 90)},
+                      max=int(load.max()) if len(load) else 0)
+    
+    # Storno- und Umbuchungsquote aus dem Change-Feed (pro Buchung ein Ereignis)
+    events["week"] = pd.to_datetime(events["created_at"]).dt.strftime("%Y-%W")
+    per_week = events.pivot_table(index="week", columns="kind", values="booking_id", aggfunc="count", fill_value=0)
+    per_week = per_week.reindex(columns=["booked", "cancelled", "rebooked"], fill_value=0)
+    counts = per_week.sum()
+    booked_n = max(int(counts["booked"]), 1)
+    rates = dict(booked=int(counts["booked"]), cancelled=int(counts["cancelled"]), rebooked=int(counts["rebooked"]),
+                 cancel_rate=float(counts["cancelled"] / booked_n), rebook_rate=float(counts["rebooked"] / booked_n))
+    
+    # Vorlaufzeit zwischen Buchung (UTC) und Schichtbeginn (lokal)
+    starts = bookings["slot_id"].map({s.id: s.start for s in slots})
+    valid = starts.notna()
+    shift_start = pd.to_datetime(bookings["booking_date"][valid] + " " + starts[valid]).dt.tz_localize(TZ)
+    booked_at = pd.to_datetime(bookings["created_at"][valid]).dt.tz_localize("UTC").dt.tz_convert(TZ)
+    lead_days = ((shift_start - booked_at).dt.total_seconds() / 86400).to_numpy()
+    lead_days = lead_days[lead_days >= 0]
+    lead = dict(median=float(np.median(lead_days)), p10=float(np.percentile(lead_days, 10)),
+                p90=float(np.percentile(lead_days, 90)), short_share=float((lead_days < 2).mean())) if len(lead_days) else None
+    
+    # Bisherige Dashboard-Kennzahlen aus demselben Frame
+    totals = bookings.groupby("user_id").agg(total_bookings=("id", "size"), last_booking=("booking_date", "max"))
+    user_stats = (users.set_index("id").join(totals).fillna({"total_bookings": 0})
+                       .astype({"total_bookings": int})
+                       .sort_values("total_bookings", ascending=False, kind="stable")
+                       [["name", "email", "total_bookings", "last_booking"]].reset_index(drop=True))
+    trend_rows = bookings[bookings["booking_date"] >= (datetime.now() - timedelta(weeks=weeks)).strftime("%Y-%m-%d")]
+    trends = (trend_rows.assign(week=pd.to_datetime(trend_rows["booking_date"]).dt.strftime("%Y-%W"))
+                        .groupby("week").agg(bookings=("id", "size"), unique_users=("user_id", "nunique"))
+                        .reset_index())
+    slot_dist = (bookings[bookings["slot_id"].isin(labels)].groupby("slot_id").size()
+                         .rename("count").reset_index())
+    slot_dist["slot"] = slot_dist["slot_id"].map(lambda sid: registry.get(sid).label)
+    
+    return dict(weeks=weeks, coverage=coverage, coverage_total=coverage_total, load=load_stats,
+                load_hist=pd.Series(load).value_counts().sort_index(), rates=rates, rates_weekly=per_week,
+                lead=lead, user_stats=user_stats, trends=trends, slot_dist=slot_dist[["slot", "count"]])
+
+class BookingAnalytics:
+    """Prozessweiter Cache für compute_analytics, Schlüssel ist der Datenstand.
+
+    Datenstand = Change-Feed-Sequenz, Nutzer-Tabellenversion, Datum und
+    Slot-Konfiguration; solange sich nichts ändert, teilen sich alle Admin-
+    Sitzungen dasselbe Ergebnis.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}  # weeks -> (version, result)
+
+    def version(self, db: DB, weeks):
+        return (db.path, db.current_seq(), db.table_versions().get("users", 0),
+                date.today().isoformat(), SLOT_CONFIG.raw or "", weeks)
+
+    def get(self, db: DB, weeks=12):
+        version = self.version(db, weeks)
+        with self.lock:
+            cached = self.results.get(weeks)
+        if cached and cached[0] == version:
+            return cached[1]
+        result = compute_analytics(db, weeks)
+        with self.lock:
+            self.results[weeks] = (version, result)
+        return result
+
+@st.cache_resource(show_spinner=False)
+def _analytics():
+    return BookingAnalytics()
+
+ANALYTICS = _analytics()
+
+# ===== Kalender-Feed (ICS) =====
+APP_STARTED = datetime.now(timezone.utc).replace(microsecond=0)
+
+class ICSFeed:
+    """Abonnierbare ICS-Feeds pro Nutzer und für den Gesamtplan.
+
+    Die Dokumente werden pro Feed und Datenstand (Change-Feed-Seq + Slot-Konfiguration)
+    gecacht; ETag und Last-Modified leiten sich aus demselben Stand ab, sodass
+    bedingte Anfragen mit einer einzigen Abfrage als 304 beantwortet werden.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    @staticmethod
+    def _secret(db):
+        secret = db.get_setting("ics_feed_secret", "")
+        if not secret:
+            secret = secrets.token_hex(32)
+            db.set_setting("ics_feed_secret", secret)
+        return secret
+
+    def token(self, db, scope):
+        """Signiertes Feed-Token (scope: 'user:<id>' oder 'plan')"""
+        return hmac.new(self._secret(db).encode(), f"ics:{scope}".encode(), hashlib.sha256).hexdigest()[:32]
+
+    def check(self, db, scope, token):
+        return bool(token) and hmac.compare_digest(self.token(db, scope), token)
+
+    def url(self, db, uid=None):
+        if uid is None:
+            return f"{API_PUBLIC_URL}/api/calendar/plan.ics?token={self.token(db, 'plan')}"
+        return f"{API_PUBLIC_URL}/api/calendar/user/{uid}.ics?token={self.token(db, f'user:{uid}')}"
+
+    def version(self, db, uid=None):
+        """(etag, last_modified) ohne das Dokument zu erzeugen.
+
+        Das Datumsfenster verschiebt sich täglich: das Datum gehört daher zum
+        ETag, und Last-Modified ist mindestens der heutige Tagesbeginn.
+        """
+        seq, changed = db.feed_version(uid)
+        slots = hashlib.sha1((SLOT_CONFIG.raw or "").encode()).hexdigest()[:8]
+        today = date.today()
+        etag = f'"{"plan" if uid is None else f"u{uid}"}-{seq}-{slots}-{today:%Y%m%d}"'
+        modified = datetime.strptime(changed, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc) if changed else APP_STARTED
+        day_start = TZ.localize(datetime.combine(today, datetime.min.time())).astimezone(timezone.utc)
+        return etag, max(modified, day_start)
+
+    def document(self, db, etag, uid=None):
+        with self.lock:
+            body = self.cache.get(etag)
+        if body is not None: return body
+        
+        today = date.today()
+        start = (today - timedelta(days=ICS_FEED_PAST_DAYS)).strftime("%Y-%m-%d")
+        end = (today + timedelta(days=ICS_FEED_FUTURE_DAYS)).strftime("%Y-%m-%d")
+        events = []
+        for r in db.ics_feed_rows(start, end, uid):
+            slot = active_slots().get(r["slot_id"])
+            if not slot: continue
+            modified = datetime.strptime(r["modified"], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc) if r["modified"] else None
+            # Der Gesamtplan geht an alle Feed-Inhaber: keine E-Mail-Adressen anderer Mitglieder
+            events.append((slot, r["date"], r["user_name"], r["user_email"] if uid is not None else None,
+                           r["sequence"], modified))
+        body = generate_ics_feed(events, f"Dienstplan+ – {'Meine Schichten' if uid is not None else 'Gesamtplan'}")
+        
+        with self.lock:
+            if len(self.cache) >= self.max_entries:
+                self.cache.pop(next(iter(self.cache)))
+            self.cache[etag] = body
+        return body
+
+@st.cache_resource(show_spinner=False)
+def _ics_feed():
+    return ICSFeed()
+
+ICS_FEED = _ics_feed()
+
+# ===== JSON-API (WSGI) =====
+class Services:
+    """Bündelt DB, Mailer und SMS für Aufrufe außerhalb einer Streamlit-Sitzung"""
+    __slots__ = ("db", "mail", "sms")
+
+    def __init__(self, db, mail, sms):
+        self.db, self.mail, self.sms = db, mail, sms
+
+class APIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+HTTP_STATUS = {200: "200 OK", 201: "201 Created", 204: "204 No Content", 304: "304 Not Modified",
+               400: "400 Bad Request", 401: "401 Unauthorized", 403: "403 Forbidden",
+               404: "404 Not Found", 405: "405 Method Not Allowed", 409: "409 Conflict",
+               500: "500 Internal Server Error", 503: "503 Service Unavailable"}
+
+class BookingAPI:
+    """Schlanke JSON-API für Plan, freie Slots, Buchen, Stornieren und eigene Schichten.
+
+    Nutzt dieselbe DB-Klasse, den prozessweiten Auth-Token-Cache und die
+    Benachrichtigungsfunktionen der Streamlit-App. Authentifizierung per
+    ``Authorization: Bearer <token>`` (Token von ``POST /api/login``).
+    """
+
+    def __init__(self, svc: Services):
+        self.svc = svc
+        self.routes = [
+            ("POST",   re.compile(r"^/api/login$"), self.login),
+            ("POST",   re.compile(r"^/api/logout$"), self.logout),
+            ("GET",    re.compile(r"^/api/week$"), self.week),
+            ("GET",    re.compile(r"^/api/free$"), self.free),
+            ("GET",    re.compile(r"^/api/me/bookings$"), self.my_bookings),
+            ("POST",   re.compile(r"^/api/bookings$"), self.book),
+            ("POST",   re.compile(r"^/api/bookings/series$"), self.book_series),
+            ("DELETE", re.compile(r"^/api/bookings/(\d+)$"), self.cancel),
+            ("GET",    re.compile(r"^/api/admin/users\.csv$"), self.users_csv),
+            ("GET",    re.compile(r"^/api/admin/exports/(backup|free_slots|audit|users)$"), self.export),
+            ("GET",    re.compile(r"^/api/calendar/plan\.ics$"), self.calendar),
+            ("GET",    re.compile(r"^/api/calendar/user/(\d+)\.ics$"), self.calendar),
+        ]
+
+    def __call__(self, environ, start_response):
+        status, headers, body = self.handle(environ)
+        start_response(HTTP_STATUS.get(status, f"{status} Error"), headers)
+        return [body] if isinstance(body, bytes) else body
+
+    def handle(self, environ):
+        method = environ.get("REQUEST_METHOD", "GET")
+        path = environ.get("PATH_INFO", "")
+        req = {"environ": environ, "query": dict(parse_qsl(environ.get("QUERY_STRING", ""))),
+               "headers": {k[5:].replace("_", "-").lower(): v for k, v in environ.items() if k.startswith("HTTP_")}}
+        try:
+            path_match = False
+            for m, pattern, handler in self.routes:
+                match = pattern.match(path)
+                if not match: continue
+                path_match = True
+                if m == method:
+                    return handler(req, *match.groups())
+            raise APIError(405 if path_match else 404, "Methode nicht erlaubt" if path_match else "Nicht gefunden")
+        except APIError as e:
+            return self.json(e.status, {"error": str(e)})
+        except Exception:
+            logger.exception("API-Fehler bei %s %s", method, path)
+            return self.json(500, {"error": "Interner Fehler"})
+
+    # --- Hilfsfunktionen ---
+    @staticmethod
+    def json(status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+        return status, [("Content-Type", "application/json; charset=utf-8"),
+                        ("Content-Length", str(len(body)))] + (headers or []), body
+
+    @staticmethod
+    def body(req):
+        env = req["environ"]
+        try:
+            size = int(env.get("CONTENT_LENGTH") or 0)
+            data = json.loads(env["wsgi.input"].read(size) or b"{}") if size else {}
+        except (ValueError, json.JSONDecodeError):
+            raise APIError(400, "Ungültiges JSON")
+        if not isinstance(data, dict): raise APIError(400, "JSON-Objekt erwartet")
+        return data
+
+    @staticmethod
+    def uid(req):
+        auth = req["headers"].get("authorization", "")
+        uid = AUTH.resolve_token(auth[7:] if auth.lower().startswith("bearer ") else "")
+        if not uid: raise APIError(401, "Token fehlt oder ist abgelaufen")
+        return uid
+
+    def user(self, req):
+        u = self.svc.db.get_user_by_id(self.uid(req))
+        if not u or not u["active"]: raise APIError(401, "Nutzer nicht aktiv")
+        return u
+
+    @staticmethod
+    def slot(value):
+        """Aktiver Slot zu einer ganzzahligen slot_id, sonst 400"""
+        slot = active_slots().get(value) if isinstance(value, int) and not isinstance(value, bool) else None
+        if not slot: raise APIError(400, "Unbekannter Slot")
+        return slot
+
+    @staticmethod
+    def parse_date(value, field="date"):
+        try:
+            return date.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise APIError(400, f"Ungültiges Datum in '{field}' (YYYY-MM-DD)")
+
+    # --- Endpunkte ---
+    def login(self, req):
+        data = self.body(req)
+        try:
+            u = self.svc.db.auth(data.get("email", ""), data.get("password", ""))
+        except TimeoutError as e:
+            raise APIError(503, str(e))
+        if not u: raise APIError(401, "Ungültige Anmeldedaten")
+        self.svc.db.log(u["id"], "login", "api login")
+        return self.json(200, {"token": AUTH.issue_token(u["id"]), "user": u})
+
+    def logout(self, req):
+        self.uid(req)
+        AUTH.revoke(req["headers"]["authorization"][7:])
+        return 204, [], b""
+
+    def week(self, req):
+        uid = self.uid(req)
+        ws = week_start(self.parse_date(req["query"]["start"], "start") if "start" in req["query"] else None)
+        we = ws + timedelta(days=6)
+        cells = self.svc.db.bookings_in_range(ws.strftime("%Y-%m-%d"), we.strftime("%Y-%m-%d"))
+        slots = []
+        for slot in active_slots():
+            d = slot.date_in_week(ws)
+            bookings = cells.get((slot.id, d), [])
+            slots.append({
+                "slot_id": slot.id, "day": slot.day_name, "date": d, "start": slot.start, "end": slot.end,
+                "status": "blocked" if is_blocked_date(d) else ("booked" if bookings else "free"),
+                "blocked_reason": get_block_reason(d),
+                "booked_by": bookings[0]["user_name"] if bookings else None,
+                "booking_id": bookings[0]["id"] if bookings else None,
+                "mine": bool(bookings and bookings[0]["user_id"] == uid),
+            })
+        return self.json(200, {"week_start": ws.isoformat(), "week": ws.isocalendar()[1], "slots": slots})
 
-def _notify_admins_cancellation(user, slot, booking_date):
-    """Benachrichtigt Admins über Stornierung"""
-    admins = st.session_state.db.get_admin_users()
-    message = format_template("admin_cancellation_notification", st.session_state.db,
-                             USER=user["name"], DATUM=fmt_de(booking_date), 
-                             SCHICHT=slot["day_name"], ZEIT=f"{slot['start']}-{slot['end']}")
-    
-    # E-Mail an Admins
-    if st.session_state.mail.enabled:
-        for admin_email in admins:
-            st.session_state.mail.send(admin_email, "Schicht storniert", message)
+    def free(self, req):
+        self.uid(req)
+        try:
+            weeks = min(max(int(req["query"].get("weeks", 4)), 1), 26)
+        except ValueError:
+            raise APIError(400, "'weeks' muss eine Zahl sein")
+        return self.json(200, {"free": self.svc.db.get_free_slots_next_weeks(weeks)})
 
-def _notify_admins_rebooking(old_user, new_user, slot, booking_date):
-    """Benachrichtigt Admins über Umbuchung"""
-    admins = st.session_state.db.get_admin_users()
-    message = format_template("admin_rebooking_notification", st.session_state.db,
-                             OLD_USER=old_user["user_name"], NEW_USER=new_user["name"],
-                             DATUM=fmt_de(booking_date), SCHICHT=slot["day_name"], 
-                             ZEIT=f"{slot['start']}-{slot['end']}")
-    
-    if st.session_state.mail.enabled:
-        for admin_email in admins:
-            st.session_state.mail.send(admin_email, "Schicht umgebucht", message)
+    def my_bookings(self, req):
+        uid = self.uid(req)
+        out = []
+        for b in self.svc.db.user_bookings(uid):
+            slot = active_slots().get(b["slot_id"])
+            out.append(dict(b, day=slot.day_name if slot else None,
+                            start=slot.start if slot else None, end=slot.end if slot else None))
+        return self.json(200, {"bookings": out})
 
-def _send_rebooking_confirmation(new_user, slot, booking_date):
-    """Sendet Bestätigung an neuen Nutzer bei Umbuchung"""
-    message = format_template("rebooking_confirmation", st.session_state.db,
-                             USER=new_user["name"], DATUM=fmt_de(booking_date),
-                             SCHICHT=slot["day_name"], ZEIT=f"{slot['start']}-{slot['end']}")
-    
-    if st.session_state.mail.enabled and new_user.get("email_opt_in", True):
-        ics_content = generate_ics(slot, booking_date, new_user["name"], new_user["email"])
-        st.session_state.mail.send(new_user["email"], "Neue Schicht zugeteilt", message,
-                                 [{"filename": f"neue_schicht_{slot['day']}_{booking_date}.ics", "content": ics_content}])
-    
-    if st.session_state.sms.enabled and new_user.get("sms_opt_in", True):
-        st.session_state.sms.send(new_user["phone"], message)
+    def book(self, req):
+        u = self.user(req)
+        data = self.body(req)
+        slot = self.slot(data.get("slot_id"))
+        d = self.parse_date(data.get("date"))
+        if d.weekday() != slot.weekday: raise APIError(400, f"Slot {slot.id} liegt nicht auf diesem Wochentag")
+        if d < date.today(): raise APIError(400, "Datum liegt in der Vergangenheit")
+        d = d.strftime("%Y-%m-%d")
+        ok, res = self.svc.db.create_booking(u["id"], slot.id, d)
+        if not ok: raise APIError(409, res)
+        _send_booking_confirmation(u, slot, d, svc=self.svc)
+        self.svc.db.log(u["id"], "booking_created", f"api: slot_id={slot.id}, date={d}")
+        return self.json(201, {"booking_id": res, "slot_id": slot.id, "date": d})
 
-# ===== Backup + Scheduler =====
-def _create_backup_zip(db: DB):
-    backup_data = db.export_full_backup()
-    payload = io.BytesIO()
-    with zipfile.ZipFile(payload, "w", zipfile.ZIP_DEFLATED) as z:
-        z.writestr(f"dienstplan_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
-                   json.dumps(backup_data, indent=2, default=str))
-        z.writestr("README.txt", f"Dienstplan+ v{VERSION} Backup {datetime.now().isoformat()} {TIMEZONE_STR}")
-    payload.seek(0)
-    return payload.getvalue()
+    def book_series(self, req):
+        """Serienbuchung: {"items": [{slot_id, date}]} oder {slot_id, from, until, every_weeks};
+        Admins dürfen per "user_id" für andere buchen"""
+        u = self.user(req)
+        data = self.body(req)
+        target = u
+        if data.get("user_id") not in (None, u["id"]):
+            if u["role"] != "admin": raise APIError(403, "Nur Admins buchen für andere")
+            if not isinstance(data["user_id"], int): raise APIError(400, "'user_id' muss eine Zahl sein")
+            target = self.svc.db.get_user_by_id(data["user_id"])
+            if not target or not target["active"]: raise APIError(404, "Nutzer nicht gefunden")
+        if "items" in data:
+            try:
+                items = [(i["slot_id"], i["date"]) for i in data["items"]]
+            except (TypeError, KeyError):
+                raise APIError(400, "'items' erwartet [{slot_id, date}]")
+            if not all(isinstance(sid, int) and not isinstance(sid, bool) for sid, _ in items):
+                raise APIError(400, "'slot_id' muss eine Zahl sein")
+        else:
+            slot = self.slot(data.get("slot_id"))
+            every_weeks = data.get("every_weeks", 1)
+            if not isinstance(every_weeks, int) or isinstance(every_weeks, bool) or every_weeks < 1:
+                raise APIError(400, "'every_weeks' muss eine positive Zahl sein")
+            items = series_dates(slot, self.parse_date(data.get("from"), "from"),
+                                 self.parse_date(data.get("until"), "until"), every_weeks)
+        if not items: raise APIError(400, "Keine Termine angegeben")
+        if len(items) > 500: raise APIError(400, "Maximal 500 Termine pro Serie")
+        result = book_series(target, items, svc=self.svc, actor_id=u["id"])
+        return self.json(201 if result["booked"] else 409, result)
 
-def _send_daily_backup(db: DB, mailer: Mailer):
-    if not mailer.enabled: return False
-    zip_bytes = _create_backup_zip(db)
-    to = (st.secrets.get("BACKUP_EMAIL","backup@example.com") if hasattr(st,"secrets") else "backup@example.com")
-    ok,_ = mailer.send(to, f"[Dienstplan+] Tägliches Backup - {datetime.now().strftime('%d.%m.%Y')}",
-                       "Automatisches Backup im Anhang.",
-                       [{"filename": f"dienstplan_backup_{datetime.now().strftime('%Y%m%d')}.zip", "content": zip_bytes}])
-    return ok
+    def cancel(self, req, booking_id):
+        u = self.user(req)
+        b = self.svc.db.get_booking(int(booking_id))
+        if not b: raise APIError(404, "Buchung nicht gefunden")
+        own = b["user_id"] == u["id"]
+        if not own and u["role"] != "admin": raise APIError(403, "Nur eigene Buchungen stornierbar")
+        if not self.svc.db.cancel_booking(b["id"], u["id"] if own else None):
+            raise APIError(409, "Buchung wurde bereits storniert")
+        slot = active_slots().get(b["slot_id"])
+        owner = u if own else self.svc.db.get_user_by_id(b["user_id"])
+        if slot and owner:
+            _send_cancellation_confirmation(owner, slot, b["date"], svc=self.svc)
+            if own: _notify_admins_cancellation(owner, slot, b["date"], svc=self.svc)
+        self.svc.db.log(u["id"], "booking_cancelled" if own else "admin_cancelled", f"api: booking_id={b['id']}")
+        return 204, [], b""
 
-def start_scheduler(db: DB, mailer: Mailer, sms: TwilioSMS):
-    if SAFE_MODE or not ENABLE_DAILY_BACKUP: return None
-    try:
-        sched = BackgroundScheduler(timezone=TZ)
-        sched.add_job(lambda: _send_daily_backup(db, mailer), CronTrigger(hour=20, minute=0),
-                      id="daily_backup", replace_existing=True, max_instances=1)
-        
-        if ENABLE_REMINDER_SMS:
-            sched.add_job(lambda: _process_reminders(db, sms), CronTrigger(minute="*/15"),
-                          id="reminder_check", replace_existing=True, max_instances=1)
+    def users_csv(self, req):
+        """Nutzer-Export als gestreamte CSV (nur Admins)"""
+        if self.user(req)["role"] != "admin": raise APIError(403, "Nur für Admins")
+        body = (chunk.encode("utf-8") for chunk in export_users_csv(self.svc.db))
+        return 200, [("Content-Type", "text/csv; charset=utf-8"),
+                     ("Content-Disposition", 'attachment; filename="nutzer.csv"')], body
+
+    def export(self, req, kind):
+        """Gecachtes Export-Artefakt, direkt aus der Temp-Datei gestreamt (nur Admins)"""
+        if self.user(req)["role"] != "admin": raise APIError(403, "Nur für Admins")
+        path = EXPORTS.get(self.svc.db, kind)
+        f = open(path, "rb")
+        wrapper = req["environ"].get("wsgi.file_wrapper")
         
-        sched.start()
-        return sched
-    except Exception:
-        return None
+        def stream():
+            with f:
+                yield from iter(lambda: f.read(64 * 1024), b"")
+        body = wrapper(f, 64 * 1024) if wrapper else stream()
+        headers = [("Content-Type", EXPORTS.mime(kind)), ("Content-Length", str(os.path.getsize(path))),
+                   ("Content-Disposition", f'attachment; filename="{os.path.basename(path)}"')]
+        return 200, headers, body
 
-def _process_reminders(db: DB, sms: TwilioSMS):
-    """Verarbeitet fällige Reminder"""
-    if not sms.enabled:
-        return
+    def calendar(self, req, uid=None):
+        """ICS-Feed mit ETag/Last-Modified; Kalender-Clients erhalten bei unverändertem Stand 304"""
+        uid = int(uid) if uid is not None else None
+        scope = "plan" if uid is None else f"user:{uid}"
+        if not ICS_FEED.check(self.svc.db, scope, req["query"].get("token", "")):
+            raise APIError(403, "Ungültiges Feed-Token")
         
-    reminders = db.get_upcoming_shifts_for_reminders()
-    for reminder in reminders:
-        template_key = f"reminder_{reminder['reminder_type']}"
-        message = format_template(
-            template_key, db,
-            USER=reminder["name"],
-            DATUM=fmt_de(reminder["date"]),
-            SCHICHT=reminder["slot"]["day_name"],
-            ZEIT=f"{reminder['slot']['start']}-{reminder['slot']['end']}"
-        )
+        etag, modified = ICS_FEED.version(self.svc.db, uid)
+        headers = [("ETag", etag), ("Last-Modified", email.utils.format_datetime(modified, usegmt=True)),
+                   ("Cache-Control", "private, max-age=60")]
+        inm = req["headers"].get("if-none-match")
+        ims = req["headers"].get("if-modified-since")
+        if inm is not None:
+            not_modified = etag in [t.strip() for t in inm.split(",")] or inm.strip() == "*"
+        else:
+            try:
+                not_modified = bool(ims) and email.utils.parsedate_to_datetime(ims) >= modified
+            except (TypeError, ValueError):
+                not_modified = False
+        if not_modified:
+            return 304, headers, b""
         
-        success, _ = sms.send(reminder["phone"], message)
-        if success:
-            db.log_reminder_sent(reminder["booking_id"], reminder["reminder_type"])
-            db.log(reminder["user_id"], f"reminder_sent_{reminder['reminder_type']}", 
-                   f"SMS reminder sent for {reminder['date']}")
+        body = ICS_FEED.document(self.svc.db, etag, uid)
+        return 200, [("Content-Type", "text/calendar; charset=utf-8"),
+                     ("Content-Length", str(len(body)))] + headers, body
+
+class APIClient:
+    """In-Process-Client: ruft die WSGI-App ohne Netzwerk auf (Tests, Skripte)"""
+
+    def __init__(self, app):
+        self.app = app
+        self.token = None
+
+    def request(self, method, path, payload=None, headers=None):
+        path, _, query = path.partition("?")
+        body = json.dumps(payload).encode() if payload is not None else b""
+        environ = {"REQUEST_METHOD": method, "PATH_INFO": path, "QUERY_STRING": query,
+                   "CONTENT_LENGTH": str(len(body)), "wsgi.input": io.BytesIO(body)}
+        setup_testing_defaults(environ)
+        if self.token: environ["HTTP_AUTHORIZATION"] = f"Bearer {self.token}"
+        for k, v in (headers or {}).items():
+            environ["HTTP_" + k.upper().replace("-", "_")] = v
+        result = {}
+        def start_response(status, response_headers):
+            result["status"] = int(status.split()[0])
+            result["headers"] = dict(response_headers)
+        raw = b"".join(self.app(environ, start_response))
+        is_json = result["headers"].get("Content-Type", "").startswith("application/json")
+        return result["status"], result["headers"], (json.loads(raw) if raw and is_json else raw)
+
+    def login(self, email, password):
+        status, _, data = self.request("POST", "/api/login", {"email": email, "password": password})
+        if status == 200: self.token = data["token"]
+        return status, data
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+def start_api_server(app, host, port, name="dienstplan-api"):
+    """Startet die API in einem Daemon-Thread; liefert den Server (oder None)"""
+    try:
+        server = make_server(host, port, app, server_class=_ThreadingWSGIServer, handler_class=_QuietHandler)
+    except OSError:
+        return None
+    threading.Thread(target=server.serve_forever, name=name, daemon=True).start()
+    return server
+
+@st.cache_resource(show_spinner=False)
+def _api_server():
+    svc = Services(DB(), Mailer(), TwilioSMS())
+    return start_api_server(BookingAPI(svc), API_HOST, API_PORT)
+
+@st.cache_resource(show_spinner=False)
+def _metrics_server():
+    return start_api_server(METRICS.wsgi_app, METRICS_HOST, METRICS_PORT, name="dienstplan-metrics")
 
 # ===== Page Config und Singletons =====
 st.set_page_config(page_title="Dienstplan+ Cloud v5.1", page_icon="📅", layout="wide")
@@ -960,6 +3980,168 @@ if "mail" not in st.session_state: st.session_state.mail = Mailer()
 if "week_start" not in st.session_state: st.session_state.week_start = get_current_week()
 if "view_mode" not in st.session_state: st.session_state.view_mode = "week"
 if "sched" not in st.session_state: st.session_state.sched = None
+if ENABLE_API: _api_server()
+if ENABLE_METRICS:
+    _metrics_server()
+    METRICS.touch_session(getattr(get_script_run_ctx(), "session_id", None))
+if ADMIN_DIGEST_MINUTES > 0 and st.session_state.mail.enabled and not ADMIN_DIGEST.svc:
+    ADMIN_DIGEST.resume(st.session_state)
+
+# ===== UI-Profiler (Entwickler-/Admin-Modus) =====
+class UIProfiler:
+    """Misst die UI-Funktionen eines Reruns: Zeit, erzeugte Widgets, SQL-Statements"""
+
+    def __init__(self, use_cprofile=False):
+        self.entries = []
+        self.depth = 0
+        self.started = time.perf_counter()
+        self.total_ms = 0.0
+        self.profile = cProfile.Profile() if use_cprofile else None
+        self.profile_busy = False
+
+    @staticmethod
+    def _widget_count():
+        ctx = get_script_run_ctx()
+        return len(ctx.widget_ids_this_run) if ctx else 0
+
+    @staticmethod
+    def _sql_count():
+        return getattr(QUERY_STATS.local, "sql_count", 0)
+
+    def start(self):
+        QUERY_STATS.local.sql_count = 0
+        QUERY_STATS.local.trace_sql = True
+        if self.profile:
+            try:
+                self.profile.enable()
+            except ValueError:
+                # Ab Python 3.12 nur ein aktiver Profiler pro Prozess (z.B. Rerun einer anderen
+                # Sitzung): dann nur Zeiten messen
+                self.profile, self.profile_busy = None, True
+
+    def stop(self):
+        if self.profile: self.profile.disable()
+        QUERY_STATS.local.trace_sql = False
+        self.total_ms = (time.perf_counter() - self.started) * 1000
+
+    def measure(self, name, fn, *args, **kwargs):
+        entry = {"function": ("  " * self.depth) + name, "ms": 0.0, "widgets": 0, "sql": 0}
+        self.entries.append(entry)
+        w0, q0, t0 = self._widget_count(), self._sql_count(), time.perf_counter()
+        self.depth += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.depth -= 1
+            entry["ms"] = round((time.perf_counter() - t0) * 1000, 1)
+            entry["widgets"] = self._widget_count() - w0
+            entry["sql"] = self._sql_count() - q0
+
+    def stats_text(self, limit=40):
+        out = io.StringIO()
+        pstats.Stats(self.profile, stream=out).sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+    def dump_bytes(self):
+        with tempfile.NamedTemporaryFile(suffix=".prof") as f:
+            self.profile.dump_stats(f.name)
+            return f.read()
+
+def profile_ui(fn):
+    """Dekorator für Top-Level-UI-Funktionen; misst nur bei aktivem Profiler"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        prof = st.session_state.get("_ui_profiler")
+        if prof is None:
+            return fn(*args, **kwargs)
+        return prof.measure(fn.__name__, fn, *args, **kwargs)
+    return wrapper
+
+def ui_profiler_enabled():
+    u = st.session_state.get("user")
+    return ENABLE_UI_PROFILER or bool(u and u["role"] == "admin" and st.session_state.get("ui_profiler_on"))
+
+def render_profiler_overlay(prof: UIProfiler):
+    """Zeigt die Messung des aktuellen Reruns in der Sidebar"""
+    history = st.session_state.setdefault("ui_profiler_history", deque(maxlen=30))
+    history.append({"rerun": datetime.now().strftime("%H:%M:%S"), "ms": round(prof.total_ms, 1),
+                    "widgets": prof._widget_count(), "sql": prof._sql_count()})
+    
+    with st.sidebar:
+        with st.expander(f"🧪 Profiler: {prof.total_ms:.0f} ms / {prof._sql_count()} SQL", expanded=True):
+            df = pd.DataFrame(prof.entries)
+            if not df.empty:
+                st.dataframe(df, use_container_width=True, hide_index=True)
+                top = df[~df["function"].str.startswith(" ")]
+                fig = px.bar(top, x="ms", y="function", orientation="h", title="Zeit pro UI-Funktion",
+                             labels={"ms": "ms", "function": ""})
+                fig.update_layout(height=250, margin=dict(l=0, r=0, t=30, b=0))
+                st.plotly_chart(fig, use_container_width=True)
+            st.caption("Letzte Reruns")
+            st.dataframe(pd.DataFrame(list(history)), use_container_width=True, hide_index=True)
+            
+            if prof.profile_busy:
+                st.caption("cProfile belegt (anderer Rerun profiliert gerade) – nur Zeitmessung")
+            if prof.profile:
+                st.code(prof.stats_text(), language="text")
+                st.download_button("📥 cProfile-Dump (.prof)", data=prof.dump_bytes(),
+                                   file_name=f"dienstplan_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof",
+                                   mime="application/octet-stream", key="ui_profiler_dump")
+
+# ===== Nutzerauswahl (Suche) =====
+def user_picker(label, key, exclude_id=None, default=None, limit=20):
+    """Suchfeld + Auswahl aus den Suchtreffern (statt Selectbox über alle Nutzer)"""
+    q = st.text_input(f"🔍 {label} suchen", key=f"{key}_q", placeholder="Name oder E-Mail")
+    hits, _ = st.session_state.db.search_users(q, limit=limit, active_only=True, exclude_id=exclude_id)
+    if default and not q and all(h["id"] != default["id"] for h in hits):
+        hits = [default] + hits[:limit - 1]
+    if not hits:
+        st.caption("Keine Treffer")
+        return None
+    idx = next((i for i, h in enumerate(hits) if default and h["id"] == default["id"]), 0)
+    return st.selectbox(label, hits, index=idx, key=f"{key}_sel",
+                        format_func=lambda h: f"{h['name']} ({h['email']})")
+
+# ===== Fragment-Helfer =====
+def rerun_scoped():
+    """Rerun nur des aktuellen Fragments; während eines Full-App-Runs der ganzen App"""
+    ctx = get_script_run_ctx()
+    st.rerun(scope="fragment" if ctx and ctx.fragment_ids_this_run else "app")
+
+# ===== Change-Feed-Caches (pro Sitzung) =====
+def plan_bookings(start, end):
+    """Buchungen eines Zeitraums für die Plan-Ansichten.
+
+    Pro Sitzung gecacht: bei jedem Rerun/Poll wird nur der Change-Feed-Stand geprüft,
+    bei Änderungen werden ausschließlich die betroffenen Zellen neu geladen.
+    """
+    db = st.session_state.db
+    cache = st.session_state.get("plan_cache")
+    seq = db.current_seq()
+    if not cache or cache["range"] != (start, end):
+        cache = {"range": (start, end), "seq": seq, "cells": db.bookings_in_range(start, end)}
+    elif seq != cache["seq"]:
+        changes = db.changes_since(cache["seq"])
+        if changes is None:
+            cache["cells"] = db.bookings_in_range(start, end)
+        else:
+            for key in {(ch["slot_id"], ch["date"]) for ch in changes if ch["date"] and start <= ch["date"] <= end}:
+                cell = db.bookings_for(*key)
+                if cell: cache["cells"][key] = cell
+                else: cache["cells"].pop(key, None)
+        cache["seq"] = seq
+    st.session_state.plan_cache = cache
+    return cache["cells"]
+
+def feed_cached(key, loader):
+    """Session-Cache für Abfragen, die sich nur mit Buchungsänderungen ändern"""
+    seq = st.session_state.db.current_seq()
+    store = st.session_state.setdefault("feed_cache", {})
+    hit = store.get(key)
+    if hit and hit[0] == seq: return hit[1]
+    value = loader()
+    store[key] = (seq, value)
+    return value
 
 # ===== UI: Auth =====
 def ui_auth():
@@ -972,9 +4154,14 @@ def ui_auth():
             e = st.text_input("📧 E-Mail")
             p = st.text_input("🔒 Passwort", type="password")
             if st.form_submit_button("Anmelden", type="primary"):
-                u = st.session_state.db.auth(e, p)
+                try:
+                    u = st.session_state.db.auth(e, p)
+                except TimeoutError as ex:
+                    st.warning(f"⏳ {ex}")
+                    return
                 if u:
                     st.session_state.user = u
+                    st.session_state.auth_token = AUTH.issue_token(u["id"])
                     st.session_state.db.log(u["id"],"login","user login")
                     st.success(f"Willkommen {u['name']}!")
                     st.rerun()
@@ -1002,15 +4189,16 @@ def ui_auth():
                 else:
                     ok, result = st.session_state.db.create_user(r_e, r_ph, n, r_p1)
                     if ok:
-                        u = st.session_state.db.auth(r_e, r_p1)
-                        st.session_state.user = u
-                        st.session_state.db.log(result,"user_created","registered")
+                        st.session_state.user = result
+                        st.session_state.auth_token = AUTH.issue_token(result["id"])
+                        st.session_state.db.log(result["id"],"user_created","registered")
                         st.success("Account erstellt und eingeloggt")
                         st.rerun()
                     else:
                         st.error(result)
 
 # ===== UI: Plan mit Umschalter =====
+@profile_ui
 def ui_plan():
     u = st.session_state.user
     
@@ -1038,6 +4226,8 @@ def ui_plan():
     else:
         ui_month_view()
 
+@profile_ui
+@st.fragment(run_every=PLAN_REFRESH_SECONDS or None)
 def ui_week_view():
     u = st.session_state.user
     ws = st.session_state.week_start
@@ -1048,7 +4238,7 @@ def ui_week_view():
     with col1:
         if st.button("⬅️ Vorherige Woche"):
             st.session_state.week_start = ws - timedelta(days=7)
-            st.rerun()
+            rerun_scoped()
     
     with col2:
         st.markdown(f'<div class="week-header">KW {ws.isocalendar()[1]} — {ws.strftime("%d.%m.%Y")} bis {week_end.strftime("%d.%m.%Y")}</div>', unsafe_allow_html=True)
@@ -1056,11 +4246,12 @@ def ui_week_view():
     with col3:
         if st.button("Nächste Woche ➡️"):
             st.session_state.week_start = ws + timedelta(days=7)
-            st.rerun()
+            rerun_scoped()
 
-    for slot in WEEKLY_SLOTS:
-        d = slot_date(ws, slot["day"])
-        bookings = st.session_state.db.bookings_for(slot["id"], d)
+    cells = plan_bookings(ws.strftime("%Y-%m-%d"), week_end.strftime("%Y-%m-%d"))
+    for slot in active_slots():
+        d = slot.date_in_week(ws)
+        bookings = cells.get((slot.id, d), [])
         blocked = is_blocked_date(d)
         
         col_info, col_action = st.columns([3,1])
@@ -1068,15 +4259,15 @@ def ui_week_view():
         with col_info:
             if blocked:
                 reason = get_block_reason(d)
-                st.markdown(f'<div class="slot-blocked">{reason}<br><strong>{slot["day_name"]}, {fmt_de(d)}</strong> — ⏰ {slot["start"]}–{slot["end"]}</div>', unsafe_allow_html=True)
+                st.markdown(f'<div class="slot-blocked">{reason}<br><strong>{slot.day_name}, {fmt_de(d)}</strong> — ⏰ {slot.start}–{slot.end}</div>', unsafe_allow_html=True)
             elif bookings:
                 b = bookings[0]
                 if b["user_id"] == u["id"]:
-                    st.markdown(f'<div class="slot-booked-me">✅ <strong>{slot["day_name"]}, {fmt_de(d)}</strong> — Gebucht von Ihnen — ⏰ {slot["start"]}–{slot["end"]}</div>', unsafe_allow_html=True)
+                    st.markdown(f'<div class="slot-booked-me">✅ <strong>{slot.day_name}, {fmt_de(d)}</strong> — Gebucht von Ihnen — ⏰ {slot.start}–{slot.end}</div>', unsafe_allow_html=True)
                 else:
-                    st.markdown(f'<div class="slot-booked-other">📋 <strong>{slot["day_name"]}, {fmt_de(d)}</strong> — Gebucht von: <strong>{b["user_name"]}</strong> — ⏰ {slot["start"]}–{slot["end"]}</div>', unsafe_allow_html=True)
+                    st.markdown(f'<div class="slot-booked-other">📋 <strong>{slot.day_name}, {fmt_de(d)}</strong> — Gebucht von: <strong>{b["user_name"]}</strong> — ⏰ {slot.start}–{slot.end}</div>', unsafe_allow_html=True)
             else:
-                st.markdown(f'<div class="slot-available">✨ <strong>{slot["day_name"]}, {fmt_de(d)}</strong> — Verfügbar — ⏰ {slot["start"]}–{slot["end"]}</div>', unsafe_allow_html=True)
+                st.markdown(f'<div class="slot-available">✨ <strong>{slot.day_name}, {fmt_de(d)}</strong> — Verfügbar — ⏰ {slot.start}–{slot.end}</div>', unsafe_allow_html=True)
         
         with col_action:
             if blocked:
@@ -1088,9 +4279,9 @@ def ui_week_view():
                         _send_cancellation_confirmation(u, slot, d)
                         _notify_admins_cancellation(u, slot, d)
                         
-                        st.session_state.db.log(u["id"],"booking_cancelled",f"slot_id={slot['id']}, date={d}")
+                        st.session_state.db.log(u["id"],"booking_cancelled",f"slot_id={slot.id}, date={d}")
                         st.success("Schicht storniert - Benachrichtigungen versendet")
-                        st.rerun()
+                        rerun_scoped()
             elif bookings and u["role"] == "admin":
                 # Admin-Aktionen für fremde Buchungen
                 col_action1, col_action2 = st.columns(2)
@@ -1100,7 +4291,7 @@ def ui_week_view():
                         st.session_state.rebook_slot = slot
                         st.session_state.rebook_date = d
                         st.session_state.rebook_old_user = b
-                        st.rerun()
+                        rerun_scoped()
                 
                 with col_action2:
                     if st.button("❌", key=f"admin_cancel_{b['id']}", help="Admin-Storno"):
@@ -1113,34 +4304,31 @@ def ui_week_view():
                             
                             st.session_state.db.log(u["id"],"admin_cancelled",f"cancelled booking_id={b['id']} for user={b['user_name']}")
                             st.success(f"Schicht für {b['user_name']} storniert")
-                            st.rerun()
+                            rerun_scoped()
             elif not bookings:
-                if st.button("📝 Buchen", key=f"book_{slot['id']}_{d}", type="primary"):
-                    ok, res = st.session_state.db.create_booking(u["id"], slot["id"], d)
+                if st.button("📝 Buchen", key=f"book_{slot.id}_{d}", type="primary"):
+                    ok, res = st.session_state.db.create_booking(u["id"], slot.id, d)
                     if ok:
                         # Buchungsbestätigung senden
                         _send_booking_confirmation(u, slot, d)
                         
-                        st.session_state.db.log(u["id"],"booking_created",f"slot_id={slot['id']}, date={d}")
+                        st.session_state.db.log(u["id"],"booking_created",f"slot_id={slot.id}, date={d}")
                         st.success(f"Gebucht für {fmt_de(d)} - Bestätigung versendet")
-                        st.rerun()
+                        rerun_scoped()
                     else:
                         st.error(res)
     
     # Umbuchungs-Dialog
     if hasattr(st.session_state, "rebook_booking_id"):
         with st.expander("🔄 Schicht umbuchen", expanded=True):
-            users = st.session_state.db.get_all_users()
-            active_users = [u for u in users if u["active"] and u["id"] != st.session_state.rebook_old_user["user_id"]]
+            selected_user = user_picker("Neuer Nutzer", "rebook_user",
+                                        exclude_id=st.session_state.rebook_old_user["user_id"])
             
-            if active_users:
-                user_options = {f"{u['name']} ({u['email']})": u["id"] for u in active_users}
-                selected_user = st.selectbox("Neuer Nutzer:", list(user_options.keys()))
-                
+            if selected_user:
                 col1, col2 = st.columns(2)
                 with col1:
                     if st.button("✅ Umbuchen bestätigen", type="primary"):
-                        new_user_id = user_options[selected_user]
+                        new_user_id = selected_user["id"]
                         new_user = st.session_state.db.get_user_by_id(new_user_id)
                         
                         if st.session_state.db.rebook_to_user(st.session_state.rebook_booking_id, new_user_id):
@@ -1158,7 +4346,7 @@ def ui_week_view():
                             del st.session_state.rebook_old_user
                             
                             st.success("Schicht erfolgreich umgebucht - Benachrichtigungen versendet!")
-                            st.rerun()
+                            rerun_scoped()
                 
                 with col2:
                     if st.button("❌ Abbrechen"):
@@ -1166,10 +4354,18 @@ def ui_week_view():
                         del st.session_state.rebook_slot
                         del st.session_state.rebook_date
                         del st.session_state.rebook_old_user
-                        st.rerun()
+                        rerun_scoped()
             else:
-                st.warning("Keine anderen aktiven Nutzer verfügbar")
+                st.warning("Kein passender aktiver Nutzer gefunden")
+                if st.button("❌ Abbrechen", key="rebook_cancel_empty"):
+                    del st.session_state.rebook_booking_id
+                    del st.session_state.rebook_slot
+                    del st.session_state.rebook_date
+                    del st.session_state.rebook_old_user
+                    rerun_scoped()
 
+@profile_ui
+@st.fragment(run_every=PLAN_REFRESH_SECONDS or None)
 def ui_month_view():
     u = st.session_state.user
     current_date = st.session_state.get("calendar_date", datetime.now().date())
@@ -1183,7 +4379,7 @@ def ui_month_view():
                 st.session_state.calendar_date = current_date.replace(year=current_date.year-1, month=12)
             else:
                 st.session_state.calendar_date = current_date.replace(month=current_date.month-1)
-            st.rerun()
+            rerun_scoped()
     
     with col2:
         month_names = ["", "Januar", "Februar", "März", "April", "Mai", "Juni",
@@ -1196,7 +4392,7 @@ def ui_month_view():
                 st.session_state.calendar_date = current_date.replace(year=current_date.year+1, month=1)
             else:
                 st.session_state.calendar_date = current_date.replace(month=current_date.month+1)
-            st.rerun()
+            rerun_scoped()
     
     # Kalender erstellen
     cal = calendar.monthcalendar(current_date.year, current_date.month)
@@ -1208,6 +4404,9 @@ def ui_month_view():
         cols[i].markdown(f"**{day}**")
     
     today = date.today()
+    month_start = current_date.replace(day=1)
+    month_end = month_start.replace(day=calendar.monthrange(current_date.year, current_date.month)[1])
+    cells = plan_bookings(month_start.strftime("%Y-%m-%d"), month_end.strftime("%Y-%m-%d"))
     
     for week in cal:
         cols = st.columns(7)
@@ -1237,51 +4436,52 @@ def ui_month_view():
                 else:
                     # Schichten für diesen Tag
                     day_slots = []
-                    weekday_map = {"tuesday": 1, "friday": 4, "saturday": 5}  # 0=Montag
                     
-                    for slot in WEEKLY_SLOTS:
-                        if day_date.weekday() == weekday_map.get(slot["day"]):
-                            bookings = st.session_state.db.bookings_for(slot["id"], day_str)
-                            day_slots.append((slot, bookings))
+                    for slot in active_slots().for_weekday(day_date.weekday()):
+                        day_slots.append((slot, cells.get((slot.id, day_str), [])))
                     
                     if day_slots:
                         for slot, bookings in day_slots:
                             if bookings:
                                 css_class += " calendar-booked"
-                                content += f"🔴 {slot['start']}\n"
+                                content += f"🔴 {slot.start}\n"
                             else:
                                 css_class += " calendar-available"
-                                content += f"🟢 {slot['start']}\n"
+                                content += f"🟢 {slot.start}\n"
                                 
                                 # Buchungsbutton
-                                if st.button(f"Buchen", key=f"cal_{slot['id']}_{day_str}", use_container_width=True):
-                                    ok, res = st.session_state.db.create_booking(u["id"], slot["id"], day_str)
+                                if st.button(f"Buchen", key=f"cal_{slot.id}_{day_str}", use_container_width=True):
+                                    ok, res = st.session_state.db.create_booking(u["id"], slot.id, day_str)
                                     if ok:
                                         # Buchungsbestätigung senden
                                         _send_booking_confirmation(u, slot, day_str)
                                         
-                                        st.session_state.db.log(u["id"],"booking_created",f"calendar: slot_id={slot['id']}, date={day_str}")
+                                        st.session_state.db.log(u["id"],"booking_created",f"calendar: slot_id={slot.id}, date={day_str}")
                                         st.success("Gebucht - Bestätigung versendet!")
-                                        st.rerun()
+                                        rerun_scoped()
                                     else:
                                         st.error(res)
                 
                 st.markdown(f'<div class="{css_class}">{content}</div>', unsafe_allow_html=True)
 
 # ===== UI: Meine Schichten =====
+@profile_ui
+@st.fragment(run_every=PLAN_REFRESH_SECONDS or None)
 def ui_my_shifts():
     u = st.session_state.user
     
     st.subheader("👤 Meine Schichten")
-    mine = st.session_state.db.user_bookings(u["id"])
+    mine = feed_cached(("user_bookings", u["id"]), lambda: st.session_state.db.user_bookings(u["id"]))
     
     if mine:
+        registry = active_slots()
         for b in mine:
-            slot = next(s for s in WEEKLY_SLOTS if s["id"] == b["slot_id"])
+            slot = registry.get(b["slot_id"])
+            if not slot: continue
             col_info, col_action = st.columns([4,1])
             
             with col_info:
-                st.info(f"**{slot['day_name']}, {fmt_de(b['date'])}** — ⏰ {slot['start']}–{slot['end']} — 📝 Gebucht am {datetime.fromisoformat(b['created_at']).strftime('%d.%m.%Y %H:%M')}")
+                st.info(f"**{slot.day_name}, {fmt_de(b['date'])}** — ⏰ {slot.start}–{slot.end} — 📝 Gebucht am {datetime.fromisoformat(b['created_at']).strftime('%d.%m.%Y %H:%M')}")
             
             with col_action:
                 if st.button("❌ Stornieren", key=f"my_cancel_{b['id']}"):
@@ -1292,11 +4492,53 @@ def ui_my_shifts():
                         
                         st.session_state.db.log(u["id"],"booking_cancelled_from_list",f"booking_id={b['id']}")
                         st.success("Storniert - Benachrichtigungen versendet")
-                        st.rerun()
+                        rerun_scoped()
     else:
         st.info("Keine Buchungen vorhanden.")
+    
+    st.divider()
+    ui_series_booking()
+
+def ui_series_booking():
+    """Serienbuchung: ein Slot in festem Wochenrhythmus, eine Transaktion, eine Bestätigung"""
+    u = st.session_state.user
+    
+    with st.expander("🔁 Serienbuchung (z.B. jeden Dienstag bis Weihnachten)"):
+        target = u
+        if u["role"] == "admin":
+            target = user_picker("Für Nutzer", "series_user", default=u) or u
+        with st.form("f_series"):
+            slot = st.selectbox("Schicht", list(active_slots()), format_func=lambda s: f"{s.day_name} {s.time_range}")
+            c1, c2, c3 = st.columns(3)
+            start = c1.date_input("Ab", value=date.today())
+            until = c2.date_input("Bis", value=date(date.today().year, 12, 24))
+            every = c3.number_input("Alle n Wochen", min_value=1, max_value=8, value=1)
+            
+            if st.form_submit_button("🔁 Serie buchen", type="primary"):
+                items = series_dates(slot, start, until, every)
+                if not items:
+                    st.warning("Kein Termin im gewählten Zeitraum")
+                elif len(items) > 500:
+                    st.error("Maximal 500 Termine pro Serie")
+                else:
+                    if target["id"] != u["id"]:
+                        target = st.session_state.db.get_user_by_id(target["id"])
+                    st.session_state.series_result = book_series(target, items, actor_id=u["id"])
+                    rerun_scoped()
+        
+        result = st.session_state.pop("series_result", None)
+        if result:
+            if result["booked"]:
+                st.success(f"{len(result['booked'])} Schichten gebucht - Sammelbestätigung versendet")
+            if result["conflicts"]:
+                st.warning(f"{len(result['conflicts'])} Termine nicht gebucht:")
+                st.dataframe(pd.DataFrame([{"Datum": fmt_de(c["date"]), "Grund": c["reason"]} for c in result["conflicts"]]),
+                             use_container_width=True, hide_index=True)
 
 # ===== UI: Handbuch (ehemals Info) =====
+HANDBUCH_PAGES = {"handbuch_page_1": "📋 Schicht-Info", "handbuch_page_2": "🚨 Notfall"}
+
+@profile_ui
 def ui_handbuch():
     st.subheader("📖 Handbuch")
     
@@ -1305,8 +4547,19 @@ def ui_handbuch():
     if news_content:
         st.markdown(f'<div class="news-block"><h4>📢 News</h4>{news_content.replace("\\n", "<br>")}</div>', unsafe_allow_html=True)
     
+    # Volltextsuche über alle Handbuch-Seiten
+    query = st.text_input("🔍 Handbuch durchsuchen", key="handbook_query")
+    if query:
+        hits = st.session_state.db.search_handbook(query)
+        for key, snippet in hits:
+            plain = re.sub(r"[#*`>]+|\\n|\n", " ", snippet)
+            plain = re.sub(r"\s+", " ", plain).replace("[[", "**").replace("]]", "**")
+            st.markdown(f"**{HANDBUCH_PAGES.get(key, key)}** — {plain}")
+        if not hits:
+            st.info("Keine Treffer im Handbuch")
+    
     # Zwei Handbuch-Seiten als Tabs
-    tab1, tab2 = st.tabs(["📋 Schicht-Info", "🚨 Notfall"])
+    tab1, tab2 = st.tabs(list(HANDBUCH_PAGES.values()))
     
     with tab1:
         content1 = st.session_state.db.get_setting("handbuch_page_1", "# Seite 1\n\nKein Inhalt vorhanden.")
@@ -1337,6 +4590,7 @@ def ui_handbuch():
             st.markdown(content2.replace("\\n", "\n"))
 
 # ===== UI: Profil mit Test-Buttons =====
+@profile_ui
 def ui_profile():
     u = st.session_state.user
     
@@ -1362,6 +4616,31 @@ def ui_profile():
     
     st.divider()
     
+    # Verfügbarkeit für die automatische Zuteilung
+    st.subheader("🗓️ Meine Verfügbarkeit")
+    st.caption("Wird bei der automatischen Zuteilung freier Schichten berücksichtigt.")
+    with st.form("f_availability"):
+        current = st.session_state.db.get_availability(u["id"])
+        levels = list(AVAILABILITY_LEVELS)
+        chosen = {slot.id: st.selectbox(f"{slot.day_name} {slot.time_range}", levels,
+                                        index=levels.index(current.get(slot.id, 1)),
+                                        format_func=AVAILABILITY_LEVELS.get, key=f"avail_{slot.id}")
+                  for slot in active_slots()}
+        if st.form_submit_button("💾 Verfügbarkeit speichern"):
+            st.session_state.db.set_availability(u["id"], chosen)
+            st.session_state.db.log(u["id"], "availability_updated", json.dumps(chosen))
+            st.success("Verfügbarkeit gespeichert")
+    
+    st.divider()
+    
+    # Kalender-Abo
+    if ENABLE_API:
+        st.subheader("📅 Kalender-Abo")
+        st.caption("URL in Outlook, Google oder Apple Kalender als Internetkalender abonnieren.")
+        st.text_input("Meine Schichten", value=ICS_FEED.url(st.session_state.db, u["id"]), disabled=True)
+        st.text_input("Gesamter Dienstplan", value=ICS_FEED.url(st.session_state.db), disabled=True)
+        st.divider()
+    
     # Passwort ändern
     st.subheader("🔒 Passwort ändern")
     with st.form("f_password"):
@@ -1372,8 +4651,11 @@ def ui_profile():
         if st.form_submit_button("🔄 Passwort ändern"):
             errs = []
             
-            if not st.session_state.db.auth(u["email"], old_pw):
-                errs.append("Aktuelles Passwort ist falsch")
+            try:
+                if not st.session_state.db.auth(u["email"], old_pw):
+                    errs.append("Aktuelles Passwort ist falsch")
+            except TimeoutError as ex:
+                errs.append(str(ex))
             
             if len(new_pw1) < 6:
                 errs.append("Neues Passwort muss mindestens 6 Zeichen haben")
@@ -1385,11 +4667,18 @@ def ui_profile():
                 for e in errs:
                     st.error(e)
             else:
-                if st.session_state.db.change_password(u["id"], new_pw1):
+                busy = None
+                try:
+                    changed = st.session_state.db.change_password(u["id"], new_pw1)
+                except TimeoutError as ex:
+                    changed, busy = False, str(ex)
+                if changed:
+                    # Andere Sitzungen dieses Nutzers abmelden
+                    AUTH.revoke_user(u["id"], keep=st.session_state.get("auth_token"))
                     st.session_state.db.log(u["id"], "password_changed", "password updated")
                     st.success("Passwort erfolgreich geändert")
                 else:
-                    st.error("Fehler beim Ändern des Passworts")
+                    st.error(busy or "Fehler beim Ändern des Passworts")
     
     st.divider()
     
@@ -1429,278 +4718,624 @@ def ui_profile():
             st.info("📴 E-Mail nicht konfiguriert" + (" oder Safe-Mode aktiv" if SAFE_MODE else ""))
 
 # ===== UI: Admin =====
-def ui_admin():
-    st.subheader("⚙️ Admin-Panel")
+def export_download(kind, label, file_name):
+    """Zweistufiger Download: Artefakt erst auf Klick erzeugen (bzw. aus dem Cache holen),
+    danach direkt aus der Temp-Datei anbieten. In der Sitzung liegt nur der Pfad."""
+    paths = st.session_state.setdefault("export_paths", {})
+    if st.button(f"⚙️ {label} vorbereiten", key=f"export_prepare_{kind}"):
+        with st.spinner("Export wird erstellt..."):
+            paths[kind] = EXPORTS.get(st.session_state.db, kind)
     
-    admin_tabs = st.tabs(["👥 Nutzer", "📝 Templates", "📊 Reporting", "💾 Backup/Restore"])
+    path = paths.get(kind)
+    if not path:
+        return
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        paths.pop(kind, None)  # veralteter Stand wurde inzwischen ersetzt
+        return
+    with f:
+        st.download_button(f"💾 {label} herunterladen", data=f, file_name=file_name,
+                           mime=EXPORTS.mime(kind), key=f"export_download_{kind}")
+
+@st.fragment
+def admin_users_tab():
+    """Admin-Tab: Nutzerverwaltung"""
+    st.subheader("👥 Nutzerverwaltung")
     
-    # Nutzerverwaltung
-    with admin_tabs[0]:
-        st.subheader("👥 Nutzerverwaltung")
-        
-        # Neuen Nutzer anlegen
-        with st.expander("➕ Neuen Nutzer anlegen"):
-            with st.form("add_user"):
-                new_email = st.text_input("E-Mail")
-                new_phone = st.text_input("Telefon", "+49 ")
-                new_name = st.text_input("Name")
-                new_role = st.selectbox("Rolle", ["user", "admin"])
-                temp_password = st.text_input("Temporäres Passwort", "temp123")
-                
-                if st.form_submit_button("👤 Nutzer anlegen"):
-                    ok, result = st.session_state.db.create_user(new_email, new_phone, new_name, temp_password)
-                    if ok:
-                        st.session_state.db.update_user_role(result, new_role)
-                        st.session_state.db.log(st.session_state.user["id"], "user_created_by_admin", f"user_id={result}, email={new_email}")
-                        st.success(f"Nutzer {new_name} angelegt mit temporärem Passwort: {temp_password}")
-                        st.rerun()
-                    else:
-                        st.error(result)
-        
-        # Nutzerliste
-        users = st.session_state.db.get_all_users()
-        if users:
-            for user in users:
-                with st.container():
-                    col1, col2, col3, col4 = st.columns([3,1,1,2])
-                    
-                    with col1:
-                        status = "🟢 Aktiv" if user["active"] else "🔴 Inaktiv"
-                        st.write(f"**{user['name']}** ({user['email']}) - {user['role'].title()} - {status}")
-                    
-                    with col2:
-                        new_role = st.selectbox("Rolle", ["user", "admin"], 
-                                              index=0 if user["role"]=="user" else 1,
-                                              key=f"role_{user['id']}")
-                        if st.button("↻", key=f"update_role_{user['id']}"):
-                            st.session_state.db.update_user_role(user["id"], new_role)
-                            st.session_state.db.log(st.session_state.user["id"], "user_role_changed", f"user_id={user['id']}, new_role={new_role}")
-                            st.rerun()
-                    
-                    with col3:
-                        if st.button("🔄 Aktivieren" if not user["active"] else "❌ Deaktivieren", 
-                                   key=f"toggle_{user['id']}"):
-                            new_status = not user["active"]
-                            st.session_state.db.update_user_status(user["id"], new_status)
-                            st.session_state.db.log(st.session_state.user["id"], "user_status_changed", f"user_id={user['id']}, active={new_status}")
-                            st.rerun()
-                    
-                    with col4:
-                        st.caption(f"Erstellt: {user['created_at'][:10]}")
+    # Neuen Nutzer anlegen
+    with st.expander("➕ Neuen Nutzer anlegen"):
+        with st.form("add_user"):
+            new_email = st.text_input("E-Mail")
+            new_phone = st.text_input("Telefon", "+49 ")
+            new_name = st.text_input("Name")
+            new_role = st.selectbox("Rolle", ["user", "admin"])
+            temp_password = st.text_input("Temporäres Passwort", "temp123")
+            
+            if st.form_submit_button("👤 Nutzer anlegen"):
+                ok, result = st.session_state.db.create_user(new_email, new_phone, new_name, temp_password)
+                if ok:
+                    st.session_state.db.update_user_role(result["id"], new_role)
+                    st.session_state.db.log(st.session_state.user["id"], "user_created_by_admin", f"user_id={result['id']}, email={new_email}")
+                    st.success(f"Nutzer {new_name} angelegt mit temporärem Passwort: {temp_password}")
+                    rerun_scoped()
+                else:
+                    st.error(result)
     
-    # Template-Editor
-    with admin_tabs[1]:
-        st.subheader("📝 Template-Editor")
+    # CSV-Import/Export
+    with st.expander("📄 CSV-Import / -Export"):
+        st.caption("Spalten: " + ", ".join(USER_CSV_COLUMNS) + " — Pflicht: email, name. "
+                   "Ohne Passwort wird ein temporäres erzeugt.")
+        csv_file = st.file_uploader("CSV-Datei", type=["csv", "txt"], key="user_csv_upload")
+        if csv_file and st.button("📥 Nutzer importieren", type="primary"):
+            with st.spinner("Import läuft..."):
+                report = import_users_csv(st.session_state.db, open_csv_upload(csv_file))
+            st.session_state.db.log(st.session_state.user["id"], "users_imported",
+                                    f"created={report['created']}, errors={len(report['errors'])}")
+            st.session_state.user_import_report = report
         
-        templates = [
-            ("booking_confirmation", "Buchungsbestätigung"),
-            ("cancellation_confirmation", "Storno-Bestätigung"),
-            ("admin_cancellation_notification", "Admin Storno-Benachrichtigung"),
-            ("admin_rebooking_notification", "Admin Umbuchungs-Benachrichtigung"),
-            ("rebooking_confirmation", "Umbuchungs-Bestätigung"),
-            ("reminder_24h", "24h Reminder"),
-            ("reminder_1h", "1h Reminder"),
-            ("news_content", "News-Inhalt")
-        ]
+        report = st.session_state.get("user_import_report")
+        if report:
+            st.success(f"{report['created']} Nutzer angelegt")
+            if report["errors"]:
+                st.warning(f"{len(report['errors'])} Zeilen übersprungen")
+                st.dataframe(pd.DataFrame(report["errors"]), use_container_width=True, hide_index=True)
+            # Klartext-Passwörter nur für diesen einen Durchlauf anbieten, nicht im Session-State halten
+            passwords = report.pop("passwords", None)
+            if passwords:
+                st.download_button("🔑 Temporäre Passwörter (CSV)",
+                                   data=pd.DataFrame(passwords).to_csv(index=False).encode("utf-8"),
+                                   file_name="temporaere_passwoerter.csv", mime="text/csv")
+                st.caption("⚠️ Die Passwörter werden nur jetzt angeboten — bitte sofort herunterladen.")
         
-        for template_key, template_name in templates:
-            with st.expander(f"✏️ {template_name}"):
-                current_template = st.session_state.db.get_setting(template_key, "")
+        export_download("users", "Nutzer-CSV", f"nutzer_{datetime.now().strftime('%Y%m%d')}.csv")
+    
+    # Nutzerliste: Suche + Keyset-Pagination, nur die aktuelle Seite wird gerendert
+    q = st.text_input("🔍 Nutzer suchen", key="admin_user_q", placeholder="Name oder E-Mail")
+    if st.session_state.get("admin_user_pages_q") != q:
+        st.session_state.admin_user_pages = [None]
+        st.session_state.admin_user_pages_q = q
+    pages = st.session_state.admin_user_pages
+    users, next_cursor = st.session_state.db.search_users(q, after=pages[-1], limit=ADMIN_USERS_PAGE_SIZE)
+    
+    col_prev, col_page, col_next = st.columns([1,2,1])
+    with col_prev:
+        if len(pages) > 1 and st.button("⬅️ Zurück", key="admin_users_prev"):
+            pages.pop()
+            rerun_scoped()
+    with col_page:
+        st.caption(f"Seite {len(pages)} — {len(users)} Nutzer")
+    with col_next:
+        if next_cursor and st.button("Weiter ➡️", key="admin_users_next"):
+            pages.append(next_cursor)
+            rerun_scoped()
+    
+    if users:
+        for user in users:
+            with st.container():
+                col1, col2, col3, col4 = st.columns([3,1,1,2])
                 
-                if template_key == "news_content":
-                    st.caption("Wird in der Sidebar und im Handbuch angezeigt")
-                else:
-                    st.caption("Verfügbare Platzhalter: {USER}, {DATUM}, {SCHICHT}, {ZEIT}, {OLD_USER}, {NEW_USER}")
+                with col1:
+                    status = "🟢 Aktiv" if user["active"] else "🔴 Inaktiv"
+                    st.write(f"**{user['name']}** ({user['email']}) - {user['role'].title()} - {status}")
                 
-                new_template = st.text_area(
-                    f"Template für {template_name}:",
-                    value=current_template,
-                    height=100,
-                    key=f"template_{template_key}"
-                )
+                with col2:
+                    new_role = st.selectbox("Rolle", ["user", "admin"], 
+                                          index=0 if user["role"]=="user" else 1,
+                                          key=f"role_{user['id']}")
+                    if st.button("↻", key=f"update_role_{user['id']}"):
+                        st.session_state.db.update_user_role(user["id"], new_role)
+                        st.session_state.db.log(st.session_state.user["id"], "user_role_changed", f"user_id={user['id']}, new_role={new_role}")
+                        rerun_scoped()
                 
-                # Vorschau (außer News)
-                if template_key != "news_content":
-                    preview = new_template.replace("{USER}", "Max Mustermann") \
-                                       .replace("{OLD_USER}", "Anna Schmidt") \
-                                       .replace("{NEW_USER}", "Max Mustermann") \
-                                       .replace("{DATUM}", "15.09.2025") \
-                                       .replace("{SCHICHT}", "Dienstag") \
-                                       .replace("{ZEIT}", "17:00-20:00") \
-                                       .replace("\\n", "\n")
-                    
-                    st.caption("Vorschau:")
-                    st.text(preview)
+                with col3:
+                    if st.button("🔄 Aktivieren" if not user["active"] else "❌ Deaktivieren", 
+                               key=f"toggle_{user['id']}"):
+                        new_status = not user["active"]
+                        st.session_state.db.update_user_status(user["id"], new_status)
+                        if not new_status:
+                            AUTH.revoke_user(user["id"])
+                        st.session_state.db.log(st.session_state.user["id"], "user_status_changed", f"user_id={user['id']}, active={new_status}")
+                        rerun_scoped()
+                
+                with col4:
+                    st.caption(f"Erstellt: {user['created_at'][:10]}")
+    else:
+        st.info("Keine Nutzer gefunden.")
+
+@st.fragment
+def admin_templates_tab():
+    """Admin-Tab: Template-Editor und Schichtzeiten"""
+    st.subheader("📝 Template-Editor")
+    
+    templates = [
+        ("booking_confirmation", "Buchungsbestätigung"),
+        ("cancellation_confirmation", "Storno-Bestätigung"),
+        ("admin_cancellation_notification", "Admin Storno-Benachrichtigung"),
+        ("admin_rebooking_notification", "Admin Umbuchungs-Benachrichtigung"),
+        ("rebooking_confirmation", "Umbuchungs-Bestätigung"),
+        ("series_booking_confirmation", "Serienbuchungs-Bestätigung"),
+        ("reminder_24h", "24h Reminder"),
+        ("reminder_1h", "1h Reminder"),
+        ("news_content", "News-Inhalt")
+    ]
+    
+    for template_key, template_name in templates:
+        with st.expander(f"✏️ {template_name}"):
+            current_template = st.session_state.db.get_setting(template_key, "")
+            
+            if template_key == "news_content":
+                st.caption("Wird in der Sidebar und im Handbuch angezeigt")
+            else:
+                st.caption("Verfügbare Platzhalter: {USER}, {DATUM}, {SCHICHT}, {ZEIT}, {OLD_USER}, {NEW_USER}"
+                           + (", {ANZAHL}, {TERMINE}" if template_key == "series_booking_confirmation" else ""))
+            
+            new_template = st.text_area(
+                f"Template für {template_name}:",
+                value=current_template,
+                height=100,
+                key=f"template_{template_key}"
+            )
+            
+            # Vorschau (außer News)
+            if template_key != "news_content":
+                preview = new_template.replace("{USER}", "Max Mustermann") \
+                                   .replace("{OLD_USER}", "Anna Schmidt") \
+                                   .replace("{NEW_USER}", "Max Mustermann") \
+                                   .replace("{DATUM}", "15.09.2025") \
+                                   .replace("{SCHICHT}", "Dienstag") \
+                                   .replace("{ZEIT}", "17:00-20:00") \
+                                   .replace("\\n", "\n")
                 
-                if st.button(f"💾 {template_name} speichern", key=f"save_{template_key}"):
-                    st.session_state.db.set_setting(template_key, new_template)
-                    st.session_state.db.log(st.session_state.user["id"], "template_updated", f"template={template_key}")
-                    st.success("Template gespeichert")
+                st.caption("Vorschau:")
+                st.text(preview)
+            
+            if st.button(f"💾 {template_name} speichern", key=f"save_{template_key}"):
+                st.session_state.db.set_setting(template_key, new_template)
+                st.session_state.db.log(st.session_state.user["id"], "template_updated", f"template={template_key}")
+                st.success("Template gespeichert")
+                # News erscheinen auch in der Sidebar -> ganze App neu rendern
+                if template_key == "news_content":
                     st.rerun()
+                rerun_scoped()
     
-    # Enhanced Reporting mit Visualisierungen
-    with admin_tabs[2]:
-        st.subheader("📊 Enhanced Reporting")
+    # Schichtzeiten (Slot-Konfiguration)
+    with st.expander("🕐 Schichtzeiten (Slots)"):
+        st.caption("Wochentag: " + ", ".join(WEEKDAYS) + " — Zeiten im Format HH:MM. "
+                   "Slots mit zukünftigen Buchungen können nicht entfernt oder verschoben werden.")
+        df_slots_cfg = pd.DataFrame([s.to_dict() for s in active_slots()])
+        edited_slots = st.data_editor(
+            df_slots_cfg, num_rows="dynamic", use_container_width=True, hide_index=True,
+            key="slot_config_editor",
+            column_config={
+                "id": st.column_config.NumberColumn("ID", min_value=1, step=1, required=True),
+                "day": st.column_config.SelectboxColumn("Wochentag", options=list(WEEKDAYS), required=True),
+                "day_name": st.column_config.TextColumn("Anzeigename", required=True),
+                "start": st.column_config.TextColumn("Beginn", required=True),
+                "end": st.column_config.TextColumn("Ende", required=True),
+            })
+        if st.button("💾 Schichtzeiten speichern", key="save_weekly_slots"):
+            defs = edited_slots.dropna(how="all").to_dict("records")
+            ok, msg = st.session_state.db.save_weekly_slots(defs)
+            if ok:
+                st.session_state.db.log(st.session_state.user["id"], "slots_updated", json.dumps(defs, default=str))
+                st.success(msg)
+                st.rerun()
+            else:
+                st.error(msg)
+
+@st.fragment
+def admin_reporting_tab():
+    """Admin-Tab: Reporting mit Visualisierungen"""
+    st.subheader("📊 Enhanced Reporting")
+    
+    # Twilio Balance (Robuste Version)
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        st.caption("💰 Twilio Account Balance")
+        force = st.button("🔄 Balance aktualisieren")
+        if force:
+            with st.spinner("Balance wird abgerufen..."):
+                balance_data, error = get_twilio_balance(wait=True)
+        else:
+            balance_data, error = get_twilio_balance()
         
-        # Twilio Balance (Robuste Version)
-        col1, col2 = st.columns(2)
+        if balance_data:
+            st.markdown(f'<div class="twilio-balance">💳 Guthaben: <strong>{balance_data["balance"]} {balance_data["currency"]}</strong><br>📅 Stand: {balance_data["last_updated"]}{" (wird aktualisiert)" if balance_data["stale"] else ""}</div>', unsafe_allow_html=True)
+            burn = BALANCE_MONITOR.burn_rate()
+            if burn:
+                st.caption(f"🔥 Verbrauch: {burn['per_day']:.2f} {balance_data['currency']}/Tag"
+                           + (f" — {burn['per_sms']:.3f} pro SMS" if burn["per_sms"] else "")
+                           + (f" — reicht noch ca. {burn['days_left']:.0f} Tage" if burn["days_left"] else ""))
+            history = BALANCE_MONITOR.history()
+            if len(history) > 1:
+                fig_bal = px.line(pd.DataFrame(history), x="zeit", y="balance", title="Guthaben-Verlauf",
+                                  labels={"zeit": "", "balance": balance_data["currency"]})
+                fig_bal.update_layout(height=220, margin=dict(l=0, r=0, t=30, b=0))
+                st.plotly_chart(fig_bal, use_container_width=True)
+        if error:
+            st.markdown(f'<div class="balance-error">❌ Fehler beim Abrufen der Balance:<br>{error}</div>', unsafe_allow_html=True)
+    
+    with col2:
+        # Grundstatistiken
+        counts = st.session_state.db.user_counts()
         
-        with col1:
-            st.caption("💰 Twilio Account Balance")
-            if st.button("🔄 Balance aktualisieren"):
-                with st.spinner("Balance wird abgerufen..."):
-                    balance_data, error = get_twilio_balance()
-                    if balance_data:
-                        st.markdown(f'<div class="twilio-balance">💳 Guthaben: <strong>{balance_data["balance"]} {balance_data["currency"]}</strong><br>📅 Letzte Aktualisierung: {balance_data["last_updated"]}</div>', unsafe_allow_html=True)
-                    else:
-                        st.markdown(f'<div class="balance-error">❌ Fehler beim Abrufen der Balance:<br>{error}</div>', unsafe_allow_html=True)
-            
-            # Cached Balance anzeigen
-            if "twilio_balance_cache" in st.session_state:
-                data = st.session_state.twilio_balance_cache
-                st.markdown(f'<div class="twilio-balance">💳 Cached: <strong>{data["balance"]} {data["currency"]}</strong><br>📅 Stand: {data["last_updated"]}</div>', unsafe_allow_html=True)
+        st.metric("Aktive Benutzer", counts["active"])
+        st.metric("Gesamt Benutzer", counts["total"])
+        st.metric("Administratoren", counts["admins"])
+    
+    # Kennzahlen aus dem Analytics-Modul (ein Datenabzug, pro Datenstand gecacht)
+    stats = ANALYTICS.get(st.session_state.db, 12)
+    
+    with st.expander("📐 Abdeckung & Fairness (12 Wochen)", expanded=True):
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Abdeckung", f"{stats['coverage_total']:.0%}" if stats["coverage_total"] is not None else "–")
+        col2.metric("Gini (Last)", f"{stats['load']['gini']:.2f}")
+        col3.metric("Storno-Quote", f"{stats['rates']['cancel_rate']:.0%}")
+        col4.metric("Umbuchungs-Quote", f"{stats['rates']['rebook_rate']:.0%}")
         
-        with col2:
-            # Grundstatistiken
-            users_all = st.session_state.db.get_all_users()
-            active_users = [u for u in users_all if u["active"]]
-            
-            st.metric("Aktive Benutzer", len(active_users))
-            st.metric("Gesamt Benutzer", len(users_all))
-            st.metric("Administratoren", len([u for u in active_users if u["role"]=="admin"]))
+        load = stats["load"]
+        st.caption(f"Schichten pro aktivem Nutzer: Ø {load['mean']:.1f}, Median {load['p50']:.0f}, "
+                   f"P75 {load['p75']:.0f}, P90 {load['p90']:.0f}, Max {load['max']} — "
+                   f"{load['without_shift']} von {load['users']} ohne Schicht")
+        if stats["lead"]:
+            lead = stats["lead"]
+            st.caption(f"Vorlaufzeit Buchung → Schicht: Median {lead['median']:.1f} Tage "
+                       f"(P10 {lead['p10']:.1f}, P90 {lead['p90']:.1f}), "
+                       f"{lead['short_share']:.0%} kurzfristig (< 48 h)")
         
-        # Erweiterte Visualisierungen
-        with st.expander("📈 Nutzer-Aktivitäten (Visualisierungen)", expanded=True):
-            
-            # Benutzerstatistiken
-            user_stats = st.session_state.db.get_user_statistics()
-            if user_stats:
-                st.subheader("👥 Top-Aktive Nutzer")
-                df_stats = pd.DataFrame(user_stats)
-                
-                # Top 10 Chart
-                if len(df_stats) > 0:
-                    top_users = df_stats.head(10)
-                    fig_bar = px.bar(top_users, x='name', y='total_bookings', 
-                                    title='Top 10 Nutzer nach Buchungen',
-                                    labels={'total_bookings': 'Anzahl Buchungen', 'name': 'Nutzer'})
-                    st.plotly_chart(fig_bar, use_container_width=True)
-                
-                st.dataframe(df_stats, use_container_width=True)
+        if not stats["coverage"].empty:
+            fig_cov = px.imshow(stats["coverage"].T, zmin=0, zmax=1, color_continuous_scale="RdYlGn",
+                                aspect="auto", title="Abdeckung pro Slot und Kalenderwoche",
+                                labels={"x": "Kalenderwoche", "y": "", "color": "belegt"})
+            st.plotly_chart(fig_cov, use_container_width=True)
+        if len(stats["load_hist"]) > 1:
+            fig_load = px.bar(x=stats["load_hist"].index, y=stats["load_hist"].values,
+                              title="Lastverteilung (Schichten pro Nutzer)",
+                              labels={"x": "Schichten", "y": "Nutzer"})
+            st.plotly_chart(fig_load, use_container_width=True)
+        if not stats["rates_weekly"].empty:
+            fig_rates = px.bar(stats["rates_weekly"].reset_index(), x="week", y=["booked", "cancelled", "rebooked"],
+                               barmode="group", title="Buchungen, Stornos und Umbuchungen pro Woche",
+                               labels={"week": "Kalenderwoche", "value": "Anzahl", "variable": ""})
+            st.plotly_chart(fig_rates, use_container_width=True)
+    
+    # Erweiterte Visualisierungen
+    with st.expander("📈 Nutzer-Aktivitäten (Visualisierungen)", expanded=True):
+        
+        # Benutzerstatistiken
+        df_stats = stats["user_stats"]
+        if len(df_stats) > 0:
+            st.subheader("👥 Top-Aktive Nutzer")
             
-            # Buchungstrends
-            trends = st.session_state.db.get_booking_trends(12)
-            if trends:
-                st.subheader("📈 Buchungstrends (12 Wochen)")
-                df_trends = pd.DataFrame(trends)
-                
-                fig_line = px.line(df_trends, x='week', y='bookings', 
-                                 title='Buchungen pro Woche',
-                                 labels={'bookings': 'Anzahl Buchungen', 'week': 'Kalenderwoche'})
-                st.plotly_chart(fig_line, use_container_width=True)
+            # Top 10 Chart
+            top_users = df_stats.head(10)
+            fig_bar = px.bar(top_users, x='name', y='total_bookings', 
+                            title='Top 10 Nutzer nach Buchungen',
+                            labels={'total_bookings': 'Anzahl Buchungen', 'name': 'Nutzer'})
+            st.plotly_chart(fig_bar, use_container_width=True)
             
-            # Slot-Verteilung
-            slot_dist = st.session_state.db.get_slot_distribution()
-            if slot_dist:
-                st.subheader("🕐 Slot-Verteilung")
-                df_slots = pd.DataFrame(slot_dist)
-                
-                fig_pie = px.pie(df_slots, values='count', names='slot',
-                               title='Verteilung der Buchungen nach Slots')
-                st.plotly_chart(fig_pie, use_container_width=True)
+            st.dataframe(df_stats, use_container_width=True)
         
-        # Freie Slots nächste 4 Wochen
-        st.subheader("🟢 Freie Slots (nächste 4 Wochen)")
-        free_slots = st.session_state.db.get_free_slots_next_weeks(4)
+        # Buchungstrends
+        df_trends = stats["trends"]
+        if len(df_trends) > 0:
+            st.subheader("📈 Buchungstrends (12 Wochen)")
+            
+            fig_line = px.line(df_trends, x='week', y='bookings', 
+                             title='Buchungen pro Woche',
+                             labels={'bookings': 'Anzahl Buchungen', 'week': 'Kalenderwoche'})
+            st.plotly_chart(fig_line, use_container_width=True)
         
-        if free_slots:
-            df_free = pd.DataFrame(free_slots)
-            st.dataframe(df_free[['date_de', 'day', 'time']], use_container_width=True)
+        # Slot-Verteilung
+        df_slots = stats["slot_dist"]
+        if len(df_slots) > 0:
+            st.subheader("🕐 Slot-Verteilung")
             
-            csv = df_free.to_csv(index=False)
-            st.download_button(
-                label="📥 Als CSV herunterladen",
-                data=csv,
-                file_name=f"freie_slots_{datetime.now().strftime('%Y%m%d')}.csv",
-                mime="text/csv"
-            )
+            fig_pie = px.pie(df_slots, values='count', names='slot',
+                           title='Verteilung der Buchungen nach Slots')
+            st.plotly_chart(fig_pie, use_container_width=True)
+    
+    # Freie Slots nächste 4 Wochen
+    st.subheader("🟢 Freie Slots (nächste 4 Wochen)")
+    free_slots = st.session_state.db.get_free_slots_next_weeks(4)
+    
+    if free_slots:
+        df_free = pd.DataFrame(free_slots)
+        st.dataframe(df_free[['date_de', 'day', 'time']], use_container_width=True)
+        
+        export_download("free_slots", "Freie Slots (CSV)", f"freie_slots_{datetime.now().strftime('%Y%m%d')}.csv")
+    else:
+        st.info("Alle Slots der nächsten 4 Wochen sind belegt oder blockiert")
+    
+    admin_assignment_panel()
+    
+    # Aufklappbarer Audit Log
+    with st.expander("📝 Change-Log (Audit Trail)"):
+        audit_search()
+        logs = st.session_state.db.get_audit_log(50)
+        
+        if logs:
+            df_logs = pd.DataFrame(logs)
+            st.dataframe(df_logs, use_container_width=True)
+            export_download("audit", "Kompletter Audit-Log (CSV)", f"audit_log_{datetime.now().strftime('%Y%m%d')}.csv")
         else:
-            st.info("Alle Slots der nächsten 4 Wochen sind belegt oder blockiert")
+            st.info("Keine Aktivitäten vorhanden")
+
+@st.fragment
+def audit_search():
+    """Volltextsuche im Audit-Log mit Zeitraum und Seitenweise-Blättern"""
+    col1, col2, col3 = st.columns([3, 1, 1])
+    query = col1.text_input("🔍 Audit-Log durchsuchen", key="audit_query",
+                            placeholder="z.B. cancelled booking_id=42, handbuch, rebook …")
+    since = col2.date_input("Ab", value=None, key="audit_since")
+    until = col3.date_input("Bis", value=None, key="audit_until")
+    if not query: return
+    
+    # Neue Suche beginnt wieder auf Seite 1
+    search_key = (query, since, until)
+    if st.session_state.get("audit_search_key") != search_key:
+        st.session_state.audit_search_key = search_key
+        st.session_state.audit_page = 0
+    page = st.session_state.audit_page
+    hits, more = st.session_state.db.search_audit(query, page, 25,
+                                                  since.isoformat() if since else None,
+                                                  until.isoformat() if until else None)
+    if not hits:
+        st.info("Keine Treffer")
+        return
+    for h in hits:
+        st.markdown(f"`{h['timestamp']}` **{h['action']}** — {h['user']}: {h['details'] or ''}")
+    
+    col_prev, col_page, col_next = st.columns([1, 2, 1])
+    if page > 0 and col_prev.button("⬅️ Zurück", key="audit_prev"):
+        st.session_state.audit_page -= 1
+        rerun_scoped()
+    col_page.caption(f"Seite {page + 1}")
+    if more and col_next.button("Weiter ➡️", key="audit_next"):
+        st.session_state.audit_page += 1
+        rerun_scoped()
+
+@st.fragment
+def admin_assignment_panel():
+    """Automatische, faire Zuteilung freier Slots (Vorschlag prüfen, dann übernehmen)"""
+    with st.expander("🧩 Automatische Zuteilung"):
+        col1, col2, col3 = st.columns(3)
+        start = col1.date_input("Von", value=date.today(), key="assign_start")
+        end = col2.date_input("Bis", value=date.today() + timedelta(weeks=8), key="assign_end")
+        per_week = col3.number_input("Max. Schichten/Woche", 1, 7, ASSIGN_MAX_PER_WEEK, key="assign_per_week")
         
-        # Aufklappbarer Audit Log
-        with st.expander("📝 Change-Log (Audit Trail)"):
-            logs = st.session_state.db.get_audit_log(50)
-            
-            if logs:
-                df_logs = pd.DataFrame(logs)
-                st.dataframe(df_logs, use_container_width=True)
-            else:
-                st.info("Keine Aktivitäten vorhanden")
+        if st.button("🧮 Vorschlag berechnen"):
+            with st.spinner("Zuteilung wird berechnet..."):
+                st.session_state.assign_proposal = propose_assignment(
+                    st.session_state.db, start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"), int(per_week))
+        
+        proposal = st.session_state.get("assign_proposal")
+        if not proposal: return
+        registry = active_slots()
+        if proposal["assignments"]:
+            df = pd.DataFrame(proposal["assignments"])
+            df["datum"] = df["date"].map(fmt_de)
+            df["schicht"] = df["slot_id"].map(lambda sid: registry.get(sid).label if registry.get(sid) else sid)
+            df["präferenz"] = df["preference"].map(AVAILABILITY_LEVELS.get)
+            st.dataframe(df[["datum", "schicht", "user_name", "präferenz", "load"]]
+                         .rename(columns={"user_name": "nutzer", "load": "bisherige Schichten"}),
+                         use_container_width=True, hide_index=True)
+        if proposal["unassigned"]:
+            st.warning(f"{len(proposal['unassigned'])} Slot(s) ohne verfügbare Person: " +
+                       ", ".join(fmt_de(x["date"]) for x in proposal["unassigned"][:10]))
+        
+        if proposal["assignments"] and st.button("✅ Vorschlag übernehmen", type="primary"):
+            result = apply_assignment(proposal["assignments"], actor_id=st.session_state.user["id"],
+                                      max_per_week=proposal.get("max_per_week", ASSIGN_MAX_PER_WEEK))
+            st.session_state.assign_proposal = None
+            st.success(f"{len(result['booked'])} Schicht(en) gebucht")
+            for c in result["conflicts"]:
+                st.warning(f"{fmt_de(c['date'])}: {c['reason']}")
+
+@st.fragment
+def admin_backup_tab():
+    """Admin-Tab: Backup und Restore"""
+    st.subheader("💾 Backup & Restore")
     
-    # Enhanced Backup/Restore
-    with admin_tabs[3]:
-        st.subheader("💾 Backup & Restore")
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        st.caption("📤 Backup erstellen")
+        export_download("backup", "ZIP-Backup", f"dienstplan_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip")
         
-        col1, col2 = st.columns(2)
+        if st.button("📧 Backup per E-Mail senden"):
+            if st.session_state.mail.enabled:
+                with st.spinner("Backup wird versendet..."):
+                    ok = _send_daily_backup(st.session_state.db, st.session_state.mail)
+                    if ok:
+                        st.success("✅ Backup erfolgreich versendet")
+                        st.session_state.db.log(st.session_state.user["id"], "manual_backup_sent", "email backup")
+                    else:
+                        st.error("❌ Backup konnte nicht versendet werden")
+            else:
+                st.warning("📴 E-Mail nicht aktiviert")
+    
+    with col2:
+        st.caption("📥 Backup wiederherstellen")
+        uploaded_file = st.file_uploader("ZIP-Backup auswählen", type=['zip'])
         
-        with col1:
-            st.caption("📤 Backup erstellen")
-            if st.button("📥 Backup herunterladen"):
-                backup_data = _create_backup_zip(st.session_state.db)
-                st.download_button(
-                    label="💾 ZIP-Backup herunterladen",
-                    data=backup_data,
-                    file_name=f"dienstplan_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
-                    mime="application/zip"
-                )
+        if uploaded_file:
+            st.warning("⚠️ ACHTUNG: Restore überschreibt alle bestehenden Daten!")
             
-            if st.button("📧 Backup per E-Mail senden"):
-                if st.session_state.mail.enabled:
-                    with st.spinner("Backup wird versendet..."):
-                        ok = _send_daily_backup(st.session_state.db, st.session_state.mail)
-                        if ok:
-                            st.success("✅ Backup erfolgreich versendet")
-                            st.session_state.db.log(st.session_state.user["id"], "manual_backup_sent", "email backup")
-                        else:
-                            st.error("❌ Backup konnte nicht versendet werden")
-                else:
-                    st.warning("📴 E-Mail nicht aktiviert")
-        
-        with col2:
-            st.caption("📥 Backup wiederherstellen")
-            uploaded_file = st.file_uploader("ZIP-Backup auswählen", type=['zip'])
+            # Zwei-Stufen-Bestätigung
+            confirm1 = st.checkbox("Ich verstehe, dass alle aktuellen Daten gelöscht werden")
+            confirm2 = st.checkbox("Ich möchte den Restore trotzdem durchführen")
             
-            if uploaded_file:
-                st.warning("⚠️ ACHTUNG: Restore überschreibt alle bestehenden Daten!")
-                
-                # Zwei-Stufen-Bestätigung
-                confirm1 = st.checkbox("Ich verstehe, dass alle aktuellen Daten gelöscht werden")
-                confirm2 = st.checkbox("Ich möchte den Restore trotzdem durchführen")
-                
-                if confirm1 and confirm2:
-                    if st.button("🔄 Backup wiederherstellen", type="secondary"):
-                        try:
-                            with zipfile.ZipFile(uploaded_file, 'r') as zip_file:
-                                json_files = [f for f in zip_file.namelist() if f.endswith('.json')]
-                                if json_files:
-                                    json_content = zip_file.read(json_files[0])
-                                    backup_data = json.loads(json_content)
-                                    
-                                    success, message = st.session_state.db.restore_from_backup(backup_data)
-                                    
-                                    if success:
-                                        st.session_state.db.log(st.session_state.user["id"], "backup_restored", f"file={uploaded_file.name}")
-                                        st.success("✅ Backup erfolgreich wiederhergestellt!")
-                                        st.info("🔄 Bitte App neu laden (F5)")
-                                        st.balloons()
-                                    else:
-                                        st.error(f"❌ Restore-Fehler: {message}")
+            if confirm1 and confirm2:
+                if st.button("🔄 Backup wiederherstellen", type="secondary"):
+                    try:
+                        with zipfile.ZipFile(uploaded_file, 'r') as zip_file:
+                            json_files = [f for f in zip_file.namelist() if f.endswith('.json')]
+                            if json_files:
+                                json_content = zip_file.read(json_files[0])
+                                backup_data = json.loads(json_content)
+                                
+                                success, message = st.session_state.db.restore_from_backup(backup_data)
+                                
+                                if success:
+                                    st.session_state.db.log(st.session_state.user["id"], "backup_restored", f"file={uploaded_file.name}")
+                                    st.success("✅ Backup erfolgreich wiederhergestellt!")
+                                    st.info("🔄 Bitte App neu laden (F5)")
+                                    st.balloons()
                                 else:
-                                    st.error("❌ Keine gültige Backup-Datei gefunden")
-                        except Exception as e:
-                            st.error(f"❌ Fehler beim Wiederherstellen: {e}")
+                                    st.error(f"❌ Restore-Fehler: {message}")
+                            else:
+                                st.error("❌ Keine gültige Backup-Datei gefunden")
+                    except Exception as e:
+                        st.error(f"❌ Fehler beim Wiederherstellen: {e}")
+    
+    admin_orphan_panel()
+
+@st.fragment
+def admin_orphan_panel():
+    """Bericht und manueller Start der Waisen-Bereinigung"""
+    with st.expander("🧹 Datenbereinigung (verwaiste Einträge)"):
+        st.caption("Buchungen ohne Nutzer, Reminder ohne Buchung und Verfügbarkeiten ohne Nutzer werden "
+                   "blockweise entfernt — nach jedem Restore"
+                   + (" und täglich um 03:30." if ENABLE_DB_MAINTENANCE else " (Nachtlauf: Secret ENABLE_DB_MAINTENANCE)."))
+        if st.button("🧹 Jetzt bereinigen", key="orphan_sweep_now"):
+            with st.spinner("Bereinigung läuft..."):
+                st.session_state.db.sweep_orphans()
+        report = st.session_state.db.orphan_sweep_report()
+        if report:
+            st.write(f"Letzter Lauf: {report['at']} — {report['total']} Zeile(n) entfernt "
+                     f"in {report['seconds']:.2f} s ({report['chunks']} Blöcke)")
+            st.dataframe(pd.DataFrame([{"tabelle": t, "entfernt": n} for t, n in report["removed"].items()]),
+                         use_container_width=True, hide_index=True)
+        else:
+            st.info("Noch kein Lauf protokolliert")
+
+@st.fragment
+def admin_performance_tab():
+    """Admin-Tab: Performance (Query-Instrumentierung)"""
+    st.subheader("⚡ Performance")
+    
+    col1, col2 = st.columns([3,1])
+    with col1:
+        enabled = st.toggle("DB-Instrumentierung aktiv", value=QUERY_STATS.enabled,
+                            help=f"Misst alle DB-Methoden und SQL-Statements. Slow-Query-Schwelle: {QUERY_STATS.slow_ms:g} ms")
+        if enabled != QUERY_STATS.enabled:
+            QUERY_STATS.enabled = enabled
+            st.session_state.db.log(st.session_state.user["id"], "db_profiling_toggled", f"enabled={enabled}")
+    with col2:
+        if st.button("🗑️ Zurücksetzen", key="perf_reset"):
+            QUERY_STATS.reset()
+            rerun_scoped()
+    
+    snap = QUERY_STATS.snapshot()
+    st.caption(f"Messung seit {snap['since'][:19].replace('T', ' ')}")
+    
+    if snap["methods"]:
+        st.markdown("**DB-Methoden**")
+        df_methods = pd.DataFrame(snap["methods"])
+        st.dataframe(df_methods, use_container_width=True, hide_index=True)
+        
+        method = st.selectbox("Latenz-Histogramm für", df_methods["method"].tolist(), key="perf_hist_method")
+        df_hist = pd.DataFrame({"bucket_ms": [f"≤{b}" for b in snap["buckets_ms"]],
+                                "calls": snap["histograms"].get(method, [])})
+        fig_hist = px.bar(df_hist, x="bucket_ms", y="calls", title=f"Latenzverteilung {method}",
+                          labels={"bucket_ms": "Latenz (ms)", "calls": "Aufrufe"})
+        st.plotly_chart(fig_hist, use_container_width=True)
+        
+        with st.expander("🧾 SQL-Statements"):
+            st.dataframe(pd.DataFrame(snap["statements"]), use_container_width=True, hide_index=True)
+        
+        with st.expander(f"🐢 Slow-Query-Log ({len(snap['slow_queries'])})"):
+            for q in reversed(snap["slow_queries"]):
+                st.markdown(f"**{q['timestamp']}** — `{q['method']}` — {q['ms']} ms")
+                st.code(f"{q['sql']}\n\n-- EXPLAIN QUERY PLAN\n{q['plan']}", language="sql")
+        
+        st.download_button(
+            label="📥 Performance-Daten exportieren (JSON)",
+            data=json.dumps(snap, indent=2, default=str),
+            file_name=f"dienstplan_performance_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+            mime="application/json"
+        )
+    elif QUERY_STATS.enabled:
+        st.info("Noch keine Messwerte - Seite neu laden oder Aktionen ausführen")
+    else:
+        st.info("Instrumentierung ist deaktiviert (Secret ENABLE_DB_PROFILING oder Schalter oben)")
+    
+    admin_db_health_panel()
+
+@st.fragment
+def admin_db_health_panel():
+    """DB-Gesundheit: Dateigröße, Freelist, Objektgrößen und letzte Wartung"""
+    db = st.session_state.db
+    with st.expander("🩺 DB-Gesundheit"):
+        health = db.db_health()
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Dateigröße", f"{health['size_bytes'] / 1048576:.1f} MB")
+        col2.metric("Seiten", f"{health['page_count']:,}".replace(",", "."))
+        col3.metric("Freelist", f"{health['freelist_count']:,}".replace(",", "."),
+                    help=f"{health['free_bytes'] / 1048576:.1f} MB ungenutzt")
+        col4.metric("auto_vacuum", health["auto_vacuum"])
+        st.caption(f"Seitengröße {health['page_size']} B · Journal {health['journal_mode']} · "
+                   f"Wartung {'täglich 04:00' if ENABLE_DB_MAINTENANCE else 'deaktiviert (ENABLE_DB_MAINTENANCE)'}")
+        
+        if st.button("🛠️ Wartung jetzt ausführen", key="db_maintenance_now"):
+            with st.spinner("ANALYZE, Vacuum und integrity_check laufen..."):
+                db.run_maintenance()
+                db.log(st.session_state.user["id"], "db_maintenance_manual", "")
+        
+        report = db.maintenance_report()
+        if not report:
+            st.info("Noch keine Wartung protokolliert")
+            return
+        integrity = "✅ ok" if report["integrity"] == "ok" else "❌ " + "; ".join(report["integrity"])
+        st.write(f"Letzte Wartung: {report['at']} ({report['seconds']:.2f} s) — Integrität {integrity} · "
+                 f"Vacuum {report['vacuum']} · {report['statistics']} · "
+                 f"{report['freed_bytes'] / 1048576:.1f} MB freigegeben")
+        df = pd.DataFrame(report["objects"])
+        if not df.empty and df["bytes"].notna().any():
+            df["KB"] = (df["bytes"] / 1024).round(1)
+            df = df.drop(columns=["bytes"])
+        st.caption("Tabellen und Indizes (Stand der letzten Wartung)")
+        st.dataframe(df, use_container_width=True, hide_index=True)
+
+@profile_ui
+def ui_admin():
+    st.subheader("⚙️ Admin-Panel")
+    
+    admin_tabs = st.tabs(["👥 Nutzer", "📝 Templates", "📊 Reporting", "💾 Backup/Restore", "⚡ Performance"])
+    
+    # Nutzerverwaltung
+    with admin_tabs[0]:
+        admin_users_tab()
+    
+    # Template-Editor
+    with admin_tabs[1]:
+        admin_templates_tab()
+    
+    # Enhanced Reporting mit Visualisierungen
+    with admin_tabs[2]:
+        admin_reporting_tab()
+    
+    # Enhanced Backup/Restore
+    with admin_tabs[3]:
+        admin_backup_tab()
+    
+    # Performance (Query-Instrumentierung)
+    with admin_tabs[4]:
+        admin_performance_tab()
 
 # ===== Enhanced Sidebar =====
+@st.fragment(run_every=PLAN_REFRESH_SECONDS or None)
+def sidebar_next_shift(uid):
+    next_shift = feed_cached(("next_shift", uid, date.today()), lambda: st.session_state.db.get_next_shift(uid))
+    if next_shift:
+        st.markdown(f'<div class="sidebar-info"><strong>📅 Nächster Dienst:</strong><br>{next_shift["day"]} {next_shift["date"]}<br>⏰ {next_shift["time"]}</div>', unsafe_allow_html=True)
+    else:
+        st.info("📅 Kein Dienst geplant")
+
+@profile_ui
 def render_sidebar():
     u = st.session_state.user
     
@@ -1713,17 +5348,31 @@ def render_sidebar():
         st.caption(f"Safe-Mode: {'🟢 ON' if SAFE_MODE else '🔴 OFF'}")
         st.caption(f"E-Mail: {'🟢 ON' if st.session_state.mail.enabled else '⚪ OFF'}")
         st.caption(f"SMS: {'🟢 ON' if st.session_state.sms.enabled else '⚪ OFF'}")
-        st.caption(f"Reminder: {'🟢 ON' if ENABLE_REMINDER_SMS else '⚪ OFF'}")
+        if ENABLE_REMINDER_SMS and REMINDERS.thread:
+            st.caption(f"Reminder: 🟢 ON ({REMINDERS.stats()['pending']} geplant)")
+        else:
+            st.caption(f"Reminder: {'🟢 ON' if ENABLE_REMINDER_SMS else '⚪ OFF'}")
+        for name, breaker in BREAKERS.items():
+            if breaker.state == "open":
+                st.caption(f"{name}-Circuit: 🔴 offen (Probe in {breaker.retry_in()} s)",
+                           help=breaker.last_error)
+            elif breaker.state == "half_open":
+                st.caption(f"{name}-Circuit: 🟡 Probe läuft", help=breaker.last_error)
+            elif breaker.stats["failures"] and u["role"] == "admin":
+                st.caption(f"{name}-Circuit: 🟢 geschlossen ({breaker.stats['failures']} Fehler gesamt)",
+                           help=breaker.last_error)
         st.caption(f"Version: {VERSION}")
         
+        if u["role"] == "admin" and not ENABLE_UI_PROFILER:
+            if st.toggle("🧪 UI-Profiler", key="ui_profiler_on", help="Zeitaufschlüsselung pro UI-Funktion und Rerun"):
+                st.checkbox("cProfile-Dump erstellen", key="ui_profiler_cprofile")
+        elif ENABLE_UI_PROFILER:
+            st.checkbox("cProfile-Dump erstellen", key="ui_profiler_cprofile")
+        
         st.divider()
         
         # Nächster Dienst
-        next_shift = st.session_state.db.get_next_shift(u["id"])
-        if next_shift:
-            st.markdown(f'<div class="sidebar-info"><strong>📅 Nächster Dienst:</strong><br>{next_shift["day"]} {next_shift["date"]}<br>⏰ {next_shift["time"]}</div>', unsafe_allow_html=True)
-        else:
-            st.info("📅 Kein Dienst geplant")
+        sidebar_next_shift(u["id"])
         
         # Handbuch-Link
         st.markdown("### 📖 Schnellzugriff")
@@ -1740,6 +5389,7 @@ def render_sidebar():
         # Abmelden
         if st.button("🚪 Abmelden", use_container_width=True):
             st.session_state.db.log(u["id"],"logout","user logout")
+            AUTH.revoke(st.session_state.pop("auth_token", None))
             del st.session_state["user"]
             st.rerun()
 
@@ -1752,39 +5402,60 @@ def main():
     
     u = st.session_state.user
     
-    # Sidebar rendern
-    render_sidebar()
+    # Sitzung über den Token-Cache prüfen (kein erneutes KDF pro Rerun)
+    if AUTH.resolve_token(st.session_state.get("auth_token")) != u["id"]:
+        del st.session_state["user"]
+        st.session_state.pop("auth_token", None)
+        st.info("🔒 Sitzung abgelaufen - bitte erneut anmelden")
+        ui_auth()
+        return
     
-    # Navigation
-    if u["role"] == "admin":
-        tabs = st.tabs(["📅 Plan", "👤 Meine Schichten", "📖 Handbuch", "👤 Profil", "⚙️ Admin"])
-        tab_plan, tab_shifts, tab_handbuch, tab_profile, tab_admin = tabs
-    else:
-        tabs = st.tabs(["📅 Plan", "👤 Meine Schichten", "📖 Handbuch", "👤 Profil"])
-        tab_plan, tab_shifts, tab_handbuch, tab_profile = tabs
-        tab_admin = None
+    # Profiler für diesen Rerun (nur Admin-/Entwicklermodus)
+    prof = UIProfiler(st.session_state.get("ui_profiler_cprofile", False)) if ui_profiler_enabled() else None
+    st.session_state._ui_profiler = prof
+    if prof: prof.start()
+    
+    try:
+        # Sidebar rendern
+        render_sidebar()
+    
+        # Navigation
+        if u["role"] == "admin":
+            tabs = st.tabs(["📅 Plan", "👤 Meine Schichten", "📖 Handbuch", "👤 Profil", "⚙️ Admin"])
+            tab_plan, tab_shifts, tab_handbuch, tab_profile, tab_admin = tabs
+        else:
+            tabs = st.tabs(["📅 Plan", "👤 Meine Schichten", "📖 Handbuch", "👤 Profil"])
+            tab_plan, tab_shifts, tab_handbuch, tab_profile = tabs
+            tab_admin = None
+    
+        with tab_plan:
+            ui_plan()
     
-    with tab_plan:
-        ui_plan()
+        with tab_shifts:
+            ui_my_shifts()
     
-    with tab_shifts:
-        ui_my_shifts()
+        with tab_handbuch:
+            ui_handbuch()
     
-    with tab_handbuch:
-        ui_handbuch()
+        with tab_profile:
+            ui_profile()
     
-    with tab_profile:
-        ui_profile()
+        if tab_admin:
+            with tab_admin:
+                ui_admin()
+    finally:
+        if prof:
+            prof.stop()
+            st.session_state._ui_profiler = None
     
-    if tab_admin:
-        with tab_admin:
-            ui_admin()
+    if prof:
+        render_profiler_overlay(prof)
 
 # ===== Scheduler-Management =====
 def manage_scheduler():
     """Scheduler-Management nur im UI-Kontext"""
     if ("sched" not in st.session_state or not st.session_state.sched) and not SAFE_MODE:
-        if ENABLE_DAILY_BACKUP or ENABLE_REMINDER_SMS:
+        if ENABLE_DAILY_BACKUP or ENABLE_REMINDER_SMS or ENABLE_DB_MAINTENANCE:
             st.session_state.sched = start_scheduler(st.session_state.db, st.session_state.mail, st.session_state.sms)
 
 if __name__ == "__main__":
@@ -0,0 +1,95 @@
+"""Tests der JSON-API über den In-Process-Client (ohne Netzwerk, SAFE_MODE)
+
+Aufruf:
+    python -m unittest test_api      (oder: python -m pytest test_api.py)
+"""
+import os, sys, tempfile, unittest
+from datetime import date, timedelta
+from pathlib import Path
+
+# streamlit liest secrets.toml relativ zum Arbeitsverzeichnis beim Import:
+# daher vor dem App-Import in ein Temp-Verzeichnis mit eigenen Secrets wechseln
+ADMIN_EMAIL = "test-admin@dienstplan.local"
+ADMIN_PASSWORD = "test-admin-pw"
+_TMP = tempfile.TemporaryDirectory(prefix="dienstplan-test-")
+os.makedirs(os.path.join(_TMP.name, ".streamlit"))
+with open(os.path.join(_TMP.name, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+    f.write(f'SAFE_MODE = "true"\nADMIN_EMAIL = "{ADMIN_EMAIL}"\nADMIN_PASSWORD = "{ADMIN_PASSWORD}"\n')
+_CWD = os.getcwd()
+os.chdir(_TMP.name)
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import streamlit_app as app  # noqa: E402
+
+def tearDownModule():
+    os.chdir(_CWD)
+    _TMP.cleanup()
+
+class BookingAPITest(unittest.TestCase):
+    def setUp(self):
+        self.db = app.DB(os.path.join(_TMP.name, f"{self.id()}.db"))
+        self.client = app.APIClient(app.BookingAPI(app.Services(self.db, app.Mailer(), app.TwilioSMS())))
+
+    def free_slot(self):
+        slot = next(iter(app.active_slots()))
+        ws = app.week_start(date.today() + timedelta(weeks=1))
+        while app.is_blocked_date(slot.date_in_week(ws)):
+            ws += timedelta(weeks=1)
+        return slot, slot.date_in_week(ws)
+
+    def test_login(self):
+        status, data = self.client.login(ADMIN_EMAIL, "falsch")
+        self.assertEqual(status, 401)
+        status, data = self.client.login(ADMIN_EMAIL, ADMIN_PASSWORD)
+        self.assertEqual(status, 200)
+        self.assertEqual(data["user"]["email"], ADMIN_EMAIL)
+
+    def test_week_requires_token(self):
+        status, _, _ = self.client.request("GET", "/api/week")
+        self.assertEqual(status, 401)
+        self.client.login(ADMIN_EMAIL, ADMIN_PASSWORD)
+        status, _, data = self.client.request("GET", "/api/week")
+        self.assertEqual(status, 200)
+        self.assertEqual(len(data["slots"]), len(app.active_slots()))
+
+    def test_book_double_book_cancel(self):
+        self.client.login(ADMIN_EMAIL, ADMIN_PASSWORD)
+        slot, d = self.free_slot()
+        status, _, data = self.client.request("POST", "/api/bookings", {"slot_id": slot.id, "date": d})
+        self.assertEqual(status, 201)
+        booking_id = data["booking_id"]
+
+        status, _, _ = self.client.request("POST", "/api/bookings", {"slot_id": slot.id, "date": d})
+        self.assertEqual(status, 409)
+
+        status, _, data = self.client.request("GET", f"/api/week?start={d}")
+        cell = next(s for s in data["slots"] if s["slot_id"] == slot.id)
+        self.assertEqual((cell["status"], cell["booking_id"], cell["mine"]), ("booked", booking_id, True))
+
+        status, _, _ = self.client.request("DELETE", f"/api/bookings/{booking_id}")
+        self.assertEqual(status, 204)
+        status, _, _ = self.client.request("DELETE", f"/api/bookings/{booking_id}")
+        self.assertEqual(status, 404)
+
+    def test_bad_input(self):
+        self.client.login(ADMIN_EMAIL, ADMIN_PASSWORD)
+        slot, d = self.free_slot()
+        cases = [
+            ("POST", "/api/login", [1, 2]),
+            ("POST", "/api/bookings", "x"),
+            ("POST", "/api/bookings", {"slot_id": slot.id, "date": "morgen"}),
+            ("POST", "/api/bookings", {"slot_id": 999, "date": d}),
+            ("GET", "/api/free?weeks=viele", None),
+            ("POST", "/api/bookings", {"slot_id": [slot.id], "date": d}),
+            ("POST", "/api/bookings/series", {"slot_id": slot.id, "from": d, "until": d, "every_weeks": "x"}),
+            ("POST", "/api/bookings/series", {"slot_id": slot.id, "from": d, "until": d, "every_weeks": 0}),
+            ("POST", "/api/bookings/series", {"items": [{"slot_id": [slot.id], "date": d}]}),
+            ("POST", "/api/bookings/series", {"items": [{"slot_id": slot.id, "date": d}], "user_id": [1]}),
+        ]
+        for method, path, payload in cases:
+            with self.subTest(path=path, payload=payload):
+                status, _, data = self.client.request(method, path, payload)
+                self.assertEqual(status, 400, data)
+
+if __name__ == "__main__":
+    unittest.main()